@@ -3,7 +3,9 @@ Project: MT Server Land
  Author: Christian Federmann <cfedermann@gmail.com>
 """
 from django.contrib import admin
-from serverland.dashboard.models import WorkerServer, TranslationRequest
+from serverland.dashboard.models import WorkerServer, TranslationRequest, \
+  WorkerLanguagePair
 
 admin.site.register(WorkerServer)
-admin.site.register(TranslationRequest)
\ No newline at end of file
+admin.site.register(TranslationRequest)
+admin.site.register(WorkerLanguagePair)
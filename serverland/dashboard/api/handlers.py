@@ -9,14 +9,16 @@ Web API handlers for the serverland dashboard.
 from django.contrib import messages
 #from django.core.urlresolvers import reverse
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import get_object_or_404
 from piston.handler import BaseHandler
 from piston.utils import rc, throttle
-from serverland.dashboard.models import WorkerServer, TranslationRequest
+from serverland.dashboard.models import WorkerServer, TranslationRequest, \
+     RUNNING
 from serverland.dashboard.forms import TranslationRequestForm
 from serverland.protobuf.TranslationRequestMessage_pb2 import \
      TranslationRequestMessage
-from serverland.settings import TRANSLATION_MESSAGE_PATH
+from serverland.settings import TRANSLATION_MESSAGE_PATH, API_PAGE_SIZE
 import uuid
 
 MAX_REQUESTS_PER_MINUTE = 250
@@ -33,7 +35,18 @@ class RequestHandler(BaseHandler):
         user_requests = TranslationRequest.objects.filter(owner=request.user)
 
         if shortname is None:
-            objects = user_requests.all()
+            # listings are paginated, newest first, and may be restricted
+            # to one state, e.g. ?state=running&page=2
+            objects = user_requests.select_related('owner', 'worker')
+            objects = objects.order_by('-created')
+            if 'state' in request.GET:
+                objects = objects.filter(state=request.GET['state'])
+            paginator = Paginator(objects, API_PAGE_SIZE)
+            try:
+                objects = paginator.page(request.GET.get('page', 1))
+                objects = objects.object_list
+            except (PageNotAnInteger, EmptyPage):
+                return rc.BAD_REQUEST
         else:
             try:
                 # cfedermann: I'm not at all sure why Will placed the UUID
@@ -46,7 +59,9 @@ class RequestHandler(BaseHandler):
                 objects = [get_object_or_404(user_requests,
                   shortname=shortname)]
         
-        objects = [ RequestHandler.request_to_dict(o, results)
+        # progress is only queried from the worker for single requests
+        objects = [ RequestHandler.request_to_dict(o, results,
+                    include_progress=shortname is not None)
                     for o in objects ]
         if len(objects) == 1:
             objects = objects[0]
@@ -62,8 +77,9 @@ class RequestHandler(BaseHandler):
         postdata = self.flatten_dict(request.POST)
         # ensure that the worker field is present
         postdata['worker'] = postdata.get('worker','')
-        # convert worker shortname to a worker ID if needed
-        if not postdata['worker'].isdigit():
+        # convert worker shortname to a worker ID if needed; without a
+        # worker, the form routes the request by its language pair
+        if postdata['worker'] and not postdata['worker'].isdigit():
             try:
                 postdata['worker'] = str(WorkerServer.objects.get(
                     shortname=postdata['worker']).id)
@@ -105,11 +121,11 @@ class RequestHandler(BaseHandler):
         handle.write(message.SerializeToString())
         handle.close()
 
+        # queued on the broker, see the dispatch_requests command
         new.save()
-        new.start_translation()
 
         messages.add_message(request, messages.SUCCESS, 'Successfully ' \
-                             'started translation request "{0}".'.format(
+                             'queued translation request "{0}".'.format(
                                 new.shortname))
         
         # FIXME: Could not figure out why Piston is insisting on returning the
@@ -156,7 +172,8 @@ class RequestHandler(BaseHandler):
         return rc.DELETED
 
     @staticmethod
-    def request_to_dict ( request, include_results = False ):
+    def request_to_dict ( request, include_results = False,
+                          include_progress = False ):
         '''Transforms a TranslationRequest object to a Python
         dictionary.'''
         retval = {}
@@ -165,8 +182,12 @@ class RequestHandler(BaseHandler):
         retval['worker'] = request.worker.shortname
         retval['created'] = request.created
         retval['request_id'] = request.request_id
+        retval['state'] = request.state
+        retval['queued'] = request.is_queued()
         retval['ready'] = request.is_ready()
         retval['deleted'] = request.deleted
+        if include_progress and request.state == RUNNING:
+            retval['progress'] = request.progress()
         if include_results:
             translation_message = request.fetch_translation()
             if type(translation_message) == TranslationRequestMessage:
@@ -177,6 +198,11 @@ class RequestHandler(BaseHandler):
                                 translation_message.packet_data] )
             else:
                 retval['result'] = translation_message
+                # running requests return the target prefix translated so far,
+                # or None if the worker server cannot provide it
+                if request.state == RUNNING:
+                    retval['partial_result'] = \
+                        request.fetch_partial_translation()
         return retval
 
 class WorkerHandler(BaseHandler):
@@ -192,6 +218,7 @@ class WorkerHandler(BaseHandler):
             objects = WorkerServer.objects.filter(users=request.user)
         else:
             objects = [get_object_or_404(WorkerServer, shortname=shortname)]
+        WorkerServer.prefetch(objects, 'is_alive')
         objects = [ WorkerHandler.server_to_dict(o) for o in objects ]
         if len(objects) == 1:
             objects = objects[0]
@@ -203,9 +230,11 @@ class WorkerHandler(BaseHandler):
         retval = {}
         retval['shortname'] = server.shortname
         retval['description'] = server.description
-        retval['is_alive'] = server.is_alive()
+        retval['is_alive'] = server.cached('is_alive')
         if retval['is_alive']:
-            retval['is_busy'] = server.is_busy()
-            retval['language_pairs'] = [ x for x in server.language_pairs() ]
+            retval['is_busy'] = server.cached('is_busy')
+            retval['language_pairs'] = [ x for x in
+                                         server.cached('language_pairs') ]
+        retval['transport'] = server.transport_stats()
         return retval
 
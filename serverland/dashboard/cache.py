@@ -0,0 +1,142 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+In-process cache for worker server status and capabilities.
+
+Entries expire after a time-to-live.  Expired entries are still returned for
+up to stale seconds while a single background thread refreshes them, so that
+rendering forms does not wait for worker servers.  If several threads miss
+the same key, only one of them calls the loader; the others wait for it.
+"""
+from threading import Event, Lock, Thread
+from time import time
+
+
+class StatusCache(object):
+    """
+    TTL cache with single-flight loading and stale-while-revalidate.
+    """
+    def __init__(self, stale=None, empty_ttl=None):
+        """
+        Creates a new StatusCache.
+
+        Expired values are served for up to stale seconds while they are
+        refreshed, None serves them indefinitely.  Empty values, e.g. from a
+        worker server that could not be reached, are kept for at most
+        empty_ttl seconds.
+        """
+        self.stale = stale
+        self.empty_ttl = empty_ttl
+        self.lock = Lock()
+        self.entries = {}
+        self.loading = {}
+
+    def _start(self, key):
+        """
+        Registers a load for the given key, must be called with the lock.
+
+        Returns a (event, owner) tuple; owner is True if the caller has to
+        run the load, otherwise it may wait for event.
+        """
+        if key in self.loading:
+            return self.loading[key], False
+
+        event = Event()
+        self.loading[key] = event
+        return event, True
+
+    def _load(self, key, loader, ttl, event):
+        """Runs the loader and stores its value for ttl seconds."""
+        try:
+            value = loader()
+            if not value and self.empty_ttl is not None:
+                ttl = min(ttl, self.empty_ttl)
+
+            with self.lock:
+                self.entries[key] = (value, time() + ttl)
+
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def _lookup(self, key, now):
+        """
+        Returns a (entry, fresh) tuple for the given key, must be called with
+        the lock.  entry is None if there is no usable entry.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+
+        if entry[1] > now:
+            return entry, True
+
+        if self.stale is None or entry[1] + self.stale > now:
+            return entry, False
+
+        return None, False
+
+    def get(self, key, loader, ttl):
+        """
+        Returns the cached value for the given key, calling loader() to load
+        it if required.  Loaded values are fresh for ttl seconds.
+        """
+        with self.lock:
+            entry, fresh = self._lookup(key, time())
+            if entry and fresh:
+                return entry[0]
+
+            event, owner = self._start(key)
+
+        # A stale entry is served while a background thread refreshes it.
+        if entry:
+            if owner:
+                thread = Thread(target=self._load,
+                  args=(key, loader, ttl, event))
+                thread.daemon = True
+                thread.start()
+
+            return entry[0]
+
+        if owner:
+            self._load(key, loader, ttl, event)
+        else:
+            event.wait()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        return entry[0] if entry else loader()
+
+    def prefetch(self, items):
+        """
+        Loads the given (key, loader, ttl) items concurrently, waiting only
+        for items that have no usable entry yet.
+        """
+        events = []
+        for key, loader, ttl in items:
+            with self.lock:
+                entry, fresh = self._lookup(key, time())
+                if fresh:
+                    continue
+
+                event, owner = self._start(key)
+
+            if owner:
+                thread = Thread(target=self._load,
+                  args=(key, loader, ttl, event))
+                thread.daemon = True
+                thread.start()
+
+            if not entry:
+                events.append(event)
+
+        for event in events:
+            event.wait()
+
+    def invalidate(self, key):
+        """Removes the given key from the cache."""
+        with self.lock:
+            self.entries.pop(key, None)
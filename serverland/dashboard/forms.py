@@ -9,7 +9,8 @@ import subprocess
 from os import remove
 from django.forms import ModelForm, ValidationError, FileField, ChoiceField, \
   ModelChoiceField
-from serverland.dashboard.models import TranslationRequest, WorkerServer
+from serverland.dashboard.models import TranslationRequest, WorkerServer, \
+  WorkerLanguagePair
 from serverland.settings import LOG_LEVEL, LOG_HANDLER
 
 # Setup logging support.
@@ -44,6 +45,8 @@ class TranslationRequestForm(ModelForm):
     Form class for a translation request object
     
     The available worker servers are computed based on a given user instance.
+    If no worker server is chosen, the request is routed to the least loaded
+    worker server supporting the language pair.
     
     """
     def __init__(self, user, *args, **kwargs):
@@ -58,10 +61,24 @@ class TranslationRequestForm(ModelForm):
         else:
             worker_queryset = WorkerServer.objects.all()
         
-        language_pairs = []
-        for worker in worker_queryset:
+        self.worker_queryset = worker_queryset
+        self.fields['worker'].required = False
+        self.fields['worker'].empty_label = 'Automatic (least loaded)'
+
+        # Language pairs are taken from the index maintained by the worker
+        # health checks.  Worker servers which have not been checked yet are
+        # not in the index, so we ask them concurrently, using cached values
+        # where available.
+        language_pairs = set(WorkerLanguagePair.objects.filter(
+          worker__in=worker_queryset).values_list('source_language',
+          'target_language').distinct())
+
+        unchecked = list(worker_queryset.filter(checked__isnull=True))
+        WorkerServer.prefetch(unchecked, 'language_pairs')
+
+        for worker in unchecked:
             try:
-                language_pairs.extend([x for x in worker.language_pairs()])
+                language_pairs.update(worker.cached('language_pairs'))
             
             except:
                 LOGGER.warning('Could not access language pairs for ' \
@@ -87,7 +104,8 @@ class TranslationRequestForm(ModelForm):
     class Meta:
         """Meta class that connects to the TranslationRequest class."""
         model = TranslationRequest
-        exclude = ('request_id', 'owner', 'created', 'ready', 'deleted')
+        exclude = ('request_id', 'owner', 'created', 'dispatched', 'ready',
+          'deleted', 'state', 'state_changed', 'started', 'finished')
 
     source_language = ChoiceField(choices=LANGUAGE_CODES)
     target_language = ChoiceField(choices=LANGUAGE_CODES)
@@ -105,12 +123,26 @@ class TranslationRequestForm(ModelForm):
 
         worker = self.cleaned_data.get('worker')
 
-        if worker and worker.is_busy():
-            raise ValidationError('Worker is currently busy!')
-
-        if worker and not (source, target) in worker.language_pairs():
+        if worker and not worker.supports(source, target):
             raise ValidationError('Worker does not support language pair!')
 
+        if not worker and not 'worker' in self.errors:
+            worker = WorkerServer.route(source, target, self.worker_queryset)
+
+            # Unchecked worker servers are not routed to, but may be the only
+            # ones supporting the language pair.
+            if not worker:
+                for candidate in self.worker_queryset.filter(
+                  checked__isnull=True):
+                    if candidate.supports(source, target):
+                        worker = candidate
+                        break
+
+            if not worker:
+                raise ValidationError('No worker supports language pair!')
+
+            self.cleaned_data['worker'] = worker
+
         return self.cleaned_data
 
     def clean_shortname(self):
@@ -132,12 +164,15 @@ class TranslationRequestForm(ModelForm):
     def clean_worker(self):
         """Checks that the chosen worker server is up an running."""
         data = self.cleaned_data['worker']
+        if not data:
+            return data
+
         LOGGER.debug('clean_worker() called for worker"{0}".'.format(
           data.shortname))
 
         # Check if the WorkerServer instance is alive, otherwise raise error.
         try:
-            assert(data.is_alive())
+            assert(data.cached('is_alive'))
 
         except (socket.error, AssertionError):
             raise ValidationError("The chosen worker server is not running.")
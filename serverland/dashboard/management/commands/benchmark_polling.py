@@ -0,0 +1,243 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Benchmarks concurrent dashboard polling against the SQLite database.
+
+Creates a scratch SQLite database with syncdb, seeds it with translation
+requests and points the default database connection at it.  A number of
+pollers then render the dashboard sections of one owner each, using the
+dashboard's ORM queries, while a harvester finishes running requests in the
+background.  This is done twice:
+
+- "save": the harvester finishes each request by saving it, as
+  TranslationRequest.transition() did before transitions were bulk updates;
+- "bulk": the harvester finishes each batch of requests with
+  TranslationRequest.bulk_transition().
+
+Reports the number of UPDATE statements written by the harvester and the
+median and 99th percentile page latency for both modes:
+
+    python manage.py benchmark_polling --pollers=50
+"""
+import datetime
+import os
+import shutil
+import sqlite3
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection, DatabaseError
+from optparse import make_option
+from serverland.dashboard.management.commands.benchmark_requests import seed
+from serverland.dashboard.models import TranslationRequest, WorkerServer, \
+  QUEUED, RUNNING, FINISHED, FAILED, INVALID
+from serverland.settings import DASHBOARD_PAGE_SIZE
+from tempfile import mkstemp
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+# Number of worker servers the seeded requests are spread across.
+WORKERS = 10
+
+
+class Counters(object):
+    """Thread-safe write, error and latency book-keeping for one run."""
+    def __init__(self):
+        self.lock = Lock()
+        self.writes = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, writes=0, errors=0, latency=None):
+        """Adds the given numbers to the counters."""
+        with self.lock:
+            self.writes += writes
+            self.errors += errors
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def percentile(self, fraction):
+        """Returns the given percentile of page latencies in milliseconds."""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+
+        index = min(len(latencies) - 1, int(len(latencies) * fraction))
+        return latencies[index] * 1000
+
+
+def use_database(filename):
+    """
+    Points the default database connection at the given SQLite file, both
+    for this thread and for threads connecting afterwards.
+    """
+    connection.close()
+    connection.settings_dict['NAME'] = filename
+
+
+def save_transition(request, state):
+    """
+    Moves the request into the given state by saving it, as transition()
+    did before state transitions were written in bulk.
+    """
+    now = datetime.datetime.now()
+    request.state = state
+    request.state_changed = now
+    if state == FINISHED:
+        request.ready = True
+        request.finished = now
+
+    request.save()
+
+
+def poll(owner, polls, counters):
+    """
+    Renders the first page of each dashboard section of the given owner
+    polls times, see dashboard.views.dashboard().
+    """
+    ordered = TranslationRequest.objects.all().order_by('-created')
+    requests = ordered.filter(owner=owner).select_related('worker')
+    sections = (requests.filter(state__in=(QUEUED, RUNNING)),
+      requests.filter(state=FINISHED),
+      requests.filter(state__in=(FAILED, INVALID)))
+
+    for _ in range(polls):
+        started = time()
+        try:
+            for section in sections:
+                page = Paginator(section, DASHBOARD_PAGE_SIZE).page(1)
+                list(page.object_list)
+
+            counters.add(latency=time() - started)
+
+        except DatabaseError:
+            counters.add(errors=1)
+
+    connection.close()
+
+
+def harvest(bulk, batch, stopped, counters):
+    """
+    Finishes the oldest running requests in batches until stopped is set.
+
+    If bulk is True, each batch is finished with bulk_transition(),
+    otherwise each request is saved on its own, see save_transition().
+    """
+    connection.use_debug_cursor = True
+    while not stopped.is_set():
+        try:
+            requests = list(TranslationRequest.objects.filter(
+              state=RUNNING).order_by('created')[:batch])
+            if not requests:
+                break
+
+            del connection.queries[:]
+            if bulk:
+                TranslationRequest.bulk_transition(requests, FINISHED)
+
+            else:
+                for request in requests:
+                    save_transition(request, FINISHED)
+
+            counters.add(writes=len([query for query in connection.queries
+              if query['sql'].startswith('UPDATE')]))
+
+        except DatabaseError:
+            counters.add(errors=1)
+
+        sleep(0.05)
+
+    connection.close()
+
+
+def run(options, bulk):
+    """Runs pollers and harvester on the current database, returns counters."""
+    counters = Counters()
+    stopped = Event()
+    harvester = Thread(target=harvest, args=(bulk, options['batch'],
+      stopped, counters))
+    harvester.start()
+
+    pollers = [Thread(target=poll, args=(owner + 1, options['polls'],
+      counters)) for owner in range(options['pollers'])]
+    for poller in pollers:
+        poller.start()
+    for poller in pollers:
+        poller.join()
+
+    stopped.set()
+    harvester.join()
+    return counters
+
+
+class Command(BaseCommand):
+    """Management command benchmarking concurrent dashboard polling."""
+    help = 'Benchmarks concurrent dashboard polling against SQLite.'
+
+    option_list = BaseCommand.option_list + (
+      make_option('--rows', type='int', default=100000,
+        help='Number of translation requests to seed.'),
+      make_option('--pollers', type='int', default=50,
+        help='Number of parallel pollers, each polling its own owner.'),
+      make_option('--polls', type='int', default=20,
+        help='Number of dashboard pages rendered by each poller.'),
+      make_option('--batch', type='int', default=50,
+        help='Number of requests finished by the harvester per round.'),
+    )
+
+    def handle(self, *args, **options):
+        """Seeds the scratch database and reports polling statistics."""
+        if connection.vendor != 'sqlite':
+            self.stderr.write('This benchmark needs an SQLite database.\n')
+            return
+
+        database = connection.settings_dict['NAME']
+        handle, template = mkstemp(suffix='.db')
+        os.close(handle)
+        filenames = [template]
+        try:
+            self.stdout.write('Seeding {0} requests...\n'.format(
+              options['rows']))
+            use_database(template)
+            call_command('syncdb', interactive=False, verbosity=0)
+            for index in range(WORKERS):
+                WorkerServer.objects.create(shortname='worker-{0}'.format(
+                  index + 1), hostname='localhost', port='0')
+            connection.close()
+
+            seeding = sqlite3.connect(template)
+            seed(seeding.cursor(), options['rows'], options['pollers'],
+              WORKERS)
+            seeding.execute('ANALYZE')
+            seeding.commit()
+            seeding.close()
+
+            results = []
+            for name, bulk in (('save', False), ('bulk', True)):
+                filename = '{0}.{1}'.format(template, name)
+                filenames.extend([filename, filename + '-wal',
+                  filename + '-shm'])
+                shutil.copy(template, filename)
+                use_database(filename)
+
+                self.stdout.write('Running {0} pollers ({1})...\n'.format(
+                  options['pollers'], name))
+                started = time()
+                counters = run(options, bulk)
+                results.append((name, counters, time() - started))
+
+        finally:
+            use_database(database)
+            for filename in filenames:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        self.stdout.write('{0:<8} {1:>8} {2:>8} {3:>10} {4:>10} ' \
+          '{5:>8}\n'.format('mode', 'writes', 'errors', 'p50 (ms)',
+          'p99 (ms)', 'time (s)'))
+        for name, counters, elapsed in results:
+            self.stdout.write('{0:<8} {1:>8} {2:>8} {3:>10.2f} {4:>10.2f} ' \
+              '{5:>8.1f}\n'.format(name, counters.writes, counters.errors,
+              counters.percentile(0.5), counters.percentile(0.99), elapsed))
@@ -0,0 +1,197 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Benchmarks TranslationRequest lookup paths with and without indexes.
+
+Seeds a scratch SQLite database with the TranslationRequest table, measures
+the latency of each lookup path on the previous schema, then creates the
+indexes of the current schema and measures again:
+
+    python manage.py benchmark_requests --rows=1000000
+"""
+import os
+import random
+import sqlite3
+import uuid
+
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from tempfile import mkstemp
+from time import time
+
+# TranslationRequest table as created by the previous schema, which only
+# had the foreign key indexes.
+TABLE_SQL = (
+  '''CREATE TABLE "dashboard_translationrequest" (
+    "id" integer NOT NULL PRIMARY KEY,
+    "shortname" varchar(50) NOT NULL,
+    "request_id" varchar(32) NOT NULL,
+    "worker_id" integer NOT NULL,
+    "owner_id" integer NOT NULL,
+    "created" datetime NOT NULL,
+    "dispatched" bool NOT NULL,
+    "ready" bool NOT NULL,
+    "deleted" bool NOT NULL,
+    "state" varchar(10) NOT NULL,
+    "state_changed" datetime NULL,
+    "started" datetime NULL,
+    "finished" datetime NULL)''',
+  '''CREATE INDEX "dashboard_translationrequest_20fc5b84"
+    ON "dashboard_translationrequest" ("worker_id")''',
+  '''CREATE INDEX "dashboard_translationrequest_5d52dd10"
+    ON "dashboard_translationrequest" ("owner_id")''',
+)
+
+# Unique index created for request_id by the current model definition.
+UNIQUE_SQL = '''CREATE UNIQUE INDEX dashboard_translationrequest_request_id
+  ON dashboard_translationrequest (request_id)'''
+
+CUSTOM_SQL = os.path.join(os.path.dirname(__file__), '..', '..', 'sql',
+  'translationrequest.sql')
+
+# Lookup paths as issued by the ORM; parameters are filled in per run.
+LOOKUPS = (
+  ('create_request_id', 'SELECT (1) FROM dashboard_translationrequest '
+    'WHERE request_id = ? LIMIT 1', ('request_id',)),
+  ('clean_shortname', 'SELECT COUNT(*) FROM dashboard_translationrequest '
+    'WHERE deleted = 0 AND shortname = ?', ('shortname',)),
+  ('api_by_request_id', 'SELECT * FROM dashboard_translationrequest '
+    'WHERE owner_id = ? AND request_id = ?', ('owner', 'request_id')),
+  ('api_by_shortname', 'SELECT * FROM dashboard_translationrequest '
+    'WHERE owner_id = ? AND shortname = ?', ('owner', 'shortname')),
+  ('dashboard_finished', 'SELECT * FROM dashboard_translationrequest '
+    'WHERE owner_id = ? AND state = \'finished\' '
+    'ORDER BY created DESC LIMIT 25', ('owner',)),
+  ('dashboard_active', 'SELECT * FROM dashboard_translationrequest '
+    'WHERE owner_id = ? AND state IN (\'queued\', \'running\') '
+    'ORDER BY created DESC LIMIT 25', ('owner',)),
+  ('dashboard_count', 'SELECT COUNT(*) FROM dashboard_translationrequest '
+    'WHERE owner_id = ? AND state = \'finished\'', ('owner',)),
+  ('dispatcher', 'SELECT * FROM dashboard_translationrequest '
+    'WHERE state = \'queued\' ORDER BY created LIMIT 100', ()),
+  ('harvester', 'SELECT * FROM dashboard_translationrequest '
+    'WHERE state = \'running\' ORDER BY created LIMIT 100', ()),
+)
+
+
+def seed(cursor, rows, owners, workers):
+    """
+    Inserts rows random requests, returns a list of sample rows.
+
+    Most requests are finished, a few are deleted, queued or running.
+    """
+    start = datetime(2010, 1, 1)
+    samples = []
+    batch = []
+    for index in range(rows):
+        created = start + timedelta(seconds=index * 30)
+        progress = random.random()
+        dispatched = progress > 0.01
+        ready = progress > 0.03
+        deleted = random.random() < 0.05
+        finished = created + timedelta(minutes=5) if ready else None
+        state = 'deleted' if deleted else 'finished' if ready else \
+          'running' if dispatched else 'queued'
+        row = (u'request-{0}'.format(index), uuid.uuid4().hex,
+          random.randint(1, workers), random.randint(1, owners), created,
+          dispatched, ready, deleted, state, finished or created, finished)
+        batch.append(row)
+
+        if index % (rows / 100 or 1) == 0:
+            samples.append(row)
+
+        if len(batch) == 10000:
+            cursor.executemany('INSERT INTO dashboard_translationrequest '
+              '(shortname, request_id, worker_id, owner_id, created, '
+              'dispatched, ready, deleted, state, state_changed, finished) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+
+    if batch:
+        cursor.executemany('INSERT INTO dashboard_translationrequest '
+          '(shortname, request_id, worker_id, owner_id, created, '
+          'dispatched, ready, deleted, state, state_changed, finished) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+
+    return samples
+
+
+def create_indexes(cursor):
+    """Creates the indexes of the current schema."""
+    cursor.execute(UNIQUE_SQL)
+    with open(CUSTOM_SQL) as sql_file:
+        lines = [line for line in sql_file if not line.startswith('--')]
+    for sql in ''.join(lines).split(';'):
+        if sql.strip():
+            cursor.execute(sql)
+    cursor.execute('ANALYZE')
+
+
+def measure(cursor, samples, repeat):
+    """
+    Returns a dictionary mapping lookup names to the median latency in
+    milliseconds over repeat runs.
+    """
+    results = {}
+    for name, sql, params in LOOKUPS:
+        timings = []
+        for run in range(repeat):
+            sample = samples[run % len(samples)]
+            values = {'shortname': sample[0], 'request_id': sample[1],
+              'owner': sample[3]}
+            started = time()
+            cursor.execute(sql, [values[param] for param in params])
+            cursor.fetchall()
+            timings.append((time() - started) * 1000)
+
+        timings.sort()
+        results[name] = timings[len(timings) / 2]
+
+    return results
+
+
+class Command(BaseCommand):
+    """Management command benchmarking TranslationRequest lookups."""
+    help = 'Benchmarks TranslationRequest lookups before and after indexing.'
+
+    option_list = BaseCommand.option_list + (
+      make_option('--rows', type='int', default=1000000,
+        help='Number of translation requests to seed.'),
+      make_option('--owners', type='int', default=1000,
+        help='Number of distinct request owners.'),
+      make_option('--repeat', type='int', default=20,
+        help='Number of runs per lookup path.'),
+    )
+
+    def handle(self, *args, **options):
+        """Seeds the scratch database and reports lookup latencies."""
+        handle, filename = mkstemp(suffix='.db')
+        os.close(handle)
+        try:
+            connection = sqlite3.connect(filename)
+            cursor = connection.cursor()
+            for sql in TABLE_SQL:
+                cursor.execute(sql)
+
+            self.stdout.write('Seeding {0} requests...\n'.format(
+              options['rows']))
+            samples = seed(cursor, options['rows'], options['owners'], 10)
+            connection.commit()
+            before = measure(cursor, samples, options['repeat'])
+
+            self.stdout.write('Creating indexes...\n')
+            create_indexes(cursor)
+            connection.commit()
+            after = measure(cursor, samples, options['repeat'])
+            connection.close()
+
+        finally:
+            os.remove(filename)
+
+        self.stdout.write('{0:<20} {1:>12} {2:>12}\n'.format('lookup',
+          'before (ms)', 'after (ms)'))
+        for name, _, _ in LOOKUPS:
+            self.stdout.write('{0:<20} {1:>12.3f} {2:>12.3f}\n'.format(name,
+              before[name], after[name]))
@@ -0,0 +1,52 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Checks the health of all worker servers and refreshes their load,
+throughput and the language pair index used to route requests.
+
+Run this from cron or, with --interval, as a background daemon:
+
+    python manage.py check_workers --interval=30
+"""
+import logging
+
+from serverland.dashboard.management.periodic import PeriodicCommand
+from serverland.dashboard.models import WorkerServer
+from serverland.settings import LOG_LEVEL, LOG_HANDLER
+
+# Setup logging support.
+logging.basicConfig(level=LOG_LEVEL)
+LOGGER = logging.getLogger('dashboard.check_workers')
+LOGGER.addHandler(LOG_HANDLER)
+
+
+def check_workers():
+    """
+    Runs a health check for all worker servers.
+
+    Returns the number of live worker servers.
+    """
+    alive = 0
+    for worker in WorkerServer.objects.all():
+        worker.health_check()
+        if worker.alive:
+            alive += 1
+
+        else:
+            LOGGER.warning('Worker "{0}" is not alive.'.format(
+              worker.shortname))
+
+    return alive
+
+
+class Command(PeriodicCommand):
+    """Management command checking the health of all worker servers."""
+    help = 'Refreshes worker health, load and language pair index.'
+
+    logger = LOGGER
+
+    def run_once(self):
+        """Checks all worker servers once."""
+        alive = check_workers()
+        LOGGER.info('{0} worker server(s) alive.'.format(alive))
@@ -0,0 +1,77 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Dispatches queued translation requests to the worker servers.
+
+Run this from cron or, with --interval, as a background daemon:
+
+    python manage.py dispatch_requests --interval=5
+"""
+import logging
+
+from serverland.dashboard.management.periodic import PeriodicCommand
+from serverland.dashboard.models import TranslationRequest, QUEUED
+from serverland.settings import LOG_LEVEL, LOG_HANDLER
+
+# Setup logging support.
+logging.basicConfig(level=LOG_LEVEL)
+LOGGER = logging.getLogger('dashboard.dispatch_requests')
+LOGGER.addHandler(LOG_HANDLER)
+
+
+def dispatch_requests():
+    """
+    Sends queued translation requests, oldest first, to their worker servers
+    as long as the respective worker server has free capacity.
+
+    Requests which cannot be started are marked as failed or invalid, see
+    TranslationRequest.start_translation(); only a worker server which
+    cannot be reached stops dispatching to it.
+
+    Returns the number of dispatched requests.
+    """
+    queued = TranslationRequest.objects.filter(state=QUEUED)
+    by_worker = {}
+    for request in queued.select_related('worker').order_by('created'):
+        by_worker.setdefault(request.worker_id, []).append(request)
+
+    dispatched = 0
+    for requests in by_worker.values():
+        worker = requests[0].worker
+        capacity = worker.capacity()
+
+        for request in requests[:capacity]:
+            request.worker = worker
+            success = request.start_translation()
+
+            # Only an unreachable worker server stops dispatching to it,
+            # requests it rejects are failed and the next one is sent.
+            if success is None:
+                LOGGER.warning('Worker "{0}" is not reachable, skipping ' \
+                  'request "{1}".'.format(worker.shortname,
+                  request.request_id))
+                break
+
+            elif not success:
+                LOGGER.warning('Could not start request "{0}" on worker ' \
+                  '"{1}".'.format(request.request_id, worker.shortname))
+                continue
+
+            dispatched += 1
+
+    return dispatched
+
+
+class Command(PeriodicCommand):
+    """Management command dispatching queued translation requests."""
+    help = 'Sends queued translation requests to the worker servers.'
+
+    logger = LOGGER
+
+    def run_once(self):
+        """Dispatches queued requests once."""
+        dispatched = dispatch_requests()
+        if dispatched:
+            LOGGER.info('Dispatched {0} translation request(s).'.format(
+              dispatched))
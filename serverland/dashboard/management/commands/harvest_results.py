@@ -0,0 +1,119 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Harvests finished translation results from the worker servers.
+
+Run this from cron or, with --interval, as a background daemon:
+
+    python manage.py harvest_results --interval=5
+"""
+import logging
+
+from serverland.dashboard.management.periodic import PeriodicCommand
+from serverland.dashboard.models import TranslationRequest, RUNNING, \
+  INVALID
+from serverland.settings import LOG_LEVEL, LOG_HANDLER, WORKER_BATCH_SIZE
+
+# Setup logging support.
+logging.basicConfig(level=LOG_LEVEL)
+LOGGER = logging.getLogger('dashboard.harvest_results')
+LOGGER.addHandler(LOG_HANDLER)
+
+
+def harvest_results():
+    """
+    Polls all running translation requests, grouped by worker server, and
+    fetches finished results to the broker.  Requests unknown to their
+    worker server are marked as invalid.
+
+    Each worker server is asked for the status of all its requests at once,
+    finished results are fetched and deleted in batches of WORKER_BATCH_SIZE.
+
+    Returns the number of harvested requests.
+    """
+    running = TranslationRequest.objects.filter(state=RUNNING)
+    by_worker = {}
+    for request in running.select_related('worker').order_by('created'):
+        by_worker.setdefault(request.worker_id, []).append(request)
+
+    harvested = 0
+    for requests in by_worker.values():
+        worker = requests[0].worker
+
+        # Workers that are down are skipped instead of timing out once for
+        # each of their requests.
+        statuses = worker.job_statuses([r.request_id for r in requests])
+        if statuses is None:
+            LOGGER.warning('Worker "{0}" is not alive, skipping {1} ' \
+              'request(s).'.format(worker.shortname, len(requests)))
+            continue
+
+        finished, lost = [], []
+        for request in requests:
+            request.worker = worker
+            status = statuses.get(request.request_id, 'unknown')
+            if status == 'unknown':
+                LOGGER.warning('Worker "{0}" lost request "{1}".'.format(
+                  worker.shortname, request.request_id))
+                lost.append(request)
+
+            elif status == 'finished':
+                finished.append(request)
+
+        TranslationRequest.bulk_transition(lost, INVALID)
+
+        for start in range(0, len(finished), WORKER_BATCH_SIZE):
+            harvested += harvest_batch(worker,
+              finished[start:start + WORKER_BATCH_SIZE])
+
+    return harvested
+
+
+def harvest_batch(worker, requests):
+    """
+    Fetches the results of the given finished requests from worker with one
+    bulk call and deletes them on the worker once they have been stored.
+
+    Returns the number of harvested requests.
+    """
+    results = worker.fetch_translations([r.request_id for r in requests])
+
+    stored, by_state = [], {}
+    for request in requests:
+        serialized = results[request.request_id]
+        if serialized in ("ERROR", "NOT_READY"):
+            LOGGER.warning('Could not fetch request "{0}" from worker ' \
+              '"{1}".'.format(request.request_id, worker.shortname))
+            continue
+
+        state = request.store_result(serialized)
+        by_state.setdefault(state, []).append(request)
+        stored.append(request.request_id)
+
+    for state, group in by_state.items():
+        TranslationRequest.bulk_transition(group, state)
+
+    # Results are only deleted on the worker after the broker has written
+    # them to disk, so a crash in between cannot lose a translation.
+    if stored:
+        deleted = worker.delete_translations(stored)
+        for request_id in [x for x in stored if not deleted[x]]:
+            LOGGER.warning('Could not delete request "{0}" on worker ' \
+              '"{1}".'.format(request_id, worker.shortname))
+
+    return len(stored)
+
+
+class Command(PeriodicCommand):
+    """Management command harvesting finished translation results."""
+    help = 'Fetches finished translation results from the worker servers.'
+
+    logger = LOGGER
+
+    def run_once(self):
+        """Harvests finished results once."""
+        harvested = harvest_results()
+        if harvested:
+            LOGGER.info('Harvested {0} translation result(s).'.format(
+              harvested))
@@ -0,0 +1,57 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Base class for management commands which run once, e.g. from cron, or with
+--interval as a background daemon.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import reset_queries
+from optparse import make_option
+from time import sleep
+
+
+class PeriodicCommand(BaseCommand):
+    """
+    Management command calling run_once() once or, if an interval is given,
+    every INTERVAL seconds until it is killed.
+
+    Errors in a single run are logged instead of ending the daemon, so a
+    worker server or database hiccup only costs one iteration.
+    """
+    logger = logging.getLogger('dashboard')
+
+    option_list = BaseCommand.option_list + (
+      make_option('--interval', type='float', default=0,
+        help='Run every INTERVAL seconds instead of running only once.'),
+    )
+
+    def run_once(self):
+        """Does the actual work of a single run."""
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        """Runs once or, if an interval is given, forever."""
+        interval = options['interval']
+        while True:
+            try:
+                self.run_once()
+
+            except Exception:
+                if not interval:
+                    raise
+
+                self.logger.exception('Run of {0} failed.'.format(
+                  self.__class__.__module__.split('.')[-1]))
+
+            finally:
+                # With DEBUG = True, Django records every query and a daemon
+                # would slowly run out of memory.
+                reset_queries()
+
+            if not interval:
+                break
+
+            sleep(interval)
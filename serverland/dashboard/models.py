@@ -5,6 +5,7 @@ Project: MT Server Land
  Author: Christian Federmann <cfedermann@gmail.com>
 """
 import datetime
+import httplib
 import logging
 import socket
 import uuid
@@ -12,13 +13,19 @@ import xmlrpclib
 
 from base64 import b64decode, b64encode
 from django.db import models
+from django.db.models import Count
+from django.db.backends.signals import connection_created
 from django.db.models.signals import pre_delete
 from django.contrib.auth.models import User
 # pylint: disable-msg=F0401
 from google.protobuf.message import DecodeError
-from os import remove
+from os import remove, rename
+from serverland.dashboard.cache import StatusCache
+from serverland.dashboard.transport import TransportPool
 from serverland.settings import LOG_LEVEL, LOG_HANDLER, \
-  TRANSLATION_MESSAGE_PATH
+  TRANSLATION_MESSAGE_PATH, WORKER_POOL_SIZE, WORKER_STATUS_TIMEOUT, \
+  WORKER_TRANSFER_TIMEOUT, WORKER_CACHE_TTL, WORKER_CACHE_STALE, \
+  WORKER_THROUGHPUT_WINDOW
 from serverland.protobuf.TranslationRequestMessage_pb2 import \
   TranslationRequestMessage
 
@@ -27,6 +34,14 @@ logging.basicConfig(level=LOG_LEVEL)
 LOGGER = logging.getLogger('serverland.views')
 LOGGER.addHandler(LOG_HANDLER)
 
+# Persistent XML-RPC transports to the worker servers, shared process-wide.
+TRANSPORTS = TransportPool(WORKER_POOL_SIZE)
+
+# Cached worker status and capabilities, see WorkerServer.cached().  Empty
+# results, e.g. from unreachable workers, are kept only for a short time.
+STATUS_CACHE = StatusCache(stale=WORKER_CACHE_STALE,
+  empty_ttl=min(WORKER_CACHE_TTL.values()))
+
 
 class WorkerServer(models.Model):
     """A Worker Server implements translation functionality via XML-RPC."""
@@ -41,20 +56,83 @@ class WorkerServer(models.Model):
       help_text="Users allowed to use this worker server."
     )
 
+    # Health check results, see the check_workers management command.  The
+    # throughput is the number of requests finished within the last
+    # WORKER_THROUGHPUT_WINDOW seconds.
+    alive = models.BooleanField(default=False, editable=False)
+    slots = models.PositiveIntegerField(default=0, editable=False)
+    load = models.PositiveIntegerField(default=0, editable=False)
+    throughput = models.PositiveIntegerField(default=0, editable=False)
+    checked = models.DateTimeField(null=True, blank=True, editable=False)
+
     def __unicode__(self):
         """Returns a Unicode String representation of the worker server."""
         return self.shortname
 
+    def address(self):
+        """Returns the XML-RPC address "hostname:port" of this worker."""
+        return "{0}:{1}".format(self.hostname, self.port)
+
+    def call(self, timeout, method, *args):
+        """
+        Calls the given XML-RPC method using a pooled persistent transport.
+        """
+        return TRANSPORTS.call(self.address(), timeout, method, *args)
+
+    def multicall(self, timeout, method, requests):
+        """
+        Calls the given XML-RPC method once per request id in a single
+        system.multicall round trip.
+
+        Returns a dictionary mapping request ids to results; failed calls map
+        to None.
+        """
+        request_ids = list(requests)
+        results = self.call(timeout, 'system.multicall', [{'methodName':
+          method, 'params': [request_id]} for request_id in request_ids])
+
+        # Successful calls return a singleton list, failed ones a fault dict.
+        return dict([(request_id, result[0] if isinstance(result, list)
+          else None) for request_id, result in zip(request_ids, results)])
+
+    def transport_stats(self):
+        """Returns transport pool hit, miss and failure counters."""
+        return TRANSPORTS.stats(self.address())
+
+    def cached(self, method):
+        """
+        Returns the cached result of the given status method, which has to be
+        one of the keys in WORKER_CACHE_TTL, e.g. "language_pairs".
+        """
+        return STATUS_CACHE.get((self.address(), method),
+          getattr(self, method), WORKER_CACHE_TTL[method])
+
+    def invalidate(self, method):
+        """
+        Drops the cached result of the given status method, so that the next
+        call of cached() asks the worker server again.
+        """
+        STATUS_CACHE.invalidate((self.address(), method))
+
+    @staticmethod
+    def prefetch(workers, method):
+        """
+        Refreshes the cached result of the given status method for all given
+        workers concurrently.
+        """
+        STATUS_CACHE.prefetch([((worker.address(), method),
+          getattr(worker, method), WORKER_CACHE_TTL[method])
+          for worker in workers])
+
     def language_pairs(self):
         """
         Returns a tuple of all supported language pairs for this worker.
         """
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return (tuple(x) for x in proxy.language_pairs())
+            return tuple([tuple(x) for x in self.call(WORKER_STATUS_TIMEOUT,
+              'language_pairs')])
 
-        except (xmlrpclib.Error, socket.error):
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return ()
 
         return ()
@@ -62,11 +140,9 @@ class WorkerServer(models.Model):
     def is_alive(self):
         """Checks if the current worker server instance is alive."""
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return proxy.is_alive()
+            return self.call(WORKER_STATUS_TIMEOUT, 'is_alive')
 
-        except (xmlrpclib.Error, socket.error):
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return False
 
         return False
@@ -74,11 +150,9 @@ class WorkerServer(models.Model):
     def is_busy(self):
         """Checks if the current worker server instance is busy."""
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return proxy.is_busy()
+            return self.call(WORKER_STATUS_TIMEOUT, 'is_busy')
 
-        except (xmlrpclib.Error, socket.error):
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return False
 
         return False
@@ -86,38 +160,219 @@ class WorkerServer(models.Model):
     def is_ready(self, request_id):
         """Checks if the specified request is finished."""
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return proxy.is_ready(request_id)
+            return self.call(WORKER_STATUS_TIMEOUT, 'is_ready', request_id)
 
-        except (xmlrpclib.Error, socket.error):
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return False
 
         return False
 
+    def list_requests(self):
+        """
+        Returns the set of request ids known to the worker server or None if
+        the worker server cannot be reached.
+        """
+        try:
+            return set(self.call(WORKER_STATUS_TIMEOUT, 'list_requests'))
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            return None
+
+        return None
+
+    def job_statuses(self, request_ids):
+        """
+        Returns a dictionary mapping the given request ids to their status on
+        the worker server, i.e. "queued", "running", "finished" or "unknown",
+        or None if the worker server cannot be reached.
+        """
+        request_ids = list(request_ids)
+        try:
+            try:
+                return self.call(WORKER_STATUS_TIMEOUT, 'job_statuses',
+                  request_ids)
+
+            # Worker servers without the bulk method still support multicall.
+            except xmlrpclib.Fault:
+                statuses = self.multicall(WORKER_STATUS_TIMEOUT, 'job_status',
+                  request_ids)
+                return dict([(request_id, status or 'unknown')
+                  for request_id, status in statuses.items()])
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            return None
+
+        return None
+
+    def job_progress(self, request_ids):
+        """
+        Returns a dictionary mapping the given request ids to dictionaries
+        describing their progress on the worker server, i.e. status, number
+        of completed and total segments, elapsed and estimated remaining
+        seconds, or None if the worker server cannot be reached.
+
+        For worker servers which do not report progress, the dictionaries
+        only contain the status.
+        """
+        request_ids = list(request_ids)
+        try:
+            try:
+                progress = self.multicall(WORKER_STATUS_TIMEOUT,
+                  'job_progress', request_ids)
+
+            except xmlrpclib.Fault:
+                progress = dict.fromkeys(request_ids)
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            return None
+
+        missing = [x for x in request_ids if progress.get(x) is None]
+        if missing:
+            statuses = self.job_statuses(missing)
+            if statuses is None:
+                return None
+
+            progress.update([(request_id, {'status': status})
+              for request_id, status in statuses.items()])
+
+        return progress
+
     def is_valid(self, request_id):
         """Checks if the specified request is valid."""
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return proxy.is_valid(request_id)
-
-        except (xmlrpclib.Error, socket.error) as inst:
-            print type(inst)
-            print inst.args
-            print inst
+            return self.call(WORKER_STATUS_TIMEOUT, 'is_valid', request_id)
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException), msg:
+            LOGGER.warning('Could not check request "{0}" on worker ' \
+              '"{1}": {2}'.format(request_id, self.shortname, msg))
             return False
 
         return False
 
+    def queue_status(self):
+        """
+        Returns a dictionary describing job slot usage of the worker server
+        or None if the worker server cannot be reached.
+        """
+        try:
+            return self.call(WORKER_STATUS_TIMEOUT, 'queue_status')
+
+        # Older worker servers do not implement queue_status().
+        except xmlrpclib.Fault:
+            return {'slots': 1, 'running': int(self.is_busy()), 'queued': 0}
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            return None
+
+        return None
+
+    def capacity(self):
+        """
+        Returns the number of requests the worker server can start without
+        queueing them, 0 if the worker server cannot be reached.
+        """
+        status = self.queue_status()
+        if not status:
+            return 0
+
+        return max(0, status['slots'] - status['running'] - status['queued'])
+
+    def supports(self, source, target):
+        """
+        Checks if the worker server supports the given language pair, using
+        the language pair index once the worker has been health checked.
+        """
+        if self.checked:
+            return self.pairs.filter(source_language=source,
+              target_language=target).exists()
+
+        return (source, target) in self.cached('language_pairs')
+
+    def health_check(self):
+        """
+        Refreshes health, load, throughput and the language pair index of the
+        worker server.
+        """
+        status = None
+        if self.is_alive():
+            status = self.queue_status()
+
+        self.alive = bool(status)
+        if status:
+            self.slots = status['slots']
+            self.load = status['running'] + status['queued']
+
+            # An empty result is most likely a transient error, so we keep
+            # the previous language pairs in that case.
+            pairs = set(self.language_pairs())
+            if pairs:
+                self.update_pairs(pairs)
+
+        now = datetime.datetime.now()
+        window = now - datetime.timedelta(seconds=WORKER_THROUGHPUT_WINDOW)
+        self.throughput = self.requests.filter(finished__gte=window).count()
+        self.checked = now
+        self.save()
+
+    def update_pairs(self, pairs):
+        """
+        Updates the language pair index to the given set of pairs.
+        """
+        known = set(self.pairs.values_list('source_language',
+          'target_language'))
+
+        for source, target in known - pairs:
+            self.pairs.filter(source_language=source,
+              target_language=target).delete()
+
+        WorkerLanguagePair.objects.bulk_create([WorkerLanguagePair(
+          worker=self, source_language=source, target_language=target)
+          for source, target in pairs - known])
+
+    @staticmethod
+    def route(source, target, workers=None):
+        """
+        Returns the least loaded live worker supporting the given language
+        pair or None if there is no such worker.
+
+        Workers are ranked by their backlog per job slot, consisting of the
+        jobs reported by the last health check and the requests still queued
+        on the broker; ties are broken by recent throughput.
+        """
+        if workers is None:
+            workers = WorkerServer.objects.all()
+
+        candidates = list(workers.filter(alive=True,
+          pairs__source_language=source, pairs__target_language=target))
+        if not candidates:
+            return None
+
+        queued = dict(TranslationRequest.objects.filter(
+          worker__in=candidates, state=QUEUED).values_list(
+          'worker').annotate(Count('id')))
+
+        def rank(worker):
+            """Returns the sort key for the given worker."""
+            backlog = worker.load + queued.get(worker.id, 0)
+            return (backlog / float(max(1, worker.slots)), -worker.throughput)
+
+        return min(candidates, key=rank)
+
     def start_translation(self, serialized):
-        """Sends the translation request to the worker server."""
+        """
+        Sends the translation request to the worker server.
+
+        Returns True if the worker server has accepted the request, False if
+        it has rejected it and None if it could not be reached.
+        """
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return proxy.start_translation(b64encode(serialized))
+            return self.call(WORKER_TRANSFER_TIMEOUT, 'start_translation',
+              b64encode(serialized))
 
-        except (xmlrpclib.Error, socket.error):
+        except xmlrpclib.Fault:
+            return False
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return None
 
         return None
@@ -125,49 +380,174 @@ class WorkerServer(models.Model):
     def fetch_translation(self, request_id):
         """Fetches a translation result for the given request_id."""
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return b64decode(proxy.fetch_translation(request_id))
+            return b64decode(self.call(WORKER_TRANSFER_TIMEOUT,
+              'fetch_translation', request_id))
 
-        except (xmlrpclib.Error, socket.error):
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return "ERROR"
 
         return "ERROR"
 
+    def fetch_partial_translation(self, request_id):
+        """
+        Fetches the target text translated so far for the given request_id.
+
+        Returns None if the text could not be fetched.
+        """
+        try:
+            encoded = self.call(WORKER_TRANSFER_TIMEOUT,
+              'fetch_partial_translation', request_id)
+            if encoded is False:
+                return None
+
+            return unicode(b64decode(encoded), 'utf-8')
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException,
+          TypeError, UnicodeDecodeError):
+            return None
+
+        return None
+
+    def fetch_translations(self, request_ids):
+        """
+        Fetches the translation results for the given request ids.
+
+        Returns a dictionary mapping request ids to serialized messages or
+        to "ERROR" if a result could not be fetched.
+        """
+        request_ids = list(request_ids)
+        try:
+            try:
+                results = self.call(WORKER_TRANSFER_TIMEOUT,
+                  'fetch_translations', request_ids)
+
+            except xmlrpclib.Fault:
+                results = self.multicall(WORKER_TRANSFER_TIMEOUT,
+                  'fetch_translation', request_ids)
+
+            return dict([(request_id, b64decode(results.get(request_id) or
+              b64encode("ERROR"))) for request_id in request_ids])
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            return dict.fromkeys(request_ids, "ERROR")
+
+        return dict.fromkeys(request_ids, "ERROR")
+
+    def delete_translations(self, request_ids):
+        """
+        Deletes the translation requests with the given request ids.
+
+        Returns a dictionary mapping request ids to True if the request has
+        been deleted successfully.
+        """
+        request_ids = list(request_ids)
+        try:
+            try:
+                results = self.call(WORKER_TRANSFER_TIMEOUT,
+                  'delete_translations', request_ids)
+
+            except xmlrpclib.Fault:
+                results = self.multicall(WORKER_TRANSFER_TIMEOUT,
+                  'delete_translation', request_ids)
+
+            return dict([(request_id, bool(results.get(request_id)))
+              for request_id in request_ids])
+
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            return dict.fromkeys(request_ids, False)
+
+        return dict.fromkeys(request_ids, False)
+
     def delete_translation(self, request_id):
         """Deletes a translation request with the given request_id."""
         try:
-            proxy = xmlrpclib.ServerProxy("{0}:{1}".format(self.hostname,
-              self.port))
-            return proxy.delete_translation(request_id)
+            return self.call(WORKER_TRANSFER_TIMEOUT, 'delete_translation',
+              request_id)
 
-        except (xmlrpclib.Error, socket.error):
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
             return False
 
         return False
 
 
+class WorkerLanguagePair(models.Model):
+    """
+    Index of the language pairs supported by the worker servers, refreshed
+    by WorkerServer.health_check().
+    """
+    worker = models.ForeignKey(WorkerServer, related_name='pairs')
+    source_language = models.CharField(max_length=3)
+    target_language = models.CharField(max_length=3)
+
+    class Meta:
+        """Meta class adding a unique index for language pair lookups."""
+        unique_together = (('source_language', 'target_language', 'worker'),)
+
+    def __unicode__(self):
+        """Returns a Unicode String representation of the language pair."""
+        return u"{0}-{1} ({2})".format(self.source_language,
+          self.target_language, self.worker.shortname)
+
+
+# States of a TranslationRequest.  Requests are queued on the broker, run on
+# a worker server and end up finished, failed, invalid (i.e. lost by their
+# worker server) or deleted.
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+INVALID = 'invalid'
+DELETED = 'deleted'
+
+# State transitions are written in batches of at most this many requests,
+# which keeps UPDATE queries below SQLite's limit of query parameters.
+UPDATE_BATCH_SIZE = 500
+
+STATES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (FINISHED, 'Finished'),
+  (FAILED, 'Failed'), (INVALID, 'Invalid'), (DELETED, 'Deleted'))
+
+# Columns written by state transitions, see TranslationRequest.refresh_state().
+STATE_FIELDS = ('state', 'state_changed', 'started', 'finished', 'dispatched',
+  'ready', 'deleted')
+
+
 def create_request_id():
-    """Creates a random UUID-4 32-digit hex number for use as request id."""
-    new_id = uuid.uuid4().hex
-    while (TranslationRequest.objects.filter(request_id=new_id)):
-        new_id = uuid.uuid4().hex
+    """
+    Creates a random UUID-4 32-digit hex number for use as request id.
 
-    return new_id
+    Collisions are practically impossible and would be rejected by the
+    unique index on request_id, so we do not query the database here.
+    """
+    return uuid.uuid4().hex
 
 
 class TranslationRequest(models.Model):
     """A Translation Request encodes the parameters of a translation job."""
     shortname = models.CharField(max_length=50)
-    request_id = models.CharField(max_length=32, default=create_request_id)
+    request_id = models.CharField(max_length=32, default=create_request_id,
+      unique=True)
     worker = models.ForeignKey(WorkerServer, related_name='requests')
     owner = models.ForeignKey(User, related_name='requests')
     created = models.DateTimeField(default=datetime.datetime.now)
 
+    # Composite indexes for the dashboard, shortname lookups, dispatcher and
+    # harvester are created by sql/translationrequest.sql.
+
     # We use a TranslationRequestMessage instance to store all request data.
     # The serialized, binary message will be stored as $request_id.message.
 
-    # Cache attributes that save the request's "state" inside the Django DB.
+    # The request's state is persisted in the Django DB and updated by the
+    # component that learns about a transition, see transition().
+    state = models.CharField(max_length=10, choices=STATES, default=QUEUED,
+      editable=False)
+    state_changed = models.DateTimeField(null=True, blank=True,
+      editable=False)
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    finished = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Boolean flags derived from the state, kept in sync by transition() for
+    # existing databases and clients.
+    dispatched = models.BooleanField(default=False)
     ready = models.BooleanField(default=False)
     deleted = models.BooleanField(default=False)
 
@@ -176,34 +556,130 @@ class TranslationRequest(models.Model):
         return u"{0} (request_id={1}, worker={2})".format(self.shortname,
           self.request_id, self.worker.id)
 
+    def transition(self, state):
+        """
+        Moves the request into the given state and records the time of the
+        transition, see bulk_transition().
+
+        Whichever component learns about a new state calls this: views and
+        the API queue and delete requests, the dispatcher starts them and the
+        harvester and dashboard notice finished, failed or invalid ones.
+
+        Returns True if the request has been moved.
+        """
+        return TranslationRequest.bulk_transition([self], state) == 1
+
+    @staticmethod
+    def bulk_transition(requests, state):
+        """
+        Moves the given requests into the given state with one UPDATE query
+        per previous state and batch of UPDATE_BATCH_SIZE requests.
+
+        Only the state columns are written and only for rows still in their
+        previous state, so that nothing is written for requests which are
+        already in the given state and concurrent transitions of the same
+        request do not overwrite each other.
+
+        Requests starting or leaving RUNNING change how busy their worker
+        servers are, so the cached is_busy status of these is dropped.
+
+        Returns the number of updated requests.
+        """
+        now = datetime.datetime.now()
+        changes = {'state': state, 'state_changed': now}
+        if state == RUNNING:
+            changes.update(dispatched=True, started=now)
+
+        elif state == FINISHED:
+            changes.update(ready=True, finished=now)
+
+        elif state == DELETED:
+            changes.update(deleted=True)
+
+        by_state = {}
+        for request in requests:
+            if request.state != state:
+                by_state.setdefault(request.state, []).append(request)
+
+        updated, busy = 0, set()
+        for previous, group in by_state.items():
+            for start in range(0, len(group), UPDATE_BATCH_SIZE):
+                batch = group[start:start + UPDATE_BATCH_SIZE]
+                count = TranslationRequest.objects.filter(state=previous,
+                  pk__in=[r.pk for r in batch]).update(**changes)
+                updated += count
+
+                if count == len(batch):
+                    for request in batch:
+                        for name, value in changes.items():
+                            setattr(request, name, value)
+
+                # Some of the rows have been moved by someone else meanwhile,
+                # so we re-read the state of all of them instead of assuming
+                # that our changes have been applied.
+                else:
+                    TranslationRequest.refresh_state(batch)
+
+            if RUNNING in (previous, state):
+                busy.update([r.worker_id for r in group if r.worker_id])
+
+        if busy:
+            for worker in WorkerServer.objects.filter(pk__in=busy):
+                worker.invalidate('is_busy')
+
+        return updated
+
+    @staticmethod
+    def refresh_state(requests):
+        """
+        Reloads the state columns of the given requests from the database.
+        """
+        rows = TranslationRequest.objects.filter(
+          pk__in=[r.pk for r in requests]).values('pk', *STATE_FIELDS)
+        by_pk = dict((row['pk'], row) for row in rows)
+
+        for request in requests:
+            row = by_pk.get(request.pk)
+            if row is not None:
+                for name in STATE_FIELDS:
+                    setattr(request, name, row[name])
+
     def is_ready(self):
-        """Checks if the current translation request is finished."""
-        if not self.ready:
-            self.ready = self.worker.is_ready(self.request_id)
-            self.save()
-
-            # If the translation request has been finished by now, we fetch
-            # the corresponding TranslationRequestMessage from the worker
-            # server and copy it to the broker's TRANSLATION_MESSAGE_PATH.
-            if self.ready:
-                LOGGER.info('Fetching translation result for request' \
-                  ' "{0}"'.format(self.request_id))
-                serialized = self.worker.fetch_translation(self.request_id)
-                handle = open('{0}/{1}.message'.format(
-                  TRANSLATION_MESSAGE_PATH, self.request_id), 'w+b')
-                handle.write(serialized)
-                handle.close()
-
-                # Now that we have successfully retrieved the translation from
-                # the worker server, we can delete it from the worker's queue.
-                success = self.worker.delete_translation(self.request_id)
-
-                if not success:
-                    LOGGER.warning('Could not delete request "{0}" on ' \
-                      ' worker "{1}".'.format(self.request_id,
-                      self.worker.shortname))
-
-        return self.ready
+        """
+        Checks if the current translation request is finished.
+
+        This only reads the broker's database, results are harvested from
+        the worker servers in the background, see the harvest_results command.
+        """
+        return self.state == FINISHED
+
+    def store_result(self, serialized):
+        """
+        Writes the serialized TranslationRequestMessage fetched from the
+        worker server to TRANSLATION_MESSAGE_PATH.
+
+        Returns the new state of the request, i.e. FINISHED or FAILED if the
+        worker server did not produce a translation.
+        """
+        # We write to a temporary file first so that readers never see a
+        # partially written message file.
+        filename = '{0}/{1}.message'.format(TRANSLATION_MESSAGE_PATH,
+          self.request_id)
+        handle = open('{0}.part'.format(filename), 'w+b')
+        handle.write(serialized)
+        handle.close()
+        rename('{0}.part'.format(filename), filename)
+
+        try:
+            message = TranslationRequestMessage()
+            # pylint: disable-msg=E1101
+            message.ParseFromString(serialized)
+            succeeded = message.HasField('target_text')
+
+        except DecodeError:
+            succeeded = False
+
+        return FINISHED if succeeded else FAILED
 
     def is_corrupted(self):
         """Checks whether the translation request message file is OK."""
@@ -225,18 +701,48 @@ class TranslationRequest(models.Model):
 
         return False
 
-    def is_valid(self):
-        """Checks if the current translation request is valid."""
-        return self.worker.is_valid(self.request_id)
+    def is_queued(self):
+        """Checks if the request is still queued on the broker server."""
+        return self.state == QUEUED
 
     def start_translation(self):
-        """Sends the serialized translation request to the worker server."""
-        handle = open('{0}/{1}.message'.format(TRANSLATION_MESSAGE_PATH,
-          self.request_id), 'rb')
-        message = handle.read()
-        handle.close()
+        """
+        Sends the serialized translation request to the worker server and
+        marks it as dispatched if the worker server has accepted it.
+
+        Requests which can never be started, as their message file is gone
+        or the worker server has rejected them, are marked as invalid or
+        failed, respectively, and False is returned.  False is also returned
+        for requests which have left the queue meanwhile, their jobs are
+        deleted again.  Returns None if the worker server could not be
+        reached, the request stays queued then.
+        """
+        try:
+            handle = open('{0}/{1}.message'.format(TRANSLATION_MESSAGE_PATH,
+              self.request_id), 'rb')
+            message = handle.read()
+            handle.close()
 
-        return self.worker.start_translation(message)
+        except IOError, msg:
+            LOGGER.warning('Could not read request "{0}": {1}'.format(
+              self.request_id, msg))
+            self.transition(INVALID)
+            return False
+
+        success = self.worker.start_translation(message)
+        if success:
+            # The request may have been deleted while we were sending it, we
+            # do not leave its job running on the worker server then.
+            if not self.transition(RUNNING):
+                LOGGER.info('Request "{0}" has been {1} meanwhile.'.format(
+                  self.request_id, self.state))
+                self.worker.delete_translation(self.request_id)
+                return False
+
+        elif success is not None:
+            self.transition(FAILED)
+
+        return success
 
     def fetch_translation(self):
         """Fetches the TranslationRequestMessage object if ready."""
@@ -258,21 +764,61 @@ class TranslationRequest(models.Model):
 
         return message
 
-    def delete_translation(self):
-        """Deletes a translation request from the broker server queue."""
-        if not self.deleted:
-            self.deleted = True
-            self.save()
+    def progress(self):
+        """
+        Returns the progress of the request on its worker server, see
+        WorkerServer.job_progress(), or None if it is not running.
+        """
+        if self.state != RUNNING:
+            return None
 
-            # If the translation request is not yet ready, we have to ensure
-            # that it is properly deleted from the worker's job queue.
-            if not self.ready:
-                success = self.worker.delete_translation(self.request_id)
+        progress = self.worker.job_progress([self.request_id])
+        if progress is None:
+            return None
+
+        return progress.get(self.request_id)
 
-                if not success:
-                    LOGGER.warning('Could not delete request "{0}" on ' \
-                      ' worker "{1}".'.format(self.request_id,
-                      self.worker.shortname))
+    def fetch_partial_translation(self):
+        """
+        Fetches the target text translated so far, i.e. the prefix of the
+        translation while the request is running and the full translation
+        once it is finished.
+
+        Returns None if the text is not available.
+        """
+        if self.state == RUNNING:
+            return self.worker.fetch_partial_translation(self.request_id)
+
+        message = self.fetch_translation()
+        if type(message) == TranslationRequestMessage:
+            return message.target_text
+
+        return None
+
+    def delete_translation(self):
+        """Deletes a translation request from the broker server queue."""
+        # The state of this instance may be outdated, a failed transition
+        # reloads the state stored in the database and we try again.
+        deleted = None
+        while self.state != DELETED:
+            previous = self.state
+            if self.transition(DELETED):
+                deleted = previous
+                break
+
+            # The row is gone if its state could not be reloaded.
+            if self.state == previous:
+                break
+
+        # If the translation request is still running, we have to ensure
+        # that it is properly deleted from the worker's job queue.
+        if deleted == RUNNING:
+            success = self.worker.delete_translation(self.request_id)
+
+            if not success:
+                LOGGER.warning('Could not delete request "{0}" on ' \
+                  ' worker "{1}".'.format(self.request_id,
+                  self.worker.shortname))
 
         return self.deleted
 
@@ -286,3 +832,18 @@ def remove_message_file(sender, instance, **kwargs):
 
 # Connect pre_delete signal handler for TranslationRequest objects.
 pre_delete.connect(remove_message_file, sender=TranslationRequest)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Switches SQLite databases to write-ahead logging, so that dashboard and
+    API readers do not block the dispatcher and harvester writing state
+    transitions, and vice versa.
+    """
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+
+# Connect connection_created signal handler for new database connections.
+connection_created.connect(configure_sqlite)
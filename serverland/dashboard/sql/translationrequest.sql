@@ -0,0 +1,19 @@
+-- Composite indexes matching the access paths of TranslationRequest, which
+-- cannot be declared in the model.  syncdb runs this file when it creates the
+-- table, see README.textile on how to upgrade existing databases.
+
+-- Shortname lookups of the API and the form's check for active duplicates.
+CREATE INDEX dashboard_translationrequest_shortname_deleted
+  ON dashboard_translationrequest (shortname, deleted);
+
+-- Dashboard and API: requests of one owner in a given state, newest first.
+CREATE INDEX dashboard_translationrequest_owner_state_created
+  ON dashboard_translationrequest (owner_id, state, created);
+
+-- Dispatcher and harvester: oldest queued or running requests first.
+CREATE INDEX dashboard_translationrequest_state_created
+  ON dashboard_translationrequest (state, created);
+
+-- Health checks: requests recently finished by one worker.
+CREATE INDEX dashboard_translationrequest_worker_finished
+  ON dashboard_translationrequest (worker_id, finished);
@@ -1,4 +1,6 @@
 from django.test.testcases import TestCase
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
 
 class CheckErrorHandlers(TestCase):
     """
@@ -10,3 +12,756 @@ class CheckErrorHandlers(TestCase):
         response = c.get('/some/non-existing/view/')
         self.assertEqual(response.status_code, 404)
 
+
+
+class StopLoop(Exception):
+    """Raised by the patched sleep() to end a PeriodicCommand loop."""
+
+
+class PeriodicCommandTests(TestCase):
+    """
+    UnitTest checking that --interval daemons survive failed runs.
+    """
+    def setUp(self):
+        from serverland.dashboard.management import periodic
+        self.periodic = periodic
+        self.sleep = periodic.sleep
+        self.sleeps = []
+
+        def fake_sleep(interval):
+            self.sleeps.append(interval)
+            if len(self.sleeps) == 3:
+                raise StopLoop
+
+        periodic.sleep = fake_sleep
+
+    def tearDown(self):
+        self.periodic.sleep = self.sleep
+
+    def command(self, fail):
+        """Returns a PeriodicCommand which raises ValueError if fail."""
+        runs = []
+        errors = self.errors = []
+
+        class Logger(object):
+            def exception(self, message):
+                errors.append(message)
+
+        class Command(self.periodic.PeriodicCommand):
+            logger = Logger()
+
+            def run_once(self):
+                runs.append(len(runs))
+                if fail:
+                    raise ValueError('run failed')
+
+        return Command(), runs
+
+    def test_errors_do_not_end_the_loop(self):
+        command, runs = self.command(fail=True)
+        self.assertRaises(StopLoop, command.handle, interval=1.5)
+        self.assertEqual(runs, [0, 1, 2])
+        self.assertEqual(self.sleeps, [1.5, 1.5, 1.5])
+        self.assertEqual(len(self.errors), 3)
+
+    def test_single_run_raises_errors(self):
+        command, runs = self.command(fail=True)
+        self.assertRaises(ValueError, command.handle, interval=0)
+        self.assertEqual(runs, [0])
+
+        command, runs = self.command(fail=False)
+        command.handle(interval=0)
+        self.assertEqual((runs, self.sleeps), ([0], []))
+
+    def test_queries_are_reset(self):
+        from django.db import connection
+        command, runs = self.command(fail=False)
+        connection.queries.append({'sql': 'SELECT 1', 'time': '0.0'})
+        command.handle(interval=0)
+        self.assertEqual(connection.queries, [])
+
+
+class FakeWorkerServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    Threaded XML-RPC server keeping connections alive like worker servers.
+    """
+    daemon_threads = True
+
+    class RequestHandler(SimpleXMLRPCRequestHandler):
+        """Handles HTTP/1.1 requests, so connections can be reused."""
+        protocol_version = 'HTTP/1.1'
+
+    def __init__(self):
+        SimpleXMLRPCServer.__init__(self, ('localhost', 0),
+          requestHandler=self.RequestHandler, allow_none=True,
+          logRequests=False)
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        """Remembers the connection, so that stop() can close it."""
+        self.connections.append(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def stop(self):
+        """Stops serving and closes all kept-alive connections."""
+        import socket
+        self.shutdown()
+        self.server_close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+
+            except socket.error:
+                pass
+
+
+class FakeWorker(object):
+    """
+    Minimal XML-RPC worker server for broker side tests.
+
+    Its start_translation() accepts serialized messages unless they equal
+    "reject"; accepted messages are collected in self.started.  Jobs to be
+    harvested are kept in self.jobs, mapping request ids to (status,
+    serialized) tuples.  Request ids passed to delete_translation() are
+    collected in self.deleted.
+    """
+    def __init__(self):
+        from threading import Thread
+        self.started = []
+        self.deleted = []
+        self.jobs = {}
+        self.slots = 10
+        self.server = FakeWorkerServer()
+        self.server.register_multicall_functions()
+        self.server.register_instance(self)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def port(self):
+        """Returns the port the fake worker server is listening on."""
+        return str(self.server.server_address[1])
+
+    def stop(self):
+        """Shuts the fake worker server down."""
+        self.server.stop()
+
+    def queue_status(self):
+        """Reports free slots for all requests."""
+        return {'slots': self.slots, 'running': 0, 'queued': 0}
+
+    def start_translation(self, serialized):
+        """Accepts all messages but "reject"."""
+        from base64 import b64decode
+        message = b64decode(serialized)
+        if message == 'reject':
+            return False
+
+        self.started.append(message)
+        return True
+
+    def language_pairs(self):
+        """Supports English to French only."""
+        return [('eng', 'fra')]
+
+    def fetch_partial_translation(self, request_id):
+        """Returns the target prefix of running jobs."""
+        from base64 import b64encode
+        if request_id not in self.jobs:
+            return False
+
+        return b64encode(u'\xdcBER\n'.encode('utf-8'))
+
+    def job_statuses(self, request_ids):
+        """Reports the status of the given jobs."""
+        return dict([(request_id, self.jobs.get(request_id,
+          ('unknown', None))[0]) for request_id in request_ids])
+
+    def fetch_translations(self, request_ids):
+        """Returns the serialized results of the given jobs."""
+        from base64 import b64encode
+        return dict([(request_id, b64encode(self.jobs[request_id][1]))
+          for request_id in request_ids])
+
+    def delete_translation(self, request_id):
+        """Deletes the given job."""
+        self.deleted.append(request_id)
+        return True
+
+    def delete_translations(self, request_ids):
+        """Deletes the given jobs."""
+        return dict([(request_id, self.jobs.pop(request_id, None) is not None)
+          for request_id in request_ids])
+
+
+class BrokerTestCase(TestCase):
+    """
+    Base class for tests which need a worker server and message files.
+    """
+    def setUp(self):
+        import shutil
+        from tempfile import mkdtemp
+        from django.contrib.auth.models import User
+        from serverland.dashboard import models
+        self.models = models
+        self.message_path = models.TRANSLATION_MESSAGE_PATH
+        models.TRANSLATION_MESSAGE_PATH = mkdtemp()
+        self.addCleanup(shutil.rmtree, models.TRANSLATION_MESSAGE_PATH)
+
+        self.fake = FakeWorker()
+        self.worker = models.WorkerServer.objects.create(shortname='fake',
+          hostname='http://localhost', port=self.fake.port)
+        self.owner = User.objects.create_user('owner', 'owner@localhost',
+          'secret')
+
+    def tearDown(self):
+        self.fake.stop()
+        self.models.TRANSLATION_MESSAGE_PATH = self.message_path
+
+    def request(self, message=None, **kwargs):
+        """
+        Creates a translation request, with the given serialized message
+        unless it is None, and returns it.
+        """
+        import datetime
+        kwargs.setdefault('worker', self.worker)
+        request = self.models.TranslationRequest(shortname='request',
+          owner=self.owner, **kwargs)
+        # Distinct creation times keep dispatch and harvest order stable.
+        request.created = datetime.datetime(2011, 1, 1) + \
+          datetime.timedelta(seconds=self.models.TranslationRequest \
+          .objects.count())
+        request.save()
+
+        if message is not None:
+            handle = open('{0}/{1}.message'.format(
+              self.models.TRANSLATION_MESSAGE_PATH, request.request_id), 'wb')
+            handle.write(message)
+            handle.close()
+
+        return request
+
+    def state(self, request):
+        """Returns the current state of the given request in the database."""
+        return self.models.TranslationRequest.objects.get(
+          pk=request.pk).state
+
+
+class DispatchRequestsTests(BrokerTestCase):
+    """
+    UnitTest checking that dispatch_requests starts queued requests.
+    """
+    def dispatch(self):
+        """Runs the dispatcher once."""
+        from serverland.dashboard.management.commands.dispatch_requests \
+          import dispatch_requests
+        return dispatch_requests()
+
+    def test_unstartable_requests_do_not_block_the_queue(self):
+        from serverland.dashboard.models import FAILED, INVALID, RUNNING
+        missing = self.request()
+        rejected = self.request('reject')
+        accepted = self.request('accept')
+
+        self.assertEqual(self.dispatch(), 1)
+        self.assertEqual(self.state(missing), INVALID)
+        self.assertEqual(self.state(rejected), FAILED)
+        self.assertEqual(self.state(accepted), RUNNING)
+        self.assertEqual(self.fake.started, ['accept'])
+
+    def test_unreachable_workers_keep_requests_queued(self):
+        from serverland.dashboard.models import QUEUED
+        first, second = self.request('first'), self.request('second')
+        calls = []
+
+        def unreachable(worker, serialized):
+            calls.append(serialized)
+            return None
+
+        WorkerServer = self.models.WorkerServer
+        start_translation = WorkerServer.start_translation
+        WorkerServer.start_translation = unreachable
+        try:
+            self.assertEqual(self.dispatch(), 0)
+
+        finally:
+            WorkerServer.start_translation = start_translation
+
+        self.assertEqual(calls, ['first'])
+        self.assertEqual([self.state(first), self.state(second)],
+          [QUEUED, QUEUED])
+
+    def test_requests_deleted_while_starting_are_not_left_running(self):
+        from serverland.dashboard.models import DELETED
+        request = self.request('accept')
+        stale = self.models.TranslationRequest.objects.get(pk=request.pk)
+        request.delete_translation()
+
+        self.assertFalse(stale.start_translation())
+        self.assertEqual(self.state(request), DELETED)
+        self.assertEqual(self.fake.started, ['accept'])
+        self.assertEqual(self.fake.deleted, [request.request_id])
+
+    def test_capacity_limits_dispatching(self):
+        from serverland.dashboard.models import QUEUED, RUNNING
+        first, second = self.request('first'), self.request('second')
+        self.fake.slots = 1
+
+        self.assertEqual(self.dispatch(), 1)
+        self.assertEqual([self.state(first), self.state(second)],
+          [RUNNING, QUEUED])
+
+
+class StatusCacheTests(TestCase):
+    """
+    UnitTest checking single-flight loading and stale-while-revalidate of
+    the worker status cache.
+    """
+    def setUp(self):
+        from serverland.dashboard import cache
+        self.cache = cache
+        self.time = cache.time
+        self.now = 1000.0
+        cache.time = lambda: self.now
+
+    def tearDown(self):
+        self.cache.time = self.time
+
+    def test_concurrent_misses_load_once(self):
+        from threading import Event, Thread
+        status = self.cache.StatusCache()
+        started, release, calls, results = Event(), Event(), [], []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'alive'
+
+        threads = [Thread(target=lambda: results.append(status.get('key',
+          loader, 10))) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['alive'] * 5)
+
+    def test_stale_values_are_served_while_refreshing(self):
+        from threading import Event
+        from time import sleep
+        status = self.cache.StatusCache(stale=30)
+        status.get('key', lambda: 'old', 10)
+
+        release, refreshed = Event(), Event()
+
+        def loader():
+            release.wait(5)
+            refreshed.set()
+            return 'new'
+
+        self.now += 20
+        self.assertEqual(status.get('key', loader, 10), 'old')
+        self.assertEqual(status.get('key', loader, 10), 'old')
+        release.set()
+        refreshed.wait(5)
+        while 'key' in status.loading:
+            sleep(0.01)
+
+        self.assertEqual(status.get('key', lambda: 'unused', 10), 'new')
+
+    def test_expired_stale_values_are_reloaded(self):
+        status = self.cache.StatusCache(stale=30)
+        status.get('key', lambda: 'old', 10)
+        self.now += 50
+        self.assertEqual(status.get('key', lambda: 'new', 10), 'new')
+
+    def test_empty_values_expire_early(self):
+        status = self.cache.StatusCache(stale=0, empty_ttl=1)
+        status.get('key', lambda: (), 60)
+        self.now += 2
+        self.assertEqual(status.get('key', lambda: ('pair',), 60), ('pair',))
+        self.now += 2
+        self.assertEqual(status.get('key', lambda: (), 60), ('pair',))
+
+    def test_invalidate(self):
+        status = self.cache.StatusCache()
+        status.get('key', lambda: 'old', 60)
+        status.invalidate('key')
+        self.assertEqual(status.get('key', lambda: 'new', 60), 'new')
+
+
+class TransportPoolTests(TestCase):
+    """
+    UnitTest checking that worker server calls reuse pooled transports.
+    """
+    def setUp(self):
+        from serverland.dashboard.transport import TransportPool
+        self.fake = FakeWorker()
+        self.address = 'http://localhost:{0}'.format(self.fake.port)
+        self.pool = TransportPool(1)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_transports_are_reused(self):
+        for _ in range(3):
+            self.assertEqual(self.pool.call(self.address, 5, 'queue_status'),
+              self.fake.queue_status())
+
+        self.assertEqual(self.pool.stats(self.address),
+          {'hits': 2, 'misses': 1, 'failures': 0})
+
+    def test_failed_calls_are_counted(self):
+        import xmlrpclib
+        self.assertRaises(xmlrpclib.Fault, self.pool.call, self.address, 5,
+          'no_such_method')
+        self.assertEqual(self.pool.stats(self.address)['failures'], 1)
+
+        # The failing transport has been closed, so it is not a hit.
+        self.pool.call(self.address, 5, 'queue_status')
+        self.assertEqual(self.pool.stats(self.address)['misses'], 2)
+
+    def test_pool_size_is_limited(self):
+        first = self.pool.acquire(self.address)
+        second = self.pool.acquire(self.address)
+        self.pool.release(self.address, first)
+        self.pool.release(self.address, second)
+        self.assertEqual(self.pool.idle[self.address], [first])
+
+
+class WorkerServerTests(BrokerTestCase):
+    """
+    UnitTest checking request routing and bulk state transitions.
+    """
+    def add_worker(self, shortname, pairs=(('eng', 'ger'),), **kwargs):
+        """Creates a worker server supporting the given language pairs."""
+        worker = self.models.WorkerServer.objects.create(shortname=shortname,
+          hostname='http://localhost', port=self.fake.port, **kwargs)
+        worker.update_pairs(set(pairs))
+        return worker
+
+    def test_route_picks_least_loaded_live_worker(self):
+        route = self.models.WorkerServer.route
+        self.assertEqual(route('eng', 'ger'), None)
+
+        busy = self.add_worker('busy', alive=True, slots=4, load=2)
+        self.add_worker('dead', alive=False)
+        self.add_worker('french', alive=True, pairs=(('eng', 'fre'),))
+        self.assertEqual(route('eng', 'ger'), busy)
+
+        idle = self.add_worker('idle', alive=True, slots=1, load=0)
+        self.assertEqual(route('eng', 'ger'), idle)
+
+        # Requests still queued on the broker count towards the backlog.
+        self.request(worker=idle)
+        self.assertEqual(route('eng', 'ger'), busy)
+
+    def test_route_breaks_ties_by_throughput(self):
+        self.add_worker('slow', alive=True, throughput=1)
+        fast = self.add_worker('fast', alive=True, throughput=5)
+        self.assertEqual(self.models.WorkerServer.route('eng', 'ger'), fast)
+
+    def test_bulk_transition(self):
+        from serverland.dashboard.models import QUEUED, RUNNING, FINISHED
+        TranslationRequest = self.models.TranslationRequest
+        requests = [self.request() for _ in range(3)]
+
+        self.assertEqual(TranslationRequest.bulk_transition(requests[:2],
+          RUNNING), 2)
+        self.assertEqual([self.state(r) for r in requests],
+          [RUNNING, RUNNING, QUEUED])
+        self.assertTrue(requests[0].dispatched and requests[0].started)
+
+        # Requests already in the target state are not written again.
+        self.assertEqual(TranslationRequest.bulk_transition(requests,
+          RUNNING), 1)
+
+        # Stale instances do not overwrite concurrent transitions.
+        stale = TranslationRequest.objects.get(pk=requests[0].pk)
+        self.assertTrue(requests[0].transition(FINISHED))
+        self.assertFalse(stale.transition(QUEUED))
+        self.assertEqual(self.state(requests[0]), FINISHED)
+        self.assertTrue(TranslationRequest.objects.get(
+          pk=requests[0].pk).ready)
+
+        # The failed transition has reloaded the state from the database.
+        self.assertEqual(stale.state, FINISHED)
+        self.assertTrue(stale.ready)
+
+    def test_short_batches_only_update_moved_instances(self):
+        from serverland.dashboard.models import RUNNING, DELETED
+        TranslationRequest = self.models.TranslationRequest
+        requests = [self.request() for _ in range(2)]
+        TranslationRequest.objects.filter(pk=requests[1].pk).update(
+          state=RUNNING)
+
+        self.assertEqual(TranslationRequest.bulk_transition(requests,
+          DELETED), 1)
+        self.assertEqual([r.state for r in requests], [DELETED, RUNNING])
+        self.assertTrue(requests[0].deleted)
+        self.assertFalse(requests[1].deleted)
+        self.assertEqual(self.state(requests[1]), RUNNING)
+
+    def test_delete_stale_instance_of_running_request(self):
+        from serverland.dashboard.models import RUNNING, DELETED
+        request = self.request()
+        stale = self.models.TranslationRequest.objects.get(pk=request.pk)
+        self.assertTrue(request.transition(RUNNING))
+
+        self.assertTrue(stale.delete_translation())
+        self.assertEqual(self.state(request), DELETED)
+        self.assertEqual(self.fake.deleted, [request.request_id])
+
+    def test_transitions_invalidate_busy_status(self):
+        from serverland.dashboard.models import RUNNING, FINISHED
+        request = self.request()
+        self.fake.server.register_function(lambda: False, 'is_busy')
+        self.assertFalse(self.worker.cached('is_busy'))
+
+        self.fake.server.register_function(lambda: True, 'is_busy')
+        request.transition(RUNNING)
+        self.assertTrue(self.worker.cached('is_busy'))
+
+        self.fake.server.register_function(lambda: False, 'is_busy')
+        request.transition(FINISHED)
+        self.assertFalse(self.worker.cached('is_busy'))
+
+
+class HarvestResultsTests(BrokerTestCase):
+    """
+    UnitTest checking that harvest_results fetches finished requests.
+    """
+    def harvest(self):
+        """Runs the harvester once."""
+        from serverland.dashboard.management.commands.harvest_results \
+          import harvest_results
+        return harvest_results()
+
+    def result(self, request, target_text=None):
+        """Returns a serialized result message for the given request."""
+        from serverland.protobuf.TranslationRequestMessage_pb2 import \
+          TranslationRequestMessage
+        message = TranslationRequestMessage()
+        message.request_id = request.request_id
+        message.source_language = 'eng'
+        message.target_language = 'ger'
+        message.source_text = 'Hello'
+        if target_text is not None:
+            message.target_text = target_text
+
+        return message.SerializeToString()
+
+    def test_harvest(self):
+        from serverland.dashboard.models import RUNNING, FINISHED, FAILED, \
+          INVALID
+        finished, failed, running, lost = [self.request(state=RUNNING)
+          for _ in range(4)]
+        self.fake.jobs[finished.request_id] = ('finished',
+          self.result(finished, 'Hallo'))
+        self.fake.jobs[failed.request_id] = ('finished', self.result(failed))
+        self.fake.jobs[running.request_id] = ('running', None)
+
+        self.assertEqual(self.harvest(), 2)
+        self.assertEqual([self.state(r) for r in (finished, failed, running,
+          lost)], [FINISHED, FAILED, RUNNING, INVALID])
+
+        # Harvested results are stored on the broker, then deleted on the
+        # worker server.
+        self.assertEqual(self.fake.jobs.keys(), [running.request_id])
+        message = self.models.TranslationRequest.objects.get(
+          pk=finished.pk).fetch_translation()
+        self.assertEqual(message.target_text, 'Hallo')
+
+    def test_unreachable_workers_are_skipped(self):
+        from serverland.dashboard.models import RUNNING
+        request = self.request(state=RUNNING)
+        self.fake.stop()
+        self.fake = FakeWorker()
+
+        self.assertEqual(self.harvest(), 0)
+        self.assertEqual(self.state(request), RUNNING)
+
+
+class TranslationRequestFormTests(BrokerTestCase):
+    """
+    UnitTest checking the language pairs offered by the request form.
+    """
+    def test_unchecked_workers_are_offered(self):
+        import datetime
+        from serverland.dashboard.forms import TranslationRequestForm
+        checked = self.models.WorkerServer.objects.create(shortname='checked',
+          hostname='http://localhost', port='1', alive=True,
+          checked=datetime.datetime.now())
+        checked.update_pairs(set([('eng', 'deu')]))
+        self.owner.is_superuser = True
+
+        form = TranslationRequestForm(self.owner)
+        self.assertEqual([x[0] for x in
+          form.fields['target_language'].choices], ['deu', 'fra'])
+
+        # Requests for the unchecked worker's pair are routed to it.
+        form.cleaned_data = {'source_language': 'eng',
+          'target_language': 'fra', 'worker': None}
+        self.assertEqual(form.clean()['worker'], self.worker)
+
+
+class RequestStatusesTests(BrokerTestCase):
+    """
+    UnitTest checking that the dashboard polls worker servers with a shared
+    thread pool.
+    """
+    def test_threads_are_shared(self):
+        from threading import active_count
+        from serverland.dashboard.models import RUNNING
+        from serverland.dashboard.views import request_statuses
+        request = self.request(state=RUNNING)
+        self.fake.jobs[request.request_id] = ('running', None)
+
+        expected = {self.worker.id: {request.request_id: {'status':
+          'running'}}}
+        self.assertEqual(request_statuses([request], 5), expected)
+        threads = active_count()
+        self.assertEqual(request_statuses([request], 5), expected)
+        self.assertEqual(active_count(), threads)
+
+
+class PartialResultTests(BrokerTestCase):
+    """
+    UnitTest checking the download of partial results.
+    """
+    def test_partial(self):
+        from django.core.urlresolvers import reverse
+        from django.test.client import Client
+        from serverland.dashboard.models import RUNNING
+        running = self.request(state=RUNNING)
+        lost = self.request(state=RUNNING)
+        self.fake.jobs[running.request_id] = ('running', None)
+
+        self.assertEqual(running.fetch_partial_translation(), u'\xdcBER\n')
+        self.assertEqual(lost.fetch_partial_translation(), None)
+
+        client = Client()
+        client.login(username='owner', password='secret')
+        response = client.get(reverse('partial', kwargs={'request_id':
+          running.request_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, u'\xdcBER\n'.encode('utf-8'))
+
+        response = client.get(reverse('partial', kwargs={'request_id':
+          lost.request_id}))
+        self.assertEqual(response.status_code, 302)
+
+
+class PaginationTests(BrokerTestCase):
+    """
+    UnitTest checking page boundaries and state filters of the dashboard
+    and of the Web API request listing.
+    """
+    def setUp(self):
+        from serverland.dashboard import views
+        from serverland.dashboard.api import handlers
+        from serverland.dashboard.api.models import AuthToken
+        from serverland.dashboard.models import QUEUED, FINISHED, FAILED
+        super(PaginationTests, self).setUp()
+        self.addCleanup(setattr, views, 'DASHBOARD_PAGE_SIZE',
+          views.DASHBOARD_PAGE_SIZE)
+        self.addCleanup(setattr, handlers, 'API_PAGE_SIZE',
+          handlers.API_PAGE_SIZE)
+        views.DASHBOARD_PAGE_SIZE = handlers.API_PAGE_SIZE = 2
+
+        # Newest first: five finished, one failed and one queued request.
+        self.finished = [self.request(state=FINISHED) for _ in range(5)]
+        self.finished.reverse()
+        self.failed = self.request(state=FAILED)
+        self.queued = self.request(state=QUEUED)
+        self.token = AuthToken.objects.create(user=self.owner).auth_token
+
+    def dashboard(self, **query):
+        """Renders the dashboard with the given GET parameters."""
+        from django.core.urlresolvers import reverse
+        from django.test.client import Client
+        client = Client()
+        client.login(username='owner', password='secret')
+        response = client.get(reverse('dashboard'), query)
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def api(self, **query):
+        """Returns the response of the JSON request listing."""
+        import json
+        from django.core.urlresolvers import reverse
+        from django.test.client import Client
+        query['token'] = self.token
+        response = Client().get(reverse('dashboard') + 'api/json/requests/',
+          query)
+        if response.status_code == 200:
+            return json.loads(response.content)
+
+        return response.status_code
+
+    def ids(self, page):
+        """Returns the request ids of the given page."""
+        return [request.request_id for request in page.object_list]
+
+    def test_dashboard_page_boundaries(self):
+        ids = [request.request_id for request in self.finished]
+        context = self.dashboard(finished=1)
+        page = context['finished_requests']
+        self.assertEqual(self.ids(page), ids[:2])
+        self.assertEqual(page.previous_query, None)
+        self.assertEqual(page.next_query, 'finished=2')
+
+        page = self.dashboard(finished=3)['finished_requests']
+        self.assertEqual(self.ids(page), ids[4:])
+        self.assertEqual(page.previous_query, 'finished=2')
+        self.assertEqual(page.next_query, None)
+
+        # Sections page on their own and keep the other sections' pages.
+        context = self.dashboard(finished=2, invalid=1)
+        self.assertEqual(self.ids(context['finished_requests']), ids[2:4])
+        self.assertEqual(self.ids(context['invalid_requests']),
+          [self.failed.request_id])
+        self.assertEqual([r.request_id for r in context['active_requests']],
+          [self.queued.request_id])
+
+    def test_dashboard_invalid_page_numbers(self):
+        ids = [request.request_id for request in self.finished]
+        page = self.dashboard(finished='x')['finished_requests']
+        self.assertEqual(self.ids(page), ids[:2])
+
+        for number in (0, 4, 100):
+            page = self.dashboard(finished=number)['finished_requests']
+            self.assertEqual(self.ids(page), ids[4:])
+
+    def test_api_page_boundaries(self):
+        ids = [self.queued.request_id, self.failed.request_id] + \
+          [request.request_id for request in self.finished]
+        listed = [request['request_id'] for number in (1, 2, 3)
+          for request in self.api(page=number)]
+        self.assertEqual(listed, ids[:6])
+
+        # A last page with one request is returned as the request itself.
+        self.assertEqual(self.api(page=4)['request_id'], ids[6])
+
+    def test_api_invalid_page_numbers(self):
+        for number in ('x', 0, 5):
+            self.assertEqual(self.api(page=number), 400)
+
+    def test_api_state_filter(self):
+        from serverland.dashboard.models import FINISHED, FAILED
+        ids = [request.request_id for request in self.finished]
+        finished = self.api(state=FINISHED, page=2)
+        self.assertEqual([r['request_id'] for r in finished], ids[2:4])
+        self.assertEqual(set(r['state'] for r in finished), set([FINISHED]))
+
+        self.assertEqual(self.api(state=FAILED)['request_id'],
+          self.failed.request_id)
+        self.assertEqual(self.api(state='running'), [])
+        self.assertEqual(self.api(state=FINISHED, page=4), 400)
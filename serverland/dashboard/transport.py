@@ -0,0 +1,133 @@
+"""
+Project: MT Server Land
+ Author: Christian Federmann <cfedermann@gmail.com>
+
+Pooled, persistent XML-RPC transports for worker server calls.
+
+Each transport keeps its HTTP connection to the worker server open, so that
+consecutive calls do not have to set up a new TCP connection.  Transports
+are shared process-wide, keyed by worker address "hostname:port".
+"""
+import httplib
+import xmlrpclib
+
+from threading import Lock
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport with a persistent connection and a per-call timeout.
+    """
+    def __init__(self, timeout=None):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+    def is_connected(self):
+        """Checks if the transport holds an open connection."""
+        # pylint: disable-msg=W0212
+        return bool(self._connection[1] and self._connection[1].sock)
+
+    def make_connection(self, host):
+        """
+        Returns the persistent connection, applying the current timeout.
+        """
+        # pylint: disable-msg=W0212
+        if self._connection and host == self._connection[0]:
+            connection = self._connection[1]
+
+        else:
+            chost, self._extra_headers, _ = self.get_host_info(host)
+            connection = httplib.HTTPConnection(chost)
+            self._connection = host, connection
+
+        connection.timeout = self.timeout
+        if connection.sock:
+            connection.sock.settimeout(self.timeout)
+
+        return connection
+
+
+class TransportPool(object):
+    """
+    Process-wide pool of idle TimeoutTransport instances per worker address.
+    """
+    def __init__(self, size):
+        """
+        Creates a new TransportPool keeping up to size idle transports for
+        each worker address.
+        """
+        self.size = size
+        self.lock = Lock()
+        self.idle = {}
+        self.counters = {}
+
+    def _count(self, address, key):
+        """Increments the given counter for the given address."""
+        with self.lock:
+            counters = self.counters.setdefault(address,
+              {'hits': 0, 'misses': 0, 'failures': 0})
+            counters[key] += 1
+
+    def acquire(self, address):
+        """
+        Returns an idle transport for the given address or a new one.
+        """
+        with self.lock:
+            idle = self.idle.get(address, [])
+            transport = idle.pop() if idle else None
+
+        if transport and transport.is_connected():
+            self._count(address, 'hits')
+
+        else:
+            self._count(address, 'misses')
+            transport = transport or TimeoutTransport()
+
+        return transport
+
+    def release(self, address, transport):
+        """
+        Returns the given transport to the pool, closes it if the pool for
+        the given address is already full.
+        """
+        with self.lock:
+            idle = self.idle.setdefault(address, [])
+            if len(idle) < self.size:
+                idle.append(transport)
+                return
+
+        transport.close()
+
+    def call(self, address, timeout, method, *args):
+        """
+        Calls the given XML-RPC method of the worker at the given address.
+
+        Errors are counted as failures and re-raised; the connection of the
+        failing transport is closed.
+        """
+        transport = self.acquire(address)
+        transport.timeout = timeout
+        proxy = xmlrpclib.ServerProxy(address, transport=transport)
+        try:
+            return getattr(proxy, method)(*args)
+
+        except:
+            self._count(address, 'failures')
+            transport.close()
+            raise
+
+        finally:
+            self.release(address, transport)
+
+    def stats(self, address=None):
+        """
+        Returns the hit, miss and failure counters for the given address or,
+        if no address is given, a dictionary of counters for all addresses.
+        """
+        with self.lock:
+            if address:
+                return dict(self.counters.get(address,
+                  {'hits': 0, 'misses': 0, 'failures': 0}))
+
+            return dict([(key, dict(value))
+              for key, value in self.counters.items()])
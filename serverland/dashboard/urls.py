@@ -11,5 +11,7 @@ urlpatterns = patterns('serverland.dashboard.views',
   url(r'^result/(?P<request_id>[a-f0-9]{32})/$', 'result', name='result'),
   url(r'^download/(?P<request_id>[a-f0-9]{32})/$', 'download',
     name='download'),
+  url(r'^partial/(?P<request_id>[a-f0-9]{32})/$', 'partial',
+    name='partial'),
   url(r'^api/', include('serverland.dashboard.api.urls')),
 )
@@ -2,19 +2,27 @@
 Project: MT Server Land
  Author: Christian Federmann <cfedermann@gmail.com>
 """
+import datetime
 import logging
-import socket
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from time import time
 
 from django.http import HttpResponse, HttpResponseRedirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from serverland.dashboard.models import TranslationRequest, WorkerServer
+from serverland.dashboard.models import TranslationRequest, QUEUED, \
+  RUNNING, FINISHED, FAILED, INVALID
 from serverland.dashboard.forms import TranslationRequestForm
 from serverland.settings import LOG_LEVEL, LOG_HANDLER, DEPLOYMENT_PREFIX, \
-  TRANSLATION_MESSAGE_PATH, COMMIT_TAG
+  TRANSLATION_MESSAGE_PATH, COMMIT_TAG, DASHBOARD_STATUS_DEADLINE, \
+  DASHBOARD_STATUS_THREADS, DASHBOARD_PAGE_SIZE
 from serverland.protobuf.TranslationRequestMessage_pb2 import \
   TranslationRequestMessage
 
@@ -23,6 +31,101 @@ logging.basicConfig(level=LOG_LEVEL)
 LOGGER = logging.getLogger('dashboard.views')
 LOGGER.addHandler(LOG_HANDLER)
 
+# Thread pool for request_statuses(), created on first use so that it is not
+# lost when the web server forks its processes after importing the views.
+STATUS_POOL = None
+STATUS_POOL_LOCK = Lock()
+
+def status_pool():
+    """Returns the thread pool shared by all calls of request_statuses()."""
+    global STATUS_POOL
+    with STATUS_POOL_LOCK:
+        if STATUS_POOL is None:
+            STATUS_POOL = ThreadPool(DASHBOARD_STATUS_THREADS)
+
+    return STATUS_POOL
+
+def request_statuses(requests, deadline):
+    """
+    Asks the workers of the given requests concurrently for the status and
+    progress of their requests, using one multicall per worker.
+
+    Returns a dictionary mapping worker ids to dictionaries of request ids
+    and progress dictionaries, see WorkerServer.job_progress(); workers
+    which fail or do not answer within deadline seconds map to None.
+    """
+    by_worker = {}
+    for req in requests:
+        by_worker.setdefault(req.worker_id, []).append(req)
+
+    if not by_worker:
+        return {}
+
+    pool = status_pool()
+    results = [(worker_id, pool.apply_async(reqs[0].worker.job_progress,
+      ([r.request_id for r in reqs],))) for worker_id, reqs
+      in by_worker.items()]
+
+    known = {}
+    expires = time() + deadline
+    for worker_id, result in results:
+        try:
+            known[worker_id] = result.get(max(0, expires - time()))
+
+        except TimeoutError:
+            known[worker_id] = None
+
+    return known
+
+def paginate(request, queryset, parameter):
+    """
+    Returns the page of queryset selected by the given GET parameter.
+
+    The page carries previous_query and next_query strings which keep the
+    other GET parameters, so that each dashboard section pages on its own.
+    """
+    paginator = Paginator(queryset, DASHBOARD_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get(parameter, 1))
+
+    except PageNotAnInteger:
+        page = paginator.page(1)
+
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+
+    query = request.GET.copy()
+    page.previous_query = page.next_query = None
+    if page.has_previous():
+        query[parameter] = page.previous_page_number()
+        page.previous_query = query.urlencode()
+
+    if page.has_next():
+        query[parameter] = page.next_page_number()
+        page.next_query = query.urlencode()
+
+    return page
+
+def progress_display(progress):
+    """
+    Adds the percentage of completed segments and the estimated time of
+    completion to the given progress dictionary, returns None for workers
+    which do not report progress.
+    """
+    if progress.get('total') is None:
+        return None
+
+    progress['percent'] = 0
+    if progress['total']:
+        progress['percent'] = 100 * progress['completed'] / progress['total']
+
+    progress['finishes'] = None
+    if progress['eta'] is not None:
+        progress['finishes'] = datetime.datetime.now() + \
+          datetime.timedelta(seconds=progress['eta'])
+
+    return progress
+
 @login_required
 def dashboard(request):
     """
@@ -33,20 +136,51 @@ def dashboard(request):
     LOGGER.info('Rendering dashboard for user "{0}".'.format(
       request.user.username))
 
-    # Change timeout for sockets to avoid waiting for slow worker servers.
-    socket.setdefaulttimeout(0.2)
-
     ordered = TranslationRequest.objects.all().order_by('-created')
-    filtered = ordered.filter(owner=request.user)
-    requests = [r for r in filtered if not r.deleted]
-    finished = [r for r in requests if r.is_ready()]
-    invalid = [r for r in requests if not r.is_valid() and not r in finished]
-    active = [r for r in requests if not r in finished and not r in invalid]
+    requests = ordered.filter(owner=request.user).select_related('worker')
+
+    # Request states are persisted by the dispatcher and the harvester, see
+    # the respective management commands, so each section is one page of an
+    # indexed query.
+    pending = paginate(request, requests.filter(state__in=(QUEUED,
+      RUNNING)), 'active')
+
+    # Running requests on the current page are checked with one
+    # job_progress() multicall per worker, all workers are queried in
+    # parallel.
+    running = [r for r in pending.object_list if r.state == RUNNING]
+    known = request_statuses(running, DASHBOARD_STATUS_DEADLINE)
+
+    active, unknown, lost = [], [], []
+    for req in pending.object_list:
+        req.progress = None
+        if req.state == QUEUED:
+            active.append(req)
+
+        elif known[req.worker_id] is None:
+            unknown.append(req)
+
+        elif known[req.worker_id].get(req.request_id, {}).get('status',
+          'unknown') != 'unknown':
+            req.progress = progress_display(known[req.worker_id][
+              req.request_id])
+            active.append(req)
+
+        else:
+            lost.append(req)
+
+    TranslationRequest.bulk_transition(lost, INVALID)
+
+    finished_page = paginate(request, requests.filter(state=FINISHED),
+      'finished')
+    invalid_page = paginate(request, requests.filter(state__in=(FAILED,
+      INVALID)), 'invalid')
 
     dictionary = {'title': 'MT Server Land -- Dashboard',
       'commit_tag': COMMIT_TAG,
-      'active_page': 'dashboard', 'finished_requests': finished,
-      'active_requests': active, 'invalid_requests': invalid}
+      'active_page': 'dashboard', 'finished_requests': finished_page,
+      'active_requests': active, 'active_requests_page': pending,
+      'invalid_requests': invalid_page, 'unknown_requests': unknown}
     return render_to_response('dashboard/dashboard.html', dictionary,
       context_instance=RequestContext(request))
 
@@ -76,8 +210,7 @@ def create(request):
             new = TranslationRequest()
             new.shortname = request.POST['shortname']
             new.owner = request.user
-            new.worker = WorkerServer.objects.get(
-              pk=int(request.POST['worker']))
+            new.worker = form.cleaned_data['worker']
 
             message = TranslationRequestMessage()
             message.request_id = new.request_id
@@ -93,17 +226,12 @@ def create(request):
             handle.write(message.SerializeToString())
             handle.close()
 
+            # The request is queued on the broker server, the dispatcher
+            # sends it to the worker server once the worker has capacity.
             new.save()
 
-            # cfedermann: We have to decide whether the translation process
-            #   should directly be sent to the worker server or whether it
-            #   makes more sense to "queue" it on the broker server and have
-            #   a cronjob start the process when the worker is not busy...
-            #   This does have impact on system performance/robustness!
-            new.start_translation()
-
             messages.add_message(request, messages.SUCCESS, 'Successfully ' \
-              'started translation request "{0}".'.format(new.shortname))
+              'queued translation request "{0}".'.format(new.shortname))
             return HttpResponseRedirect(reverse('dashboard'))
 
     else:
@@ -157,10 +285,8 @@ def result(request, request_id):
 
         return HttpResponseRedirect(reverse('dashboard'))
 
-    # cfedermann: Make sure that the request is marked as finished once the
-    #   result has been transferred to the local hard disk!!!  We are trying
-    #   to access the result from the worker server for each request now :(
-    #   This will break if the worker server has forgotten about the request.
+    # Results are transferred to the local hard disk by the harvester, so
+    # this only reads the broker's copy of the message.
     LOGGER.info('Fetching request "{0}" for user "{1}".'.format(
       request_id, request.user.username or "Anonymous"))
     translation_message = req.fetch_translation()
@@ -178,6 +304,35 @@ def result(request, request_id):
     return render_to_response('dashboard/result.html', dictionary,
       context_instance=RequestContext(request))
 
+@login_required
+def partial(request, request_id):
+    """
+    Downloads the target text translated so far for a running translation
+    request.
+    """
+    req = get_object_or_404(TranslationRequest, request_id=request_id)
+
+    if req.owner != request.user:
+        LOGGER.warning('Illegal partial request from user "{0}".'.format(
+          request.user.username or "Anonymous"))
+
+        return HttpResponseRedirect(reverse('dashboard'))
+
+    LOGGER.info('Downloading partial request "{0}" for user "{1}".'.format(
+      request_id, request.user.username or "Anonymous"))
+
+    translation = req.fetch_partial_translation()
+    if translation is None:
+        messages.add_message(request, messages.ERROR, 'Could not fetch ' \
+          'partial result for request "{0}".'.format(req.shortname))
+        return HttpResponseRedirect(reverse('dashboard'))
+
+    response = HttpResponse(translation.encode('utf-8'),
+      mimetype='text/plain; charset=UTF-8')
+    response['Content-Disposition'] = 'attachment; filename="{0}.partial' \
+      '.txt"'.format(req.shortname)
+    return response
+
 @login_required
 def download(request, request_id):
     """
@@ -24,6 +24,39 @@ TRANSLATION_MESSAGE_PATH = '{0}/messages'.format(ROOT_PATH)
 assert os.path.exists(TRANSLATION_MESSAGE_PATH), \
   "Folder {0} does not exist!".format(TRANSLATION_MESSAGE_PATH)
 
+# Worker server XML-RPC calls use pooled persistent connections.  Status
+# calls time out quickly to avoid waiting for slow worker servers, calls
+# transferring translation messages may take longer.
+WORKER_POOL_SIZE = 4
+WORKER_STATUS_TIMEOUT = 0.2
+WORKER_TRANSFER_TIMEOUT = 30
+
+# Maximum number of translation results fetched from a worker server in one
+# bulk XML-RPC call.
+WORKER_BATCH_SIZE = 50
+
+# Worker status and language pairs are cached for the given number of seconds.
+# Expired values are still used for up to WORKER_CACHE_STALE seconds while
+# they are refreshed in the background.
+WORKER_CACHE_TTL = {'is_alive': 5, 'is_busy': 5, 'language_pairs': 300}
+WORKER_CACHE_STALE = 3600
+
+# Requests finished within this number of seconds count towards a worker's
+# recent throughput, which is used to route requests.
+WORKER_THROUGHPUT_WINDOW = 600
+
+# The dashboard waits at most this number of seconds for worker servers to
+# report the status of active requests; later answers are shown as unknown.
+DASHBOARD_STATUS_DEADLINE = 0.5
+
+# Number of threads, shared by all page loads, which ask the worker servers
+# for the status of active requests.
+DASHBOARD_STATUS_THREADS = 8
+
+# Number of requests per page in each dashboard section and API listing.
+DASHBOARD_PAGE_SIZE = 25
+API_PAGE_SIZE = 100
+
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -56,6 +89,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': '{}/development.db'.format(ROOT_PATH),
+        # Seconds to wait for a lock held by another writer before failing
+        # with "database is locked"; connections use WAL mode, see
+        # dashboard.models.configure_sqlite().
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -0,0 +1,145 @@
+"""
+Pooled keep-alive HTTP connections for worker servers using web services.
+"""
+import errno
+import httplib
+import socket
+import urllib2
+
+from Queue import LifoQueue
+from threading import Lock
+
+# Errors showing that the server has closed an idle connection before it
+# received a request on it.
+STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+
+def is_stale(error):
+    """
+    Checks if the given error shows that a reused connection had been closed
+    by the server before the request was sent.
+
+    Other errors, timeouts in particular, may occur after the server has
+    processed the request, so the request must not be sent again.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+
+    if isinstance(error, httplib.BadStatusLine):
+        # No status line at all means the server closed the connection
+        # without answering; older httplib versions report this as ''.
+        line = error.line.strip("'")
+        return not line or line.startswith('No status line received')
+
+    return isinstance(error, socket.error) and error.errno in STALE_ERRNOS
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to size persistent HTTP connections to a single host.
+
+    Connections are shared by all threads of a worker server; requests block
+    while all connections are in use.
+    """
+    def __init__(self, scheme, netloc, size, timeout=None):
+        """
+        Creates a new ConnectionPool for the given URL scheme and host.
+        """
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+
+        self.lock = Lock()
+        self.counters = {'size': size, 'requests': 0, 'created': 0,
+          'reused': 0, 'failed': 0}
+
+    def _count(self, key):
+        """Increments the given counter."""
+        with self.lock:
+            self.counters[key] += 1
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends a HTTP request using a pooled connection, returns the content.
+
+        Raises urllib2.HTTPError for error responses, which leaves the
+        connection usable; other errors close the connection.
+        """
+        connection = self.idle.get()
+        try:
+            # A reused connection may have been closed by the server while
+            # idle, in this case we try again once using a new connection.
+            if connection and connection.sock:
+                self._count('reused')
+                try:
+                    response = self._send(connection, method, url, body,
+                      headers)
+
+                except (httplib.HTTPException, socket.error), msg:
+                    if not is_stale(msg):
+                        raise
+
+                    connection.close()
+                    connection = None
+
+            else:
+                connection = None
+
+            if connection is None:
+                self._count('created')
+                connection = self.connection_class(self.netloc,
+                  timeout=self.timeout)
+                response = self._send(connection, method, url, body, headers)
+
+            content = response.read()
+            if response.will_close:
+                connection.close()
+
+        except (httplib.HTTPException, socket.error):
+            self._count('failed')
+            if connection:
+                connection.close()
+            raise
+
+        finally:
+            self.idle.put(connection)
+
+        if response.status >= 400:
+            self._count('failed')
+            raise urllib2.HTTPError(url, response.status, response.reason,
+              response.msg, None)
+
+        return content
+
+    def _send(self, connection, method, url, body, headers):
+        """Sends a single request and returns the response object."""
+        self._count('requests')
+        connection.request(method, url, body, headers or {})
+        return connection.getresponse()
+
+    def stats(self):
+        """
+        Returns a dictionary of request and connection counters.
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        connections = []
+        while not self.idle.empty():
+            connections.append(self.idle.get())
+
+        for connection in connections:
+            if connection:
+                connection.close()
+            self.idle.put(None)
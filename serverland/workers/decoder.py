@@ -0,0 +1,524 @@
+"""
+Long-running Moses decoder processes shared by Moses-based worker servers.
+
+Loading Moses phrase tables and language models can take minutes, so worker
+servers keep decoders alive and stream sentences through their stdin/stdout.
+"""
+import logging
+
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from Queue import Queue
+from subprocess import Popen, PIPE
+from threading import Condition, Thread
+from time import sleep, time
+
+LOGGER = logging.getLogger('MosesDecoder')
+
+# Put into the queue of translations read from a decoder when the request
+# has been cancelled, see MosesDecoder.translate().
+CANCELLED = object()
+
+
+class Cancelled(IOError):
+    """Raised when a translation is cancelled while it is being decoded."""
+    pass
+
+
+def split_lines(text):
+    """
+    Splits the given text into a list of lines as read by Moses.
+
+    A trailing line break does not create an additional, empty line.
+    """
+    lines = text.split(u'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+
+    return lines
+
+
+def split_shards(lines, count):
+    """
+    Splits the given list of lines into count contiguous shards of nearly
+    equal size.  Joining the shards in order restores the original list.
+    """
+    count = max(1, min(count, len(lines)))
+    size, rest = divmod(len(lines), count)
+
+    shards = []
+    start = 0
+    for index in range(count):
+        end = start + size + (index < rest)
+        shards.append(lines[start:end])
+        start = end
+
+    return shards
+
+
+@contextmanager
+def not_cancellable(stop):
+    """Default for the on_cancel argument of DecoderPool.translate()."""
+    yield
+
+
+class MosesDecoder(object):
+    """
+    A persistent Moses process translating one sentence per input line.
+
+    Moses flushes one output line per input line, so translations can be
+    read back while further input is still being written.
+    """
+    # Seconds to wait for Moses to exit after SIGTERM before it is killed.
+    STOP_TIMEOUT = 5
+
+    def __init__(self, command, config):
+        """
+        Creates and starts a new MosesDecoder running "command -f config".
+        """
+        self.command = command
+        self.config = config
+        self.process = None
+        self.drain = None
+        self.writer = None
+        self.reader = None
+        self.stderr = deque(maxlen=100)
+        self.start()
+
+    def __repr__(self):
+        """Returns a String representation of the decoder."""
+        return '<MosesDecoder {0} (pid={1})>'.format(self.config,
+          self.process.pid)
+
+    def start(self):
+        """
+        Starts the Moses process; stderr is drained into a bounded buffer.
+        """
+        self.process = Popen([self.command, '-f', self.config], stdin=PIPE,
+          stdout=PIPE, stderr=PIPE, close_fds=True)
+        self.stderr.clear()
+
+        self.drain = Thread(target=self._drain_stderr, args=(self.process,))
+        self.drain.daemon = True
+        self.drain.start()
+        LOGGER.info('Started {0}.'.format(self))
+
+    def _drain_stderr(self, process):
+        """Reads stderr of the given process until it terminates."""
+        for line in iter(process.stderr.readline, ''):
+            self.stderr.append(line)
+
+    def is_alive(self):
+        """Checks if the Moses process is still running."""
+        return self.process.poll() is None
+
+    def memory(self):
+        """
+        Returns the resident set size of the Moses process in bytes.
+
+        Returns 0 if the process is not running or /proc is not available.
+        """
+        try:
+            with open('/proc/{0}/status'.format(self.process.pid)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+
+        except (IOError, ValueError):
+            pass
+
+        return 0
+
+    def stop(self):
+        """
+        Terminates the Moses process and waits until its stderr is drained.
+
+        Processes which do not exit within STOP_TIMEOUT seconds are killed.
+        """
+        if self.is_alive():
+            self.process.terminate()
+
+            deadline = time() + self.STOP_TIMEOUT
+            while self.is_alive() and time() < deadline:
+                sleep(0.05)
+
+            if self.is_alive():
+                LOGGER.warning('Killing {0}.'.format(self))
+                self.process.kill()
+
+        self.process.wait()
+        self.drain.join(1)
+
+    def error_log(self):
+        """Returns the last lines Moses has written to stderr."""
+        return ''.join(self.stderr)
+
+    def restart(self):
+        """Terminates the Moses process, if necessary, and starts a new one."""
+        LOGGER.warning('Restarting {0}.'.format(self))
+        self.stop()
+        self.start()
+
+    def _write_lines(self, process, lines):
+        """Writes the given lines to the stdin of the Moses process."""
+        try:
+            for line in lines:
+                process.stdin.write(line.encode('utf-8') + '\n')
+            process.stdin.flush()
+
+        except IOError:
+            LOGGER.error('Could not write to {0}.'.format(self))
+
+    def _read_lines(self, process, count, results):
+        """
+        Reads count translations from the stdout of the Moses process into
+        the results queue, followed by the error if reading fails.
+        """
+        try:
+            for _ in range(count):
+                line = process.stdout.readline()
+                if not line:
+                    raise IOError('{0} terminated unexpectedly.'.format(self))
+
+                results.put(unicode(line.rstrip('\n'), 'utf-8'))
+
+        except (IOError, ValueError), msg:
+            results.put(msg)
+
+    def translate(self, lines, callback=None, on_cancel=None):
+        """
+        Translates the given list of lines, returns the list of translations.
+
+        If given, callback(number, translation) is called as soon as each
+        line has been translated.  Raises IOError if the Moses process
+        terminates before all lines have been translated.
+
+        If given, on_cancel(stop) has to return a context manager calling
+        stop() when the translation is cancelled, see on_cancel() of the
+        worker server.  Cancelled is raised right away then, the remaining
+        translations are read and discarded in the background, see wait().
+        """
+        # Input is written and output is read by separate threads to avoid
+        # dead locks when the pipe buffers fill up, and so that cancelled
+        # translations do not have to wait for the decoder.
+        results = Queue()
+        self.writer = Thread(target=self._write_lines, args=(self.process,
+          lines))
+        self.reader = Thread(target=self._read_lines, args=(self.process,
+          len(lines), results))
+        for thread in (self.writer, self.reader):
+            thread.daemon = True
+            thread.start()
+
+        result = []
+        with (on_cancel or not_cancellable)(lambda: results.put(CANCELLED)):
+            for number in range(len(lines)):
+                line = results.get()
+                if line is CANCELLED:
+                    raise Cancelled('Translation on {0} has been ' \
+                      'cancelled.'.format(self))
+
+                if isinstance(line, Exception):
+                    raise line
+
+                result.append(line)
+                if callback:
+                    callback(number, line)
+
+        self.wait()
+        return result
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds until all lines of the last translation
+        have been written and read.  Returns True if the decoder is idle.
+        """
+        deadline = None if timeout is None else time() + timeout
+        for thread in (self.writer, self.reader):
+            if thread is not None:
+                thread.join(None if deadline is None \
+                  else max(0, deadline - time()))
+
+        return self.reader is None or not self.reader.is_alive()
+
+
+class DecoderPool(object):
+    """
+    A fixed-size pool of MosesDecoder instances sharing the same config.
+    """
+    # Seconds a decoder may take to finish the lines of a cancelled
+    # translation before it is restarted instead.
+    DRAIN_TIMEOUT = 30
+
+    def __init__(self, command, config, size):
+        """
+        Creates a new DecoderPool and starts size MosesDecoder instances.
+        """
+        self.decoders = [MosesDecoder(command, config) for _ in range(size)]
+        self.idle = list(self.decoders)
+        self.stopped = False
+        self.condition = Condition()
+
+    def __len__(self):
+        """Returns the number of decoders in the pool."""
+        return len(self.decoders)
+
+    @contextmanager
+    def decoder(self):
+        """
+        Context manager checking out an idle decoder from the pool.
+
+        Blocks until a decoder becomes available; dead decoders are
+        restarted before they are handed out.  Decoders still busy with a
+        cancelled translation are returned to the pool once they are idle.
+        """
+        with self.condition:
+            while not self.idle:
+                self.condition.wait()
+            decoder = self.idle.pop()
+
+        try:
+            if not decoder.is_alive():
+                decoder.restart()
+
+            yield decoder
+
+        finally:
+            if decoder.wait(0):
+                self._release(decoder)
+
+            else:
+                drain = Thread(target=self._drain, args=(decoder,))
+                drain.daemon = True
+                drain.start()
+
+    def _release(self, decoder):
+        """Returns the given decoder to the idle decoders."""
+        with self.condition:
+            self.idle.append(decoder)
+            self.condition.notify()
+
+    def _drain(self, decoder):
+        """
+        Waits until the given decoder has finished a cancelled translation
+        and returns it to the pool.  Decoders taking longer than
+        DRAIN_TIMEOUT seconds are restarted, unless the pool is stopped.
+        """
+        if not decoder.wait(self.DRAIN_TIMEOUT):
+            with self.condition:
+                if not self.stopped:
+                    decoder.restart()
+
+        self._release(decoder)
+
+    def translate(self, lines, callback=None, on_cancel=None):
+        """
+        Translates the given list of lines using an idle decoder, see
+        MosesDecoder.translate().
+
+        If the decoder crashes, it is restarted and translation is retried
+        once before the error is passed on to the caller.  Cancelled
+        translations are not retried, their decoder keeps running and is
+        handed out again once it has caught up with the discarded lines.
+        """
+        with self.decoder() as decoder:
+            return self._translate(decoder, lines, callback, on_cancel)
+
+    def decode(self, lines, callback=None, on_cancel=None):
+        """
+        Translates the given list of lines like translate(), but returns a
+        (target_lines, stderr) tuple; target_lines is None if the decoder
+        crashed twice, stderr holds the last lines of its error output.
+        """
+        with self.decoder() as decoder:
+            try:
+                target_lines = self._translate(decoder, lines, callback,
+                  on_cancel)
+
+            except Cancelled:
+                raise
+
+            except IOError, msg:
+                LOGGER.error(msg)
+                target_lines = None
+
+            return (target_lines, decoder.error_log())
+
+    @staticmethod
+    def _translate(decoder, lines, callback, on_cancel):
+        """
+        Translates the given list of lines using the given decoder, which is
+        restarted and used once more if it crashes.
+        """
+        try:
+            return decoder.translate(lines, callback, on_cancel)
+
+        except Cancelled:
+            raise
+
+        except IOError, msg:
+            LOGGER.error(msg)
+            decoder.restart()
+            return decoder.translate(lines, callback, on_cancel)
+
+    def check(self):
+        """
+        Health-checks all idle decoders and restarts any crashed ones.
+        """
+        with self.condition:
+            for decoder in self.idle:
+                if not decoder.is_alive():
+                    decoder.restart()
+
+    def memory(self):
+        """Returns the resident set size of all decoders in bytes."""
+        return sum([decoder.memory() for decoder in self.decoders])
+
+    def stop(self):
+        """Terminates all decoders in the pool."""
+        with self.condition:
+            self.stopped = True
+
+        for decoder in self.decoders:
+            decoder.stop()
+
+
+class ModelRegistry(object):
+    """
+    Maps language pairs to Moses configurations and keeps decoders for the
+    most recently used ones loaded, within a given memory budget.
+
+    Decoder pools are started lazily when a language pair is requested for
+    the first time.  If starting another pool would exceed the memory budget,
+    the least recently used pools which are not in use are stopped first.
+    """
+    def __init__(self, command, configs, memory_budget, size=1):
+        """
+        Creates a new ModelRegistry instance.
+
+        configs maps (source, target) tuples to Moses config files, the
+        memory_budget is given in bytes (None means unlimited) and size is
+        the number of decoders started per language pair.
+        """
+        self.command = command
+        self.configs = configs
+        self.memory_budget = memory_budget
+        self.size = size
+        self.pools = OrderedDict()
+        self.leases = {}
+        self.footprints = {}
+        self.condition = Condition()
+
+    def language_pairs(self):
+        """Returns a tuple of all language pairs known to the registry."""
+        return tuple(self.configs.keys())
+
+    def loaded(self):
+        """Returns a list of currently loaded language pairs, LRU first."""
+        with self.condition:
+            return self.pools.keys()
+
+    def memory(self):
+        """Returns the resident set size of all loaded decoders in bytes."""
+        with self.condition:
+            return sum([pool.memory() for pool in self.pools.values()])
+
+    def _footprint(self, pair):
+        """
+        Estimates the memory needed to load the given language pair, based
+        on earlier measurements or, if unknown, the average loaded model.
+        """
+        if pair in self.footprints:
+            return self.footprints[pair]
+
+        if self.footprints:
+            return sum(self.footprints.values()) / len(self.footprints)
+
+        return 0
+
+    def _evict(self, needed):
+        """
+        Stops least recently used, idle pools until needed bytes fit into the
+        memory budget.  Returns True if enough memory could be freed.
+        """
+        if self.memory_budget is None:
+            return True
+
+        for pair, pool in self.pools.items():
+            used = sum([p.memory() for p in self.pools.values()])
+            if used + needed <= self.memory_budget:
+                return True
+
+            if self.leases.get(pair):
+                continue
+
+            LOGGER.info('Evicting decoders for {0} ({1} bytes).'.format(pair,
+              pool.memory()))
+            self.footprints[pair] = pool.memory()
+            pool.stop()
+            del self.pools[pair]
+
+        used = sum([p.memory() for p in self.pools.values()])
+        return used + needed <= self.memory_budget
+
+    @contextmanager
+    def pool(self, pair):
+        """
+        Context manager returning the DecoderPool for the given language
+        pair, starting it if necessary.  Blocks while the memory budget is
+        exhausted by pools which are in use.
+
+        Raises KeyError for unknown language pairs.
+        """
+        config = self.configs[pair]
+
+        with self.condition:
+            while not pair in self.pools:
+                # We always allow loading a model into an empty registry,
+                # otherwise a single model larger than the budget would
+                # block forever.
+                if self._evict(self._footprint(pair)) or not self.pools:
+                    LOGGER.info('Loading decoders for {0}.'.format(pair))
+                    self.pools[pair] = DecoderPool(self.command, config,
+                      self.size)
+                    break
+
+                self.condition.wait()
+
+            # Mark the language pair as most recently used.
+            pool = self.pools.pop(pair)
+            self.pools[pair] = pool
+            self.leases[pair] = self.leases.get(pair, 0) + 1
+
+        try:
+            yield pool
+
+        finally:
+            with self.condition:
+                self.leases[pair] -= 1
+                self.footprints[pair] = max(self.footprints.get(pair, 0),
+                  pool.memory())
+                self.condition.notify_all()
+
+    def translate(self, pair, lines, callback=None, on_cancel=None):
+        """
+        Translates the given list of lines for the given language pair, see
+        DecoderPool.translate().
+        """
+        with self.pool(pair) as pool:
+            return pool.translate(lines, callback, on_cancel)
+
+    def check(self):
+        """Health-checks the decoders of all loaded language pairs."""
+        with self.condition:
+            pools = self.pools.values()
+
+        for pool in pools:
+            pool.check()
+
+    def stop(self):
+        """Terminates all loaded decoders."""
+        with self.condition:
+            for pool in self.pools.values():
+                pool.stop()
+            self.pools.clear()
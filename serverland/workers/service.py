@@ -0,0 +1,442 @@
+"""
+Base implementation for worker servers connecting to external MT services.
+
+Source lines are grouped into batches limited by a byte budget and batches
+are sent to the service concurrently over pooled keep-alive connections.
+Character quotas of the services are enforced by a token bucket which is
+shared by all jobs of a worker server.
+"""
+import fcntl
+import httplib
+import json
+import logging
+import socket
+import urllib2
+
+from datetime import datetime
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from os import path
+from threading import Lock
+from time import sleep, time
+from urlparse import urlsplit
+
+from workers.connection import ConnectionPool
+from workers.worker import AbstractWorkerServer, ProgressCollector
+
+LOGGER = logging.getLogger('ServiceWorker')
+
+
+class QuotaExceeded(Exception):
+    """Raised when a request would exceed the monthly character quota."""
+    pass
+
+
+# Errors raised by failed service requests, see ServiceWorker.is_transient().
+SERVICE_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+class QuotaLimiter(object):
+    """
+    Token bucket limiting the characters sent to an external service per
+    second and per calendar month.
+
+    The bucket state is stored in a JSON file protected by a file lock, so
+    that it is shared by all jobs, both threads and processes, and survives
+    restarts of the worker server.
+    """
+    def __init__(self, filename, per_second=None, per_month=None):
+        """
+        Creates a new QuotaLimiter storing its state in the given file.
+
+        Limits set to None are not enforced.
+        """
+        self.filename = filename
+        self.per_second = per_second
+        self.per_month = per_month
+
+    def _load(self, handle):
+        """Reads the bucket state from the given file handle."""
+        handle.seek(0)
+        try:
+            state = json.loads(handle.read())
+
+        except ValueError:
+            state = {}
+
+        month = datetime.now().strftime('%Y-%m')
+        if state.get('month') != month:
+            state['month'] = month
+            state['used'] = 0
+
+        # Refill the bucket, it holds at most one second worth of tokens.
+        now = time()
+        if self.per_second:
+            tokens = state.get('tokens', self.per_second)
+            elapsed = max(0, now - state.get('updated', now))
+            state['tokens'] = min(self.per_second,
+              tokens + elapsed * self.per_second)
+        state['updated'] = now
+
+        return state
+
+    @staticmethod
+    def _store(handle, state):
+        """Writes the bucket state to the given file handle."""
+        handle.seek(0)
+        handle.truncate()
+        handle.write(json.dumps(state))
+        handle.flush()
+
+    def acquire(self, chars):
+        """
+        Blocks until chars characters may be sent to the service.
+
+        Raises QuotaExceeded if the monthly quota does not allow to send
+        the given number of characters.
+        """
+        while True:
+            with open(self.filename, 'a+') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                state = self._load(handle)
+
+                if self.per_month and state['used'] + chars > self.per_month:
+                    self._store(handle, state)
+                    raise QuotaExceeded('Monthly quota of {0} characters ' \
+                      'exceeded.'.format(self.per_month))
+
+                # Requests larger than the bucket are allowed once the bucket
+                # is full, leaving the bucket in debt.
+                wait = 0
+                if self.per_second:
+                    needed = min(chars, self.per_second)
+                    if state['tokens'] < needed:
+                        wait = (needed - state['tokens']) / self.per_second
+
+                    else:
+                        state['tokens'] -= chars
+
+                if not wait:
+                    state['used'] += chars
+
+                self._store(handle, state)
+
+            if not wait:
+                return
+
+            sleep(wait)
+
+    def usage(self):
+        """
+        Returns a dictionary describing the current quota usage.
+        """
+        with open(self.filename, 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            state = self._load(handle)
+
+        remaining = None
+        if self.per_month:
+            remaining = max(0, self.per_month - state['used'])
+
+        return {'month': state['month'], 'used': state['used'],
+          'remaining': remaining, 'per_month': self.per_month,
+          'per_second': self.per_second}
+
+
+# pylint: disable-msg=R0922
+class ServiceWorker(AbstractWorkerServer):
+    """
+    Abstract worker server for external translation services.
+
+    Sub-classes implement _batch_translate() which translates a list of
+    lines with a single service request.
+    """
+    __name__ = 'ServiceWorker'
+    # pylint: disable-msg=C0103
+    SERVICE_URL = None
+    BATCH_BYTES = 5000
+    BATCH_LINES = 100
+    MAX_REQUESTS = 4
+    CHARS_PER_SECOND = None
+    CHARS_PER_MONTH = None
+    MAX_RETRIES = 3
+    RETRY_DELAY = 1.0
+    POOL_SIZE = 8
+    HTTP_TIMEOUT = 60
+    limiter = None
+
+    # Bytes of request markup added for every line of a batch, see
+    # line_size().
+    line_overhead = 0
+
+    # Connections are shared between jobs, hence jobs have to run as threads.
+    threaded_jobs = True
+
+    def __init__(self, *args, **kwargs):
+        """
+        Creates a new ServiceWorker instance, see AbstractWorkerServer.
+        """
+        super(ServiceWorker, self).__init__(*args, **kwargs)
+        self.pools = {}
+        self.pools_lock = Lock()
+        self.server.register_function(self.quota_usage, "quota_usage")
+        self.server.register_function(self.connection_stats,
+          "connection_stats")
+
+    @staticmethod
+    def usage():
+        """
+        Returns usage information, e.g. for additional parameters, etc.
+        """
+        return AbstractWorkerServer.usage() + (
+          'BATCH_BYTES=max_bytes_per_service_request (optional)',
+          'BATCH_LINES=max_lines_per_service_request (optional)',
+          'MAX_REQUESTS=max_parallel_service_requests_per_job (optional)',
+          'CHARS_PER_SECOND=max_characters_per_second (optional)',
+          'CHARS_PER_MONTH=max_characters_per_month (optional)',
+          'MAX_RETRIES=retries_per_failed_batch (optional)',
+          'RETRY_DELAY=seconds_before_first_retry (optional)',
+          'POOL_SIZE=max_connections_per_service_host (optional)',
+          'HTTP_TIMEOUT=seconds_per_service_request (optional)')
+
+    def parse_args(self, args):
+        """
+        Parses the given args list and sets worker specific paramters.
+        """
+        if not super(ServiceWorker, self).parse_args(args):
+            return False
+
+        for arg in args:
+            try:
+                key, value = arg.split('=')
+
+            except ValueError:
+                continue
+
+            if key == 'BATCH_BYTES':
+                print "Setting BATCH_BYTES={0}".format(value)
+                self.BATCH_BYTES = int(value)
+
+            elif key == 'BATCH_LINES':
+                print "Setting BATCH_LINES={0}".format(value)
+                self.BATCH_LINES = int(value)
+
+            elif key == 'MAX_REQUESTS':
+                print "Setting MAX_REQUESTS={0}".format(value)
+                self.MAX_REQUESTS = int(value)
+
+            elif key == 'CHARS_PER_SECOND':
+                print "Setting CHARS_PER_SECOND={0}".format(value)
+                self.CHARS_PER_SECOND = int(value)
+
+            elif key == 'CHARS_PER_MONTH':
+                print "Setting CHARS_PER_MONTH={0}".format(value)
+                self.CHARS_PER_MONTH = int(value)
+
+            elif key == 'MAX_RETRIES':
+                print "Setting MAX_RETRIES={0}".format(value)
+                self.MAX_RETRIES = int(value)
+
+            elif key == 'RETRY_DELAY':
+                print "Setting RETRY_DELAY={0}".format(value)
+                self.RETRY_DELAY = float(value)
+
+            elif key == 'POOL_SIZE':
+                print "Setting POOL_SIZE={0}".format(value)
+                self.POOL_SIZE = int(value)
+
+            elif key == 'HTTP_TIMEOUT':
+                print "Setting HTTP_TIMEOUT={0}".format(value)
+                self.HTTP_TIMEOUT = float(value)
+
+        # The quota state is kept next to the message files so that it
+        # survives restarts of the worker server.
+        self.limiter = QuotaLimiter(path.join(self.message_path,
+          '{0}.quota'.format(self.__name__)), self.CHARS_PER_SECOND,
+          self.CHARS_PER_MONTH)
+
+        return self.BATCH_BYTES > 0 and self.BATCH_LINES > 0 and \
+          self.MAX_REQUESTS > 0 and self.MAX_RETRIES >= 0 and \
+          self.POOL_SIZE > 0
+
+    def quota_usage(self):
+        """
+        Returns a dictionary describing the service quota usage.
+        """
+        if not self.limiter:
+            return {}
+
+        return self.limiter.usage()
+
+    def connection_stats(self):
+        """
+        Returns request and connection reuse counters for each service host.
+        """
+        with self.pools_lock:
+            return dict([('{0}://{1}'.format(scheme, netloc), pool.stats())
+              for (scheme, netloc), pool in self.pools.items()])
+
+    def http_post(self, url, data, headers):
+        """
+        Sends a POST request to the given URL, returns the response content.
+
+        Connections are taken from a pool of keep-alive connections shared
+        by all jobs of this worker server.
+        """
+        scheme, netloc, url_path, query, _ = urlsplit(url)
+        with self.pools_lock:
+            pool = self.pools.get((scheme, netloc))
+            if pool is None:
+                pool = ConnectionPool(scheme, netloc, self.POOL_SIZE,
+                  self.HTTP_TIMEOUT)
+                self.pools[(scheme, netloc)] = pool
+
+        if query:
+            url_path = '{0}?{1}'.format(url_path, query)
+
+        return pool.request('POST', url_path or '/', data, headers)
+
+    def stop_worker(self):
+        """
+        Stops the event handler and closes all pooled connections.
+        """
+        super(ServiceWorker, self).stop_worker()
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.close()
+
+    def batches(self, lines):
+        """
+        Splits the given list of lines into batches of consecutive lines.
+
+        Each batch contains at most BATCH_LINES lines and BATCH_BYTES bytes
+        of request data, as measured by line_size().  Lines exceeding the
+        byte budget on their own are sent as a single-line batch.
+        """
+        batches = []
+        current = []
+        current_bytes = 0
+        for line in lines:
+            size = self.line_size(line)
+            if current and (current_bytes + size > self.BATCH_BYTES or
+              len(current) >= self.BATCH_LINES):
+                batches.append(current)
+                current = []
+                current_bytes = 0
+
+            current.append(line)
+            current_bytes += size
+
+        if current:
+            batches.append(current)
+
+        return batches
+
+    def line_size(self, line):
+        """
+        Returns the number of bytes the given line adds to a service request.
+
+        By default, this is the length of the UTF-8 encoded line plus
+        line_overhead; sub-classes escaping or encoding lines override this.
+        """
+        return len(line.encode('utf-8')) + self.line_overhead
+
+    def translate_lines(self, source, target, lines, request_id=None):
+        """
+        Translates the given list of lines, sending batches concurrently.
+
+        Returns the translated text, batch results are joined in source order
+        and each one is terminated by a line break.  If request_id is given,
+        the progress of that request is reported as batches complete.
+        """
+        batches = self.batches(lines)
+        if not batches:
+            return u''
+
+        progress = None
+        if request_id is not None:
+            progress = ProgressCollector(partial(self.report_progress,
+              request_id), batches)
+
+        def translate((index, batch)):
+            """Translates the given batch and reports its lines."""
+            # Batches of deleted or overdue requests are not sent anymore.
+            if request_id is not None and self.is_cancelled(request_id):
+                return u''
+
+            result = self._retry_translate(source, target, batch)
+            if progress:
+                for number, line in enumerate(result.split(u'\n')):
+                    progress.add(index, number, line)
+
+            return result
+
+        pool = ThreadPool(min(len(batches), self.MAX_REQUESTS))
+        try:
+            results = pool.map(translate, list(enumerate(batches)))
+
+        finally:
+            pool.close()
+
+        return u''.join([u'{0}\n'.format(result) for result in results])
+
+    def translate_message(self, message, source, target, request_id):
+        """
+        Sets the target text of the given TranslationRequestMessage to the
+        translation of its source text, see translate_lines().
+
+        If the service cannot translate the text, as the quota is exhausted
+        or requests keep failing, the error is stored as ERROR in the packet
+        data instead and no target text is set.
+        """
+        try:
+            message.target_text = self.translate_lines(source, target,
+              message.source_text.split('\n'), request_id)
+
+        except (QuotaExceeded,) + SERVICE_ERRORS, msg:
+            LOGGER.error('Could not translate request {0}: {1}'.format(
+              request_id, msg))
+            keyvalue = message.packet_data.add()
+            keyvalue.key = 'ERROR'
+            keyvalue.value = '{0}'.format(msg)
+
+    @staticmethod
+    def is_transient(error):
+        """
+        Checks if a failed service request may succeed when it is sent again,
+        i.e. for network and server errors but not for client errors such as
+        invalid keys or unsupported languages.
+        """
+        if isinstance(error, urllib2.HTTPError):
+            return error.code >= 500
+
+        return True
+
+    def _retry_translate(self, source, target, lines):
+        """
+        Translates a batch of lines within the service quota, retrying the
+        batch with exponential backoff if the service request fails with a
+        transient error.  The quota is charged once per batch.
+        """
+        chars = sum([len(line) for line in lines])
+        if self.limiter:
+            self.limiter.acquire(chars)
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                return self._batch_translate(source, target, lines)
+
+            except SERVICE_ERRORS, msg:
+                if attempt == self.MAX_RETRIES or not self.is_transient(msg):
+                    raise
+
+                delay = self.RETRY_DELAY * 2 ** attempt
+                LOGGER.warning('Batch request failed ({0}), retrying in ' \
+                  '{1} seconds.'.format(msg, delay))
+                sleep(delay)
+
+    def _batch_translate(self, source, target, lines):
+        """
+        Raises NotImplemented exception, has to be implemented in sub-classes.
+        """
+        raise NotImplementedError
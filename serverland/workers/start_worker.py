@@ -2,9 +2,10 @@
 """
 Startup script to create a worker server instance at host:port.
 """
+import os
 import sys
 
-from workers.worker import DummyWorker
+from workers.worker import DummyWorker, SERVER_MODES
 from workers.worker_bing import BingWorker
 from workers.worker_google import GoogleWorker
 from workers.worker_lucy import LucyWorker
@@ -34,7 +35,8 @@ if __name__ == "__main__":
         
         print "\t- optional arguments:"
         print "\t  > LOGFILE=/path/to/logfile"
-        print "\t  > MESSAGE_PATH=/tmp\n"
+        print "\t  > MESSAGE_PATH=/tmp/workerserver-<worker>-<port>"
+        print "\t  > SERVER_MODE={0}\n".format('|'.join(SERVER_MODES.keys()))
         
         if len(REGISTERED_WORKERS):
             print "\tregistered worker servers:"
@@ -52,7 +54,8 @@ if __name__ == "__main__":
     
     # Prepare XML-RPC server instance running on host:port.
     LOGFILE = None
-    MESSAGE_PATH = '/tmp'
+    MESSAGE_PATH = None
+    SERVER_MODE = 'single'
     kwargs = sys.argv[4:]
     for arg in kwargs:
         if arg.startswith('LOGFILE='):
@@ -60,21 +63,34 @@ if __name__ == "__main__":
         
         if arg.startswith('MESSAGE_PATH='):
             MESSAGE_PATH = arg.split('=')[1]
+        
+        if arg.startswith('SERVER_MODE='):
+            SERVER_MODE = arg.split('=')[1]
+    
+    if not SERVER_MODE in SERVER_MODES.keys():
+        print "\n\tunknown SERVER_MODE={0}, choose one of: {1}\n".format(
+          SERVER_MODE, ', '.join(SERVER_MODES.keys()))
+        sys.exit(-1)
     
     if LOGFILE:
         WORKER_IMPLEMENTATION, _ = REGISTERED_WORKERS[sys.argv[1]]
     else:
         WORKER_IMPLEMENTATION, LOGFILE = REGISTERED_WORKERS[sys.argv[1]]
     
-    # Collect positional arguments, LOGFILE is now guaranteed to be set.
-    ARGS = [sys.argv[2], int(sys.argv[3]), LOGFILE]
+    # Scratch files are cleaned up by request id, so each worker server gets
+    # a folder of its own instead of sharing /tmp with other programs.
+    if not MESSAGE_PATH:
+        MESSAGE_PATH = '/tmp/workerserver-{0}-{1}'.format(
+          sys.argv[1].lower(), sys.argv[3])
+    
+    if not os.path.isdir(MESSAGE_PATH):
+        os.makedirs(MESSAGE_PATH)
     
-    # Append MESSAGE_PATH if available.
-    if MESSAGE_PATH:
-        ARGS.append(MESSAGE_PATH)
+    # Collect positional arguments, LOGFILE is now guaranteed to be set.
+    ARGS = [sys.argv[2], int(sys.argv[3]), LOGFILE, MESSAGE_PATH]
     
     # Instantiate worker server instance.
-    SERVER = WORKER_IMPLEMENTATION(*ARGS)
+    SERVER = WORKER_IMPLEMENTATION(*ARGS, server_mode=SERVER_MODE)
     
     # Parse additional parameters.
     ready = SERVER.parse_args(kwargs)
@@ -0,0 +1,1238 @@
+"""
+Unit tests for MT Server Land worker servers.
+
+Run from the root folder of your MT Server Land installation:
+
+    PYTHONPATH=. python -m unittest workers.tests
+
+External translation services are replaced by a local HTTP stand-in.
+"""
+import cgi
+import os
+import re
+import socket
+import threading
+import time
+import unittest
+import urllib
+import urllib2
+import xmlrpclib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from subprocess import Popen
+from SocketServer import ThreadingMixIn
+from base64 import b64decode, b64encode
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
+from workers import worker as worker_module
+from workers.worker import AbstractWorkerServer, JobScheduler, \
+  ProgressCollector, TranslationJob, MEGABYTE
+from workers.connection import ConnectionPool
+from workers.decoder import Cancelled, DecoderPool, ModelRegistry, \
+  MosesDecoder
+from workers.service import QuotaExceeded, QuotaLimiter
+from workers.worker_bing import BingWorker
+from workers.worker_google import GoogleWorker
+from workers.worker_moses import MosesWorker
+from workers.worker_moses_server import MosesServerWorker
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Upper-cases the text sent by GoogleWorker and BingWorker requests and
+    returns it in the respective service's response format.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        """Suppresses logging of HTTP requests."""
+        pass
+
+    def do_POST(self):
+        """Handles a translation request."""
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        with server.lock:
+            server.requests.append(self.path)
+            if server.failures:
+                server.failures -= 1
+                self.send_error(server.error)
+                return
+
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+        if self.path.startswith('/google'):
+            text = cgi.parse_qs(body)['text'][0]
+            spans = ['<span>{0}</span>'.format(line.upper())
+              for line in text.split('\n')]
+            content = '<div><span id=result_box class="short_text">' \
+              '{0}</span></div>'.format('<br>'.join(spans))
+
+        else:
+            texts = re.findall('<string[^>]*>(.*?)</string>', body)
+            content = '<ArrayOfTranslateArrayResponse>{0}' \
+              '</ArrayOfTranslateArrayResponse>'.format(''.join(
+              ['<TranslateArrayResponse><TranslatedText>{0}</TranslatedText>'
+              '</TranslateArrayResponse>'.format(text.upper())
+              for text in texts]))
+
+        # Keep requests in flight for a while to observe concurrency.
+        server.barrier.wait(0.2)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+        # Requests to .../close make the server close the connection without
+        # telling the client, as servers do with idle connections.
+        if self.path.endswith('/close'):
+            self.close_connection = 1
+
+        with server.lock:
+            server.active -= 1
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server recording requests and request concurrency."""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('localhost', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.barrier = threading.Event()
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.failures = 0
+        self.error = 503
+
+
+class ServiceWorkerTests(unittest.TestCase):
+    """
+    Tests batching and concurrent dispatch of external service workers.
+    """
+    def setUp(self):
+        self.service = StandInServer()
+        thread = threading.Thread(target=self.service.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://localhost:{0}'.format(self.service.server_port)
+        self.logfile = NamedTemporaryFile()
+        self.message_path = mkdtemp()
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.service.server_close()
+        self.logfile.close()
+        for filename in os.listdir(self.message_path):
+            os.remove(os.path.join(self.message_path, filename))
+        os.rmdir(self.message_path)
+
+    def create_worker(self, worker_class, args):
+        """Creates a worker instance connected to the stand-in service."""
+        worker = worker_class('localhost', 0, self.logfile.name,
+          self.message_path)
+        worker.server.server_close()
+        self.assertTrue(worker.parse_args(args))
+        return worker
+
+    def test_batches_respect_byte_budget(self):
+        """Batches are limited by bytes and lines, long lines stay whole."""
+        worker = self.create_worker(BingWorker, ['BATCH_BYTES=100',
+          'BATCH_LINES=3'])
+        worker.line_overhead = 0
+        lines = [u'a' * 40, u'b' * 40, u'c' * 40, u'd' * 250, u'e', u'f',
+          u'g', u'h']
+        batches = worker.batches(lines)
+
+        self.assertEqual(batches, [[u'a' * 40, u'b' * 40], [u'c' * 40],
+          [u'd' * 250], [u'e', u'f', u'g'], [u'h']])
+        self.assertEqual(sum(batches, []), lines)
+
+    def test_google_batches_respect_encoded_size(self):
+        """GoogleWorker batches are limited by their URL-encoded size."""
+        worker = self.create_worker(GoogleWorker, ['BATCH_BYTES=300'])
+        lines = [u'\xe4\xf6\xfc' * 10, u'abc' * 10] * 5
+        batches = worker.batches(lines)
+
+        self.assertTrue(len(batches) > 2)
+        for batch in batches:
+            text = u'\n'.join([u'{0}\n{1}'.format(line, worker.__splitter__)
+              for line in batch])
+            self.assertTrue(len(urllib.quote_plus(text.encode('utf-8'))) <=
+              worker.BATCH_BYTES)
+
+    def test_google_batches_in_source_order(self):
+        """GoogleWorker sends batches concurrently and keeps line order."""
+        worker = self.create_worker(GoogleWorker, ['BATCH_BYTES=100',
+          'MAX_REQUESTS=4'])
+        worker.SERVICE_URL = self.url + '/google'
+        lines = [u'line {0}'.format(i) for i in range(50)]
+
+        result = worker.translate_lines('en', 'de', lines)
+
+        self.assertEqual(result, u''.join([u'{0}\n'.format(line.upper())
+          for line in lines]))
+        self.assertTrue(len(self.service.requests) > 1)
+        self.assertTrue(self.service.max_active > 1)
+
+    def test_connections_are_reused(self):
+        """Batches of several documents share keep-alive connections."""
+        worker = self.create_worker(BingWorker, ['BATCH_LINES=5',
+          'MAX_REQUESTS=2', 'POOL_SIZE=2'])
+        worker.SERVICE_URL = self.url + '/bing'
+        lines = [u'line {0}'.format(i) for i in range(20)]
+
+        for _ in range(3):
+            worker.translate_lines('en', 'de', lines)
+
+        stats = worker.connection_stats().values()[0]
+        self.assertEqual(stats['requests'], 12)
+        self.assertTrue(stats['created'] <= 2)
+        self.assertEqual(stats['created'] + stats['reused'], 12)
+
+    def test_stale_connections_are_retried(self):
+        """Requests on connections closed while idle are sent again."""
+        pool = ConnectionPool('http', self.url[7:], 1, timeout=1)
+        self.service.barrier.set()
+        pool.request('POST', '/bing/close', '')
+        time.sleep(0.1)
+
+        pool.request('POST', '/bing', '')
+        self.assertEqual(pool.stats()['created'], 2)
+        self.assertEqual(len(self.service.requests), 2)
+
+    def test_timeouts_are_not_retried(self):
+        """Requests which time out are not sent again."""
+        pool = ConnectionPool('http', self.url[7:], 1, timeout=0.1)
+        self.service.barrier.set()
+        pool.request('POST', '/bing', '')
+
+        self.service.barrier.clear()
+        self.assertRaises(socket.timeout, pool.request, 'POST', '/bing', '')
+        self.assertEqual(len(self.service.requests), 2)
+        self.assertEqual(pool.stats()['failed'], 1)
+
+    def test_bing_batches_in_source_order(self):
+        """BingWorker sends batches concurrently and keeps line order."""
+        worker = self.create_worker(BingWorker, ['BATCH_BYTES=500',
+          'MAX_REQUESTS=3'])
+        worker.SERVICE_URL = self.url + '/bing'
+        lines = [u'line {0}'.format(i) for i in range(50)]
+
+        result = worker.translate_lines('en', 'de', lines)
+
+        self.assertEqual(result.split(u'\n')[:-1],
+          [line.upper() for line in lines])
+        self.assertTrue(len(self.service.requests) > 1)
+        self.assertTrue(self.service.max_active <= 3)
+
+    def test_failed_batch_is_retried(self):
+        """Only the failed batch is sent again after a service error."""
+        worker = self.create_worker(BingWorker, ['BATCH_LINES=10',
+          'RETRY_DELAY=0.01'])
+        worker.SERVICE_URL = self.url + '/bing'
+        self.service.failures = 1
+        lines = [u'line {0}'.format(i) for i in range(30)]
+
+        result = worker.translate_lines('en', 'de', lines)
+
+        self.assertEqual(result.split(u'\n')[:-1],
+          [line.upper() for line in lines])
+        self.assertEqual(len(self.service.requests), 4)
+
+    def test_client_errors_are_not_retried(self):
+        """Batches rejected by the service are not sent again."""
+        worker = self.create_worker(BingWorker, ['RETRY_DELAY=0.01'])
+        worker.SERVICE_URL = self.url + '/bing'
+        self.service.failures, self.service.error = 2, 403
+
+        self.assertRaises(urllib2.HTTPError, worker.translate_lines, 'en',
+          'de', [u'line'])
+        self.assertEqual(len(self.service.requests), 1)
+
+    def test_retries_are_charged_once(self):
+        """Retried batches count against the quota only once."""
+        worker = self.create_worker(BingWorker, ['RETRY_DELAY=0.01',
+          'CHARS_PER_MONTH=100'])
+        worker.SERVICE_URL = self.url + '/bing'
+        self.service.failures = 2
+
+        worker.translate_lines('en', 'de', [u'line'])
+        self.assertEqual(len(self.service.requests), 3)
+        self.assertEqual(worker.quota_usage()['used'], 4)
+
+    def test_service_errors_are_recorded(self):
+        """Requests failing at the service store the error message."""
+        worker = self.create_worker(BingWorker, ['CHARS_PER_MONTH=3'])
+        self.addCleanup(worker.stop_worker)
+        worker.SERVICE_URL = self.url + '/bing'
+        message = TranslationRequestMessage()
+        message.request_id = 'a'
+        message.source_language = 'deu'
+        message.target_language = 'eng'
+        message.source_text = u'line'
+        self.assertTrue(worker.start_translation(b64encode(
+          message.SerializeToString())))
+
+        started = time.time()
+        while not worker.is_ready('a'):
+            self.assertTrue(time.time() - started < 10)
+            time.sleep(0.05)
+
+        message.ParseFromString(b64decode(worker.fetch_translation('a')))
+        self.assertFalse(message.HasField('target_text'))
+        self.assertEqual([(x.key, x.value) for x in message.packet_data],
+          [('ERROR', 'Monthly quota of 3 characters exceeded.')])
+        self.assertEqual(self.service.requests, [])
+
+    def test_quota_is_persisted(self):
+        """Monthly usage survives restarts and is enforced."""
+        filename = os.path.join(self.message_path, 'test.quota')
+        QuotaLimiter(filename, per_month=100).acquire(60)
+        limiter = QuotaLimiter(filename, per_month=100)
+
+        self.assertEqual(limiter.usage()['used'], 60)
+        self.assertRaises(QuotaExceeded, limiter.acquire, 60)
+        limiter.acquire(40)
+        self.assertEqual(limiter.usage()['remaining'], 0)
+
+
+class UpperCaseWorker(AbstractWorkerServer):
+    """Worker server which instantly upper-cases the source text."""
+    __name__ = 'UpperCaseWorker'
+    threaded_jobs = True
+
+    def handle_translation(self, request_id):
+        """Writes an all-uppercase translation of the source text."""
+        filename = '{0}/{1}.message'.format(self.message_path, request_id)
+        message = TranslationRequestMessage()
+        message.ParseFromString(open(filename, 'rb').read())
+        message.target_text = message.source_text.upper()
+        open(filename, 'wb').write(message.SerializeToString())
+
+    def language_pairs(self):
+        """Supports only German to English."""
+        return (('deu', 'eng'),)
+
+
+class BulkInterfaceTests(unittest.TestCase):
+    """
+    Tests the bulk and system.multicall variants of the worker interface.
+    """
+    def setUp(self):
+        self.logfile = NamedTemporaryFile()
+        self.message_path = mkdtemp()
+        self.worker = UpperCaseWorker('localhost', 0, self.logfile.name,
+          self.message_path, server_mode='threaded')
+        self.worker.MAX_JOBS = 3
+        self.serving = threading.Thread(target=self.worker.start_worker)
+        self.serving.daemon = True
+        self.serving.start()
+        self.proxy = xmlrpclib.ServerProxy('http://localhost:{0}'.format(
+          self.worker.server.server_address[1]))
+
+        for request_id in ('a', 'b', 'c'):
+            message = TranslationRequestMessage()
+            message.request_id = request_id
+            message.source_language = 'deu'
+            message.target_language = 'eng'
+            message.source_text = u'text {0}'.format(request_id)
+            self.proxy.start_translation(b64encode(
+              message.SerializeToString()))
+
+        while not all([self.worker.is_ready(x) for x in ('a', 'b', 'c')]):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.worker.stop_worker()
+        self.serving.join(5)
+        self.worker.server.server_close()
+        self.logfile.close()
+        for filename in os.listdir(self.message_path):
+            os.remove(os.path.join(self.message_path, filename))
+        os.rmdir(self.message_path)
+
+    def test_job_statuses(self):
+        """Statuses of several requests are returned in one call."""
+        statuses = self.proxy.job_statuses(['a', 'b', 'x'])
+        self.assertEqual(statuses, {'a': 'finished', 'b': 'finished',
+          'x': 'unknown'})
+
+    def test_fetch_and_delete_translations(self):
+        """Results are fetched and deleted in bulk, unknown ids fail."""
+        results = self.proxy.fetch_translations(['a', 'b', 'x'], True)
+        message = TranslationRequestMessage()
+        message.ParseFromString(b64decode(results['a']))
+        self.assertEqual(message.target_text, u'TEXT A')
+        self.assertEqual(b64decode(results['x']), 'ERROR')
+        self.assertEqual(os.listdir(self.message_path), ['c.message'])
+
+        deleted = self.proxy.delete_translations(['c', 'x'])
+        self.assertEqual(deleted, {'c': True, 'x': False})
+
+    def test_multicall(self):
+        """Single-id methods can be batched via system.multicall."""
+        multicall = xmlrpclib.MultiCall(self.proxy)
+        multicall.job_status('a')
+        multicall.is_ready('x')
+        multicall.queue_status()
+        results = tuple(multicall())
+        self.assertEqual(results[:2], ('finished', False))
+        self.assertEqual(results[2]['queued'], 0)
+
+
+class ForkingWorker(UpperCaseWorker):
+    """
+    Worker server running its jobs as processes which log, recording the
+    threads scheduling jobs.
+    """
+    __name__ = 'ForkingWorker'
+    threaded_jobs = False
+
+    def schedule_jobs(self):
+        """Records the current thread and schedules queued jobs."""
+        with self.jobs_lock:
+            if len(self.pending):
+                self.scheduling.add(threading.current_thread().name)
+
+        super(ForkingWorker, self).schedule_jobs()
+
+    def handle_translation(self, request_id):
+        """Logs a lot and writes an all-uppercase translation."""
+        for number in range(50):
+            self.LOGGER.debug('Line {0} of {1}.'.format(number, request_id))
+        super(ForkingWorker, self).handle_translation(request_id)
+
+
+class ThreadedServerTests(unittest.TestCase):
+    """
+    Tests that threaded servers start job processes from the serving loop
+    while handling overlapping calls.
+    """
+    def setUp(self):
+        self.logfile = NamedTemporaryFile()
+        self.message_path = mkdtemp()
+        self.worker = ForkingWorker('localhost', 0, self.logfile.name,
+          self.message_path, server_mode='threaded')
+        self.worker.scheduling = set()
+        self.worker.MAX_JOBS = 4
+        self.serving = threading.Thread(target=self.worker.start_worker,
+          name='serving')
+        self.serving.daemon = True
+        self.serving.start()
+        self.url = 'http://localhost:{0}'.format(
+          self.worker.server.server_address[1])
+
+    def tearDown(self):
+        self.worker.stop_worker()
+        self.serving.join(5)
+        self.worker.server.server_close()
+        self.logfile.close()
+        for filename in os.listdir(self.message_path):
+            os.remove(os.path.join(self.message_path, filename))
+        os.rmdir(self.message_path)
+
+    def test_overlapping_calls(self):
+        """Concurrent clients submit and poll jobs which all finish."""
+        request_ids = ['{0:032x}'.format(number) for number in range(12)]
+        errors = []
+
+        def client(request_ids):
+            """Submits the given requests and polls them until ready."""
+            proxy = xmlrpclib.ServerProxy(self.url)
+            try:
+                for request_id in request_ids:
+                    message = TranslationRequestMessage()
+                    message.request_id = request_id
+                    message.source_language = 'deu'
+                    message.target_language = 'eng'
+                    message.source_text = u'text'
+                    proxy.start_translation(b64encode(
+                      message.SerializeToString()))
+                    proxy.queue_status()
+
+                started = time.time()
+                while not all([proxy.is_ready(x) for x in request_ids]):
+                    if time.time() - started > 20:
+                        raise AssertionError('Jobs did not finish.')
+                    time.sleep(0.01)
+
+            except Exception, msg:
+                errors.append(msg)
+
+        clients = [threading.Thread(target=client, args=(request_ids[i::4],))
+          for i in range(4)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join(30)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.worker.scheduling, set(['serving']))
+        message = TranslationRequestMessage()
+        for request_id in request_ids:
+            message.ParseFromString(b64decode(self.worker.fetch_translation(
+              request_id)))
+            self.assertEqual(message.target_text, u'TEXT')
+
+
+class SlowWorker(UpperCaseWorker):
+    """Worker server whose job processes take a second to finish."""
+    __name__ = 'SlowWorker'
+    threaded_jobs = False
+
+    def handle_translation(self, request_id):
+        """Blocks for a second before translating."""
+        time.sleep(1)
+        UpperCaseWorker.handle_translation(self, request_id)
+
+
+class JobTestCase(unittest.TestCase):
+    """
+    Base class for tests running jobs on a worker server without serving.
+    """
+    def create_worker(self, worker_class, **kwargs):
+        """Creates a worker server instance writing to a scratch folder."""
+        self.logfile = NamedTemporaryFile()
+        self.message_path = mkdtemp()
+        self.worker = worker_class('localhost', 0, self.logfile.name,
+          self.message_path, **kwargs)
+        self.worker.server.server_close()
+
+    def tearDown(self):
+        self.worker.stop_worker()
+        self.logfile.close()
+        for filename in os.listdir(self.message_path):
+            os.remove(os.path.join(self.message_path, filename))
+        os.rmdir(self.message_path)
+
+    def submit(self, request_id):
+        """Submits a translation request with the given id."""
+        message = TranslationRequestMessage()
+        message.request_id = request_id
+        message.source_language = 'deu'
+        message.target_language = 'eng'
+        message.source_text = u'text'
+        self.assertTrue(self.worker.start_translation(b64encode(
+          message.SerializeToString())))
+
+
+class MemoryAdmissionTests(JobTestCase):
+    """
+    Tests that jobs are deferred while available memory is too low.
+    """
+    def setUp(self):
+        self.create_worker(SlowWorker, min_memory=100)
+        self.worker.MAX_JOBS = 2
+        self.available = 1000 * MEGABYTE
+        self.original = worker_module.available_memory
+        worker_module.available_memory = lambda: self.available
+
+    def tearDown(self):
+        worker_module.available_memory = self.original
+        JobTestCase.tearDown(self)
+
+    def test_jobs_are_deferred(self):
+        """Jobs wait while memory would drop below MIN_MEMORY."""
+        self.submit('a')
+        self.assertEqual(self.worker.job_status('a'), 'running')
+
+        # The running job needs more than the remaining 1 MB of headroom.
+        self.available = 101 * MEGABYTE
+        self.submit('b')
+        self.assertEqual(self.worker.job_status('b'), 'queued')
+
+        status = self.worker.memory_status()
+        self.assertEqual(status['deferred'], 1)
+        self.assertEqual(status['headroom'], 1)
+        self.assertTrue(status['job_memory'] > 1)
+
+        # A single job is always started, otherwise requests would starve.
+        while self.worker.is_alive() and not self.worker.is_ready('a'):
+            time.sleep(0.1)
+        self.worker.schedule_jobs()
+        self.assertEqual(self.worker.job_status('b'), 'running')
+        self.assertEqual(self.worker.memory_status()['deferred'], 0)
+
+
+class HangingWorker(UpperCaseWorker):
+    """Worker server whose jobs start a decoder process which hangs."""
+    __name__ = 'HangingWorker'
+    threaded_jobs = False
+
+    def handle_translation(self, request_id):
+        """Starts a hanging shell command and waits for it."""
+        decoder = Popen('sleep 60; true', shell=True)
+        handle = open('{0}/{1}.pid'.format(self.message_path, request_id),
+          'w')
+        handle.write(str(decoder.pid))
+        handle.close()
+        decoder.wait()
+
+
+def is_running(pid):
+    """Checks if the given process exists and is not a zombie."""
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat_file:
+            return stat_file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+
+    except IOError:
+        return False
+
+
+class JobTerminationTests(JobTestCase):
+    """
+    Tests that jobs are killed together with the processes they started.
+    """
+    def setUp(self):
+        self.create_worker(HangingWorker)
+        self.worker.KILL_GRACE = 1
+
+    def decoder_pid(self, request_id):
+        """Waits for the job to start its decoder, returns its pid."""
+        filename = '{0}/{1}.pid'.format(self.message_path, request_id)
+        while not os.path.exists(filename) or not open(filename).read():
+            time.sleep(0.05)
+        return int(open(filename).read())
+
+    def wait_until_finished(self, request_id):
+        """Runs job checks until the given job has finished."""
+        started = time.time()
+        while self.worker.job_status(request_id) != 'finished':
+            self.assertTrue(time.time() - started < 10)
+            self.worker.check_jobs()
+            time.sleep(0.05)
+
+    def test_deadline_kills_process_group(self):
+        """Jobs past their deadline are killed and the reason recorded."""
+        self.worker.JOB_DEADLINE = 1
+        self.submit('a')
+        pid = self.decoder_pid('a')
+        self.assertTrue(is_running(pid))
+
+        self.wait_until_finished('a')
+        self.assertFalse(is_running(pid))
+
+        message = TranslationRequestMessage()
+        message.ParseFromString(b64decode(self.worker.fetch_translation('a')))
+        self.assertEqual([(x.key, x.value) for x in message.packet_data],
+          [('KILLED', 'deadline of 1 seconds exceeded')])
+
+    def test_delete_kills_process_group(self):
+        """Deleting a running job also kills the processes it started."""
+        self.submit('b')
+        pid = self.decoder_pid('b')
+        self.assertTrue(self.worker.delete_translation('b'))
+
+        self.wait_until_finished('b')
+        self.assertFalse(is_running(pid))
+
+
+class CleanUpTests(JobTestCase):
+    """
+    Tests eviction of stale jobs and removal of scratch files.
+    """
+    def setUp(self):
+        self.create_worker(UpperCaseWorker)
+        self.worker.MAX_JOBS = 3
+        self.worker.JOB_TTL = 100
+
+    def touch(self, filename, age=0):
+        """Creates a scratch file of 10 bytes, age seconds old."""
+        path = os.path.join(self.message_path, filename)
+        handle = open(path, 'w')
+        handle.write('0123456789')
+        handle.close()
+        os.utime(path, (time.time() - age, time.time() - age))
+
+    def test_clean_up(self):
+        """Stale jobs are evicted and scratch files are removed."""
+        # Only files named after 32 digit hex request ids are scratch files.
+        a, b, c, x, y = [digit * 32 for digit in 'abcef']
+        for request_id in (a, b, c):
+            self.submit(request_id)
+        while not all([self.worker.is_ready(r) for r in (a, b, c)]):
+            time.sleep(0.01)
+
+        self.worker.clean_up()
+        self.worker.jobs[a].finished -= 200
+        self.assertTrue(self.worker.delete_translation(b))
+        self.assertFalse(self.worker.delete_translation(b))
+
+        self.touch(c + '.0.source')
+        self.touch(c + '.0.target')
+        self.touch(x + '.message', age=200)
+        self.touch(y + '.message')
+        self.touch('notes.txt', age=200)
+        self.touch('notes.message', age=200)
+        self.worker.clean_up()
+
+        self.assertEqual(self.worker.list_requests(), [c])
+        self.assertEqual(sorted(os.listdir(self.message_path)),
+          [c + '.message', y + '.message', 'notes.message', 'notes.txt'])
+
+        status = self.worker.cleanup_status()
+        self.assertEqual((status['evicted'], status['files'], status['jobs']),
+          (2, 4, 1))
+        self.assertTrue(status['reclaimed'] > 30)
+
+
+# Stand-in for the Moses decoder: logs 500 lines to stderr, then upper-cases
+# its input one line at a time, taking a second for lines saying "wait" and
+# hanging on lines saying "hang".
+FAKE_MOSES = """#!/bin/sh
+i=0
+while [ $i -lt 500 ]; do echo "log line $i" >&2; i=$((i+1)); done
+while read line; do
+  [ "$line" = wait ] && sleep 1
+  [ "$line" = hang ] && exec sleep 60
+  echo "$line" | tr a-z A-Z
+done
+"""
+
+
+class MosesWorkerTests(JobTestCase):
+    """
+    Tests that Moses jobs stream text through decoder pipes.
+    """
+    def setUp(self):
+        self.create_worker(MosesWorker)
+        self.worker.MOSES_CMD = os.path.join(self.message_path, 'moses')
+        self.worker.MOSES_MODELS = ((('deu', 'eng'), 'moses.ini'),)
+        self.worker.SHARD_LINES = 2
+        self.worker.SHARDS = 2
+
+        handle = open(self.worker.MOSES_CMD, 'w')
+        handle.write(FAKE_MOSES)
+        handle.close()
+        os.chmod(self.worker.MOSES_CMD, 0755)
+
+    def translate(self, request_id, source_text):
+        """Submits a translation request with the given source text."""
+        message = TranslationRequestMessage()
+        message.request_id = request_id
+        message.source_language = 'deu'
+        message.target_language = 'eng'
+        message.source_text = source_text
+        self.assertTrue(self.worker.start_translation(b64encode(
+          message.SerializeToString())))
+
+    def wait_until(self, condition):
+        """Waits for up to 10 seconds until condition() is True."""
+        started = time.time()
+        while not condition():
+            self.assertTrue(time.time() - started < 10)
+            time.sleep(0.05)
+
+    def test_decoder_pipes(self):
+        """Shards are decoded via pipes, stderr is truncated."""
+        self.translate('a', u'one\ntwo\nthree\n')
+        self.wait_until(lambda: self.worker.is_ready('a'))
+
+        message = TranslationRequestMessage()
+        message.ParseFromString(b64decode(self.worker.fetch_translation('a')))
+        self.assertEqual(message.target_text, u'ONE\nTWO\nTHREE\n')
+
+        packet_data = dict([(x.key, x.value) for x in message.packet_data])
+        self.assertEqual(sorted(packet_data.keys()), ['STDERR.0', 'STDERR.1'])
+        for stderr in packet_data.values():
+            self.assertEqual(stderr.splitlines()[0], 'log line 400')
+            self.assertEqual(stderr.splitlines()[-1], 'log line 499')
+
+        self.assertEqual(sorted(os.listdir(self.message_path)),
+          ['a.message', 'a.prefix', 'moses'])
+
+    def test_persistent_decoder_stderr(self):
+        """Shards decoded by persistent decoders keep their stderr, too."""
+        self.worker.registry = ModelRegistry(self.worker.MOSES_CMD,
+          self.worker.moses_configs(), None, 2)
+        self.addCleanup(self.worker.registry.stop)
+        self.worker.threaded_jobs = True
+        self.translate('a', u'one\ntwo\nthree\n')
+        self.wait_until(lambda: self.worker.is_ready('a'))
+
+        message = TranslationRequestMessage()
+        message.ParseFromString(b64decode(self.worker.fetch_translation('a')))
+        self.assertEqual(message.target_text, u'ONE\nTWO\nTHREE\n')
+
+        packet_data = dict([(x.key, x.value) for x in message.packet_data])
+        self.assertEqual(sorted(packet_data.keys()), ['STDERR.0', 'STDERR.1'])
+        for stderr in packet_data.values():
+            self.assertTrue(stderr.startswith('log line '))
+
+    def test_decoder_limit(self):
+        """Jobs starting several decoders each run fewer at a time."""
+        self.assertTrue(self.worker.parse_args(['MAX_JOBS=4', 'SHARDS=3',
+          'MAX_DECODERS=7']))
+        self.assertEqual((self.worker.MAX_JOBS, self.worker.SHARDS), (2, 3))
+
+        self.assertTrue(self.worker.parse_args(['MAX_DECODERS=2']))
+        self.assertEqual((self.worker.MAX_JOBS, self.worker.SHARDS), (1, 2))
+
+    def test_progress(self):
+        """Progress and the target prefix are reported while decoding."""
+        self.worker.SHARDS = 1
+        self.translate('b', u'one\ntwo\nwait\n')
+        self.wait_until(lambda: self.worker.job_progress('b')['completed'])
+
+        progress = self.worker.job_progress('b')
+        self.assertEqual((progress['status'], progress['completed'],
+          progress['total']), ('running', 2, 3))
+        self.assertTrue(progress['eta'] is not None)
+        self.assertEqual(b64decode(self.worker.fetch_partial_translation(
+          'b')), 'ONE\nTWO\n')
+
+        self.wait_until(lambda: self.worker.is_ready('b'))
+        progress = self.worker.job_progress('b')
+        self.assertEqual((progress['status'], progress['completed'],
+          progress['eta']), ('finished', 3, 0))
+        self.assertEqual(b64decode(self.worker.fetch_partial_translation(
+          'b')), 'ONE\nTWO\nWAIT\n')
+        self.assertEqual(self.worker.job_progress('x'),
+          {'status': 'unknown'})
+        self.assertEqual(self.worker.fetch_partial_translation('x'), False)
+
+    def test_hanging_decoder_is_restarted(self):
+        """Threaded jobs past their deadline abandon their decoders."""
+        self.addCleanup(setattr, DecoderPool, 'DRAIN_TIMEOUT',
+          DecoderPool.DRAIN_TIMEOUT)
+        DecoderPool.DRAIN_TIMEOUT = 1
+        self.worker.registry = ModelRegistry(self.worker.MOSES_CMD,
+          self.worker.moses_configs(), None)
+        self.addCleanup(self.worker.registry.stop)
+        self.worker.threaded_jobs = True
+        self.worker.JOB_DEADLINE = 1
+        self.translate('c', u'one\nhang\n')
+        self.wait_until(lambda: self.worker.job_progress('c')['completed'])
+
+        def reaped():
+            """Runs job checks, returns True once the job has finished."""
+            self.worker.check_jobs()
+            return self.worker.job_status('c') == 'finished'
+
+        self.wait_until(reaped)
+        message = TranslationRequestMessage()
+        message.ParseFromString(b64decode(self.worker.fetch_translation('c')))
+        self.assertFalse(message.HasField('target_text'))
+        self.assertEqual([(x.key, x.value) for x in message.packet_data],
+          [('KILLED', 'deadline of 1 seconds exceeded')])
+
+        # The hanging decoder is restarted for the next request.
+        self.translate('d', u'two\n')
+        self.wait_until(lambda: self.worker.is_ready('d'))
+        message.ParseFromString(b64decode(self.worker.fetch_translation('d')))
+        self.assertEqual(message.target_text, u'TWO\n')
+
+
+class FakeMosesServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    Stand-in for a Moses server: upper-cases segments, taking a second for
+    segments saying "wait" and hanging on segments saying "hang" until it is
+    shut down.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        SimpleXMLRPCServer.__init__(self, ('localhost', 0), allow_none=True,
+          logRequests=False)
+        self.register_multicall_functions()
+        self.register_function(self.translate)
+        self.stopped = threading.Event()
+
+    def translate(self, params):
+        """Translates the given segment."""
+        if params['text'] == 'wait':
+            time.sleep(1)
+
+        elif params['text'] == 'hang':
+            self.stopped.wait(30)
+
+        return {'text': params['text'].upper()}
+
+
+class MosesServerWorkerTests(JobTestCase):
+    """
+    Tests that Moses server jobs report progress per segment.
+    """
+    def setUp(self):
+        self.moses = FakeMosesServer()
+        thread = threading.Thread(target=self.moses.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.create_worker(MosesServerWorker)
+        self.assertTrue(self.worker.parse_args(['MOSES_SOURCE=deu',
+          'MOSES_TARGET=eng', 'MOSES_BACKENDS=http://localhost:{0}'.format(
+          self.moses.server_address[1])]))
+
+    def tearDown(self):
+        JobTestCase.tearDown(self)
+        self.moses.stopped.set()
+        self.moses.shutdown()
+        self.moses.server_close()
+
+    def test_progress(self):
+        """Progress and the target prefix are reported per segment."""
+        message = TranslationRequestMessage()
+        message.request_id = 'a'
+        message.source_language = 'deu'
+        message.target_language = 'eng'
+        message.source_text = u'one\ntwo\nwait\n'
+        self.assertTrue(self.worker.start_translation(b64encode(
+          message.SerializeToString())))
+
+        started = time.time()
+        while self.worker.job_progress('a')['completed'] < 2:
+            self.assertTrue(time.time() - started < 10)
+            time.sleep(0.05)
+
+        progress = self.worker.job_progress('a')
+        self.assertEqual((progress['status'], progress['completed'],
+          progress['total']), ('running', 2, 3))
+        self.assertEqual(b64decode(self.worker.fetch_partial_translation(
+          'a')), 'ONE\nTWO\n')
+
+        while not self.worker.is_ready('a'):
+            self.assertTrue(time.time() - started < 10)
+            time.sleep(0.05)
+
+        message.ParseFromString(b64decode(self.worker.fetch_translation('a')))
+        self.assertEqual(message.target_text, u'ONE\nTWO\nWAIT\n')
+        self.assertEqual(self.worker.job_progress('a')['completed'], 3)
+
+    def test_delete_aborts_hanging_requests(self):
+        """Deleting a job shuts down the connections it waits on."""
+        message = TranslationRequestMessage()
+        message.request_id = 'b'
+        message.source_language = 'deu'
+        message.target_language = 'eng'
+        message.source_text = u'one\nhang\n'
+        self.assertTrue(self.worker.start_translation(b64encode(
+          message.SerializeToString())))
+
+        started = time.time()
+        while not self.worker.job_progress('b')['completed']:
+            self.assertTrue(time.time() - started < 10)
+            time.sleep(0.05)
+
+        self.assertTrue(self.worker.delete_translation('b'))
+        while self.worker.jobs['b'].is_running():
+            self.assertTrue(time.time() - started < 10)
+            time.sleep(0.05)
+
+
+class ProgressCollectorTests(unittest.TestCase):
+    """
+    Tests that lines translated in parts form a contiguous prefix.
+    """
+    def test_prefix(self):
+        """Lines are only reported once all lines before them are."""
+        reports = []
+        progress = ProgressCollector(lambda lines, completed:
+          reports.append((lines, completed)), [['a', 'b'], ['c'], ['d']])
+
+        progress.add(1, 0, 'C')
+        progress.add(0, 0, 'A')
+        progress.add(0, 0, 'A')
+        progress.add(2, 0, 'D')
+        progress.add(0, 1, 'B')
+        self.assertEqual(reports, [([], 1), (['A'], 1), ([], 1),
+          (['B', 'C', 'D'], 1)])
+
+
+class BlockingWorker(UpperCaseWorker):
+    """Worker server whose jobs wait until the test releases them."""
+    __name__ = 'BlockingWorker'
+
+    def __init__(self, *args, **kwargs):
+        UpperCaseWorker.__init__(self, *args, **kwargs)
+        self.released = {}
+
+    def handle_translation(self, request_id):
+        """Waits for the job to be released before translating."""
+        self.released[request_id].wait(10)
+        UpperCaseWorker.handle_translation(self, request_id)
+
+
+class QueueingTests(JobTestCase):
+    """
+    Tests that jobs beyond MAX_JOBS are queued and started in order.
+    """
+    def setUp(self):
+        self.create_worker(BlockingWorker)
+        self.worker.MAX_JOBS = 2
+        for request_id in 'abcd':
+            self.worker.released[request_id] = threading.Event()
+
+    def tearDown(self):
+        for event in self.worker.released.values():
+            event.set()
+        JobTestCase.tearDown(self)
+
+    def release(self, request_id):
+        """Lets the given job finish and waits until it has finished."""
+        self.worker.released[request_id].set()
+        self.worker.jobs[request_id].process.join(10)
+        self.worker.schedule_jobs()
+
+    def statuses(self):
+        """Returns the statuses of all jobs as a string."""
+        return ' '.join([self.worker.job_status(x) for x in 'abcd'])
+
+    def test_jobs_are_queued(self):
+        """Queued jobs are started in arrival order as slots are freed."""
+        for request_id in 'abcd':
+            self.submit(request_id)
+
+        self.assertEqual(self.statuses(), 'running running queued queued')
+        self.assertEqual(self.worker.queue_status(),
+          {'slots': 2, 'running': 2, 'queued': 2})
+        self.assertFalse(self.worker.is_ready('c'))
+
+        self.release('b')
+        self.assertEqual(self.statuses(), 'running finished running queued')
+
+        self.release('a')
+        self.assertEqual(self.statuses(), 'finished finished running running')
+        self.assertEqual(self.worker.queue_status()['queued'], 0)
+
+        self.release('c')
+        self.release('d')
+        self.assertEqual(self.statuses(),
+          'finished finished finished finished')
+        self.assertEqual(sorted('abcd',
+          key=lambda x: self.worker.jobs[x].started), list('abcd'))
+
+    def test_duplicate_requests_are_rejected(self):
+        """A second request with a known id leaves the first one alone."""
+        self.submit('a')
+        message = TranslationRequestMessage()
+        message.request_id = 'a'
+        message.source_language = 'deu'
+        message.target_language = 'eng'
+        message.source_text = u'other text'
+        self.assertFalse(self.worker.start_translation(b64encode(
+          message.SerializeToString())))
+
+        self.assertEqual(self.worker.queue_status(),
+          {'slots': 2, 'running': 1, 'queued': 0})
+        message.ParseFromString(open(os.path.join(self.message_path,
+          'a.message'), 'rb').read())
+        self.assertEqual(message.source_text, u'text')
+
+    def test_deadlines_must_be_positive(self):
+        """Requested deadlines of zero seconds are ignored."""
+        for request_id, deadline in (('a', '0'), ('b', '5')):
+            message = TranslationRequestMessage()
+            message.request_id = request_id
+            message.source_language = 'deu'
+            message.target_language = 'eng'
+            message.source_text = u'text'
+            keyvalue = message.packet_data.add()
+            keyvalue.key = 'DEADLINE'
+            keyvalue.value = deadline
+            self.assertTrue(self.worker.start_translation(b64encode(
+              message.SerializeToString())))
+
+        self.assertEqual(self.worker.jobs['a'].deadline, None)
+        self.assertEqual(self.worker.jobs['b'].deadline, 5)
+
+
+class JobSchedulerTests(unittest.TestCase):
+    """
+    Tests the order in which queued jobs are started.
+    """
+    def setUp(self):
+        self.scheduler = JobScheduler(max_wait=600)
+
+    def append(self, request_id, priority, size, age=0):
+        """Queues a job submitted age seconds ago."""
+        job = TranslationJob(request_id, priority, size)
+        job.submitted -= age
+        self.scheduler.append(job)
+
+    def pop_all(self):
+        """Returns the request ids of all queued jobs in start order."""
+        return [self.scheduler.pop().request_id
+          for _ in range(len(self.scheduler))]
+
+    def test_priority_order(self):
+        """Jobs are ordered by priority class, size and arrival."""
+        self.append('batch-large', 'batch', 100)
+        self.append('batch-small', 'batch', 1)
+        self.append('interactive-large', 'interactive', 100)
+        self.append('interactive-small', 'interactive', 1)
+        self.append('batch-small-2', 'batch', 1)
+        self.assertEqual(self.scheduler.depths(),
+          {'interactive': 2, 'batch': 3})
+
+        self.assertEqual(self.pop_all(), ['interactive-small',
+          'interactive-large', 'batch-small', 'batch-small-2',
+          'batch-large'])
+
+    def test_old_jobs_are_promoted(self):
+        """Jobs waiting for longer than max_wait go first, oldest first."""
+        self.append('interactive', 'interactive', 1)
+        self.append('old', 'batch', 100, age=700)
+        self.append('older', 'batch', 1000, age=900)
+        self.append('recent', 'batch', 1, age=500)
+
+        self.assertEqual(self.pop_all(), ['older', 'old', 'interactive',
+          'recent'])
+
+
+# Stand-in for a Moses decoder which crashes on the first line saying "crash"
+# it ever sees and on every line saying "die"; the config argument is used as
+# marker file for the first crash.
+FLAKY_MOSES = """#!/bin/sh
+while read line; do
+  if [ "$line" = crash ] && [ ! -e "$2" ]; then touch "$2"; exit 1; fi
+  [ "$line" = die ] && exit 1
+  echo "$line" | tr a-z A-Z
+done
+"""
+
+
+class DecoderPoolTests(unittest.TestCase):
+    """
+    Tests that crashed decoders are restarted and requests retried once.
+    """
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.command = os.path.join(self.folder, 'moses')
+        handle = open(self.command, 'w')
+        handle.write(FLAKY_MOSES)
+        handle.close()
+        os.chmod(self.command, 0755)
+        self.pool = DecoderPool(self.command, os.path.join(self.folder,
+          'crashed'), 1)
+
+    def tearDown(self):
+        self.pool.stop()
+        for filename in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, filename))
+        os.rmdir(self.folder)
+
+    def test_crashed_decoder_is_restarted(self):
+        """A decoder dying mid-request is restarted and the lines retried."""
+        decoder = self.pool.decoders[0]
+        pid = decoder.process.pid
+
+        self.assertEqual(self.pool.translate([u'one', u'crash', u'two']),
+          [u'ONE', u'CRASH', u'TWO'])
+        self.assertNotEqual(decoder.process.pid, pid)
+        self.assertTrue(decoder.is_alive())
+
+    def test_retry_only_once(self):
+        """If the restarted decoder dies as well, the error is passed on."""
+        self.assertRaises(IOError, self.pool.translate, [u'one', u'die'])
+
+        # The dead decoder is restarted when it is handed out next.
+        self.assertEqual(self.pool.translate([u'three']), [u'THREE'])
+
+    def test_cancelled_translation_keeps_decoder(self):
+        """Cancelled translations return at once, the decoder is reused."""
+        decoder = self.pool.decoders[0]
+        pid = decoder.process.pid
+
+        @contextmanager
+        def cancelled(stop):
+            """Cancels the translation right away."""
+            stop()
+            yield
+
+        self.assertRaises(Cancelled, self.pool.translate, [u'one', u'two'],
+          None, cancelled)
+        self.assertEqual(self.pool.translate([u'three']), [u'THREE'])
+        self.assertEqual(decoder.process.pid, pid)
+
+    def test_stop_kills_decoders_ignoring_sigterm(self):
+        """Decoders which do not exit on SIGTERM are killed."""
+        command = os.path.join(self.folder, 'stubborn')
+        handle = open(command, 'w')
+        handle.write('#!/bin/sh\ntrap "" TERM\n'
+          'while true; do sleep 1; done\n')
+        handle.close()
+        os.chmod(command, 0755)
+
+        decoder = MosesDecoder(command, 'moses.ini')
+        decoder.STOP_TIMEOUT = 0.5
+        time.sleep(0.2)
+        started = time.time()
+        decoder.stop()
+        self.assertFalse(decoder.is_alive())
+        self.assertTrue(time.time() - started < 3)
+
+    def test_check_restarts_idle_decoders(self):
+        """Health checks restart idle decoders which have crashed."""
+        decoder = self.pool.decoders[0]
+        decoder.process.kill()
+        decoder.process.wait()
+
+        self.pool.check()
+        self.assertTrue(decoder.is_alive())
+
+
+class ModelRegistryTests(unittest.TestCase):
+    """
+    Tests that least recently used, idle models are evicted to stay within
+    the memory budget.
+    """
+    def setUp(self):
+        self.folder = mkdtemp()
+        command = os.path.join(self.folder, 'moses')
+        handle = open(command, 'w')
+        handle.write(FLAKY_MOSES)
+        handle.close()
+        os.chmod(command, 0755)
+
+        # Every decoder pretends to use 10 MB of memory.
+        self.original = MosesDecoder.memory
+        MosesDecoder.memory = lambda decoder: 10 * MEGABYTE
+
+        configs = dict([((pair, 'eng'), os.path.join(self.folder, pair))
+          for pair in ('deu', 'fra', 'spa', 'ita')])
+        self.registry = ModelRegistry(command, configs, 25 * MEGABYTE)
+
+    def tearDown(self):
+        self.registry.stop()
+        MosesDecoder.memory = self.original
+        os.remove(os.path.join(self.folder, 'moses'))
+        os.rmdir(self.folder)
+
+    def test_evict(self):
+        """Idle pools are evicted in LRU order, leased ones are skipped."""
+        self.assertEqual(self.registry.translate(('deu', 'eng'), [u'a']),
+          [u'A'])
+        self.registry.translate(('fra', 'eng'), [u'b'])
+        self.registry.translate(('deu', 'eng'), [u'c'])
+        self.assertEqual(self.registry.loaded(), [('fra', 'eng'),
+          ('deu', 'eng')])
+
+        # Loading a third model exceeds the budget, so the least recently
+        # used model is evicted.
+        self.registry.translate(('spa', 'eng'), [u'd'])
+        self.assertEqual(self.registry.loaded(), [('deu', 'eng'),
+          ('spa', 'eng')])
+        self.assertEqual(self.registry.memory(), 20 * MEGABYTE)
+
+        # Models in use are never evicted.
+        with self.registry.pool(('deu', 'eng')):
+            with self.registry.pool(('spa', 'eng')):
+                pass
+
+            self.registry.translate(('ita', 'eng'), [u'e'])
+            self.assertEqual(self.registry.loaded(), [('deu', 'eng'),
+              ('ita', 'eng')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,19 +3,477 @@ Baseline implementation for a MT Server Land "worker" server.
 
 Implements the basic "worker" interface.
 """
+import errno
 import logging
+import os
+import re
+import signal
 import stat
 
 from base64 import b64encode, b64decode
+from contextlib import contextmanager
 from google.protobuf.message import DecodeError
 from logging.handlers import RotatingFileHandler
-from multiprocessing import Process
+from multiprocessing import Process, Value, active_children, cpu_count
 from os import chmod, remove
-from time import sleep
+from time import sleep, time
 from random import random
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Event, Lock, RLock, Thread
 
 from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
+from workers.decoder import split_lines
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    XML-RPC request handler keeping HTTP/1.1 connections open, so that the
+    broker can send several calls over one persistent connection.
+
+    Idle connections are closed after timeout seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 60
+
+
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    XML-RPC server handling each incoming request in a separate thread.
+
+    This prevents slow calls like fetch_translation() on large messages from
+    blocking cheap status probes like is_alive() or is_ready().
+    """
+    daemon_threads = True
+
+    def __init__(self, addr, **kwargs):
+        kwargs.setdefault('requestHandler', KeepAliveRequestHandler)
+        SimpleXMLRPCServer.__init__(self, addr, **kwargs)
+
+
+# Maps SERVER_MODE values to the XML-RPC server class that implements them.
+SERVER_MODES = {
+  'single': SimpleXMLRPCServer,
+  'threaded': ThreadedXMLRPCServer,
+}
+
+
+MEGABYTE = 1024 * 1024
+
+# Scratch files written for translation requests into the message path, i.e.
+# $id.message, $id.source, $id.target and their sharded or partial variants,
+# and $id.prefix holding the target lines translated so far.  Request ids are
+# 32 digit hex numbers, other files in the message path are never touched.
+SCRATCH_FILE = re.compile(r'^(?P<request_id>[0-9a-f]{32})\.(\d+\.)?' \
+  r'(?P<kind>message|source|target|prefix)(\.part)?$')
+
+
+def available_memory():
+    """
+    Returns the memory available for new processes in bytes, as reported by
+    /proc/meminfo, or None if /proc is not available.
+
+    Kernels without MemAvailable report free memory plus page cache instead.
+    """
+    fields = {}
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                key, value = line.split(':', 1)
+                fields[key] = int(value.split()[0]) * 1024
+
+    except (IOError, ValueError):
+        return None
+
+    if 'MemAvailable' in fields:
+        return fields['MemAvailable']
+
+    return sum([fields.get(key, 0) for key in ('MemFree', 'Buffers',
+      'Cached')])
+
+
+def process_memory(pid):
+    """
+    Returns the resident set size of the given process and all of its
+    descendants in bytes, e.g. including Moses decoders started by a job.
+
+    Returns 0 if /proc is not available.
+    """
+    parents, sizes = {}, {}
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open('/proc/{0}/stat'.format(entry)) as stat_file:
+                # The command name may contain spaces, fields follow the ")".
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+            parents[int(entry)] = int(fields[1])
+            sizes[int(entry)] = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+        except (IOError, IndexError, ValueError):
+            continue
+
+    total, pids = 0, [pid]
+    while pids:
+        current = pids.pop()
+        total += sizes.get(current, 0)
+        pids.extend([child for child, parent in parents.items()
+          if parent == current])
+
+    return total
+
+
+def logging_locks():
+    """Returns the locks of the logging module and of all its handlers."""
+    handlers = [ref() for ref in logging._handlerList]
+    return [logging._lock] + [handler.lock for handler in handlers
+      if handler is not None and handler.lock is not None]
+
+
+def run_in_group(target, request_id, locks=()):
+    """
+    Runs target(request_id) as the leader of a new process group, so that
+    the job and all processes it starts, e.g. Moses decoders, can be killed
+    together.
+
+    The given locks have been held by the forking thread, which the job
+    process continues as, so they are released first.
+    """
+    for lock in reversed(locks):
+        lock.release()
+
+    os.setsid()
+    target(request_id)
+
+
+# Priority classes in scheduling order; requests can choose their class by
+# sending a "PRIORITY" key inside the TranslationRequestMessage packet_data.
+PRIORITY_CLASSES = ('interactive', 'batch')
+DEFAULT_PRIORITY = 'batch'
+
+
+class TranslationJob(object):
+    """
+    Book-keeping information for a single translation request on a worker.
+
+    A job is created in "queued" state without a process; the process is
+    only forked once the worker server assigns a free job slot to it.  Worker
+    servers sharing resources between jobs can run them as threads instead.
+    """
+    def __init__(self, request_id, priority=DEFAULT_PRIORITY, size=0):
+        """
+        Creates a new, queued TranslationJob for the given request id.
+
+        The size of a job is the number of lines of its source text, i.e.
+        the number of segments to translate.  The number of segments already
+        translated is shared with the job process, see report_progress().
+        """
+        self.request_id = request_id
+        self.priority = priority
+        self.size = size
+        self.process = None
+        self.submitted = time()
+        self.started = None
+        self.cancelled = Event()
+        self.cancel_callbacks = []
+        self.cancel_lock = Lock()
+        self.peak_memory = 0
+        self.deadline = None
+        self.killed = None
+        self.kill_reason = None
+        self.reaped = False
+        self.finished = None
+        self.deleted = False
+        self.completed = Value('i', 0)
+
+    def __repr__(self):
+        """Returns a String representation of the translation job."""
+        return '<TranslationJob {0} ({1})>'.format(self.request_id,
+          self.status())
+
+    def start(self, target, threaded=False):
+        """
+        Forks a new process running target(request_id) for this job.
+
+        If threaded is True, a thread is started instead of a process.
+        """
+        locks = []
+        if threaded:
+            self.process = Thread(target=target, args=(self.request_id,))
+            self.process.daemon = True
+
+        else:
+            # A process forked while another thread holds a logging lock
+            # would wait for it forever, so we hold all of them meanwhile.
+            locks = logging_locks()
+            self.process = Process(target=run_in_group,
+              args=(target, self.request_id, locks))
+
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            self.process.start()
+
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        self.started = time()
+
+    def status(self):
+        """
+        Returns one of "queued", "running" or "finished".
+        """
+        if self.process is None:
+            return 'queued'
+
+        elif self.is_alive():
+            return 'running'
+
+        return 'finished'
+
+    def memory(self):
+        """
+        Returns the resident set size of the job process and its children in
+        bytes and updates the job's peak memory usage.
+
+        Threaded jobs share the worker process and always report 0.
+        """
+        if not isinstance(self.process, Process) or not self.is_running():
+            return 0
+
+        current = process_memory(self.process.pid)
+        self.peak_memory = max(self.peak_memory, current)
+        return current
+
+    def progress(self, now):
+        """
+        Returns a dictionary describing the progress of the job: its status,
+        the number of completed and total segments, the seconds elapsed since
+        the job has been started and the estimated seconds remaining.
+
+        The estimate assumes that remaining segments are translated as fast
+        as completed ones; it is None as long as no segment is completed.
+        """
+        status = self.status()
+        completed = min(self.completed.value, self.size)
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or now) - self.started
+
+        # Handlers which do not report progress complete all segments at once.
+        if status == 'finished' and not self.is_cancelled():
+            completed = self.size
+
+        eta = None
+        if status == 'finished':
+            eta = 0.0
+
+        elif completed:
+            eta = elapsed * (self.size - completed) / completed
+
+        return {'status': status, 'completed': completed, 'total': self.size,
+          'elapsed': elapsed, 'eta': eta}
+
+    def is_running(self):
+        """Checks if the job process is currently running."""
+        return self.process is not None and self.process.is_alive()
+
+    def is_alive(self):
+        """
+        Checks if the job has not yet finished, i.e. queued or running.
+
+        Terminated jobs count as running until their process group has been
+        reaped and the reason why they have been killed has been recorded.
+        """
+        if self.killed and not self.reaped:
+            return True
+
+        return self.process is None or self.process.is_alive()
+
+    def is_overdue(self, now):
+        """Checks if the job has been running for longer than its deadline."""
+        return self.deadline is not None and self.started is not None \
+          and not self.is_cancelled() and now - self.started > self.deadline
+
+    def terminate(self, reason=None):
+        """
+        Terminates the process group of the job, if it has been started.  If
+        a reason is given, it is recorded in the job's message once the job
+        has been reaped.
+
+        Threads cannot be terminated, they have to check is_cancelled();
+        resources they may be blocked on are released by the callbacks
+        registered with on_cancel().
+        """
+        self.cancelled.set()
+        self.kill_reason = reason
+
+        # Finished jobs are not signalled, their process group id may
+        # already have been reused.
+        if self.is_running():
+            self.killed = time()
+            self.signal(signal.SIGTERM)
+
+        with self.cancel_lock:
+            for callback in self.cancel_callbacks:
+                callback()
+
+    def kill(self):
+        """
+        Kills all remaining processes in the process group of the job, e.g.
+        decoders ignoring SIGTERM or orphaned by the job process.
+        """
+        self.signal(signal.SIGKILL)
+        if isinstance(self.process, Process):
+            self.process.join()
+
+    def signal(self, signum):
+        """Sends the given signal to the process group of the job."""
+        if not isinstance(self.process, Process) or self.process.pid is None:
+            return
+
+        try:
+            os.killpg(self.process.pid, signum)
+
+        except OSError, msg:
+            if msg.errno != errno.ESRCH:
+                raise
+
+    def is_cancelled(self):
+        """Checks if the job has been terminated."""
+        return self.cancelled.is_set()
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """
+        Context manager calling callback() if the job is terminated while
+        the block runs, or right away if it has already been terminated.
+
+        Threaded jobs use this to stop decoders or close connections they
+        are reading from, so that they notice the termination.
+        """
+        with self.cancel_lock:
+            if self.is_cancelled():
+                callback()
+
+            self.cancel_callbacks.append(callback)
+
+        try:
+            yield
+
+        finally:
+            with self.cancel_lock:
+                self.cancel_callbacks.remove(callback)
+
+
+class ProgressCollector(object):
+    """
+    Collects the target lines of a job translated in several parts at the
+    same time, e.g. shards or service batches, and reports its progress.
+
+    Each translated line completes a segment right away, but lines are only
+    added to the translated prefix once all lines before them have been
+    translated, so that the prefix stays contiguous.
+    """
+    def __init__(self, report, parts):
+        """
+        Creates a collector for the given list of parts, each one a list of
+        source lines.  Progress is passed on as report(lines, completed).
+        """
+        self.report = report
+        self.sizes = [len(part) for part in parts]
+        self.received = [[] for _ in parts]
+        self.current = 0
+        self.flushed = 0
+        self.lock = Lock()
+
+    def add(self, index, number, line):
+        """
+        Adds the translated line with the given number of the given part.
+
+        Lines already added are ignored, so that parts can be translated
+        again after a decoder has crashed.
+        """
+        with self.lock:
+            received = self.received[index]
+            if number < len(received):
+                return
+
+            received.append(line)
+            lines = []
+            while self.current < len(self.sizes):
+                lines.extend(self.received[self.current][self.flushed:])
+                self.flushed = len(self.received[self.current])
+                if self.flushed < self.sizes[self.current]:
+                    break
+
+                self.current += 1
+                self.flushed = 0
+
+            self.report(lines, 1)
+
+
+class JobScheduler(object):
+    """
+    Orders queued translation jobs for execution.
+
+    Jobs are ordered by priority class first and then by size, so that short
+    requests are started before long ones.  Jobs which have been waiting for
+    more than max_wait seconds are started first, in arrival order, so that
+    large batch jobs cannot starve.
+    """
+    def __init__(self, max_wait=600):
+        """
+        Creates a new, empty JobScheduler instance.
+        """
+        self.max_wait = max_wait
+        self.queued = []
+
+    def __len__(self):
+        """Returns the number of queued jobs."""
+        return len(self.queued)
+
+    def __contains__(self, request_id):
+        """Checks if a job with the given request id is queued."""
+        return any([j.request_id == request_id for j in self.queued])
+
+    def append(self, job):
+        """Adds the given job to the queue."""
+        self.queued.append(job)
+
+    def remove(self, request_id):
+        """Removes the job with the given request id from the queue."""
+        self.queued = [j for j in self.queued if j.request_id != request_id]
+
+    def clear(self):
+        """Removes all jobs from the queue."""
+        self.queued = []
+
+    def _sort_key(self, job, now):
+        """Returns the key by which queued jobs are ordered."""
+        if now - job.submitted > self.max_wait:
+            return (0, job.submitted)
+
+        return (1, PRIORITY_CLASSES.index(job.priority), job.size,
+          job.submitted)
+
+    def pop(self):
+        """Removes and returns the next job to be started."""
+        now = time()
+        job = min(self.queued, key=lambda j: self._sort_key(j, now))
+        self.queued.remove(job)
+        return job
+
+    def depths(self):
+        """Returns a dictionary mapping priority classes to queue depth."""
+        result = dict([(p, 0) for p in PRIORITY_CLASSES])
+        for job in self.queued:
+            result[job.priority] += 1
+
+        return result
 
 
 # pylint: disable-msg=R0922
@@ -29,12 +487,35 @@ class AbstractWorkerServer(object):
     finished = False
     server = None
     jobs = {}
+    jobs_lock = None
+    pending = None
+    # pylint: disable-msg=C0103
+    MAX_JOBS = None
+    MAX_WAIT = 600
+    MIN_MEMORY = None
+    JOB_DEADLINE = None
+    KILL_GRACE = 5
+    JOB_TTL = 7 * 24 * 60 * 60
+    CLEANUP_INTERVAL = 60
+
+    # If True, translation jobs are run as threads inside the worker process.
+    threaded_jobs = False
 
-    def __init__(self, host, port, logfile, message_path, min_memory=None):
+    # Seconds handle_request() waits before queued jobs are re-scheduled.
+    poll_interval = 1.0
+
+    def __init__(self, host, port, logfile, message_path, min_memory=None,
+      server_mode='single'):
         """
         Creates a new WorkerServer instance serving from host:port.
+
+        The server_mode parameter selects the XML-RPC server implementation,
+        see SERVER_MODES for available choices.  If min_memory is given, new
+        jobs are only started as long as at least min_memory megabytes of
+        system memory remain available, see schedule_jobs().
         """
         self.message_path = message_path
+        self.MIN_MEMORY = min_memory
 
         # pylint: disable-msg=C0103
         LOG_LEVEL = logging.DEBUG
@@ -58,13 +539,38 @@ class AbstractWorkerServer(object):
         mode |= stat.S_IROTH | stat.S_IWOTH
         chmod(LOG_FILENAME, mode)
         
-        self.server = SimpleXMLRPCServer((host, port), allow_none=True)
-        self.LOGGER.info("{0} listening on {1}:{2}".format(self.__name__,
-          host, port))
+        server_class = SERVER_MODES[server_mode]
+        self.server = server_class((host, port), allow_none=True)
+        self.server.timeout = self.poll_interval
+        self.LOGGER.info("{0} listening on {1}:{2} ({3})".format(
+          self.__name__, host, port, server_mode))
         self.LOGGER.info("{0}.message_path set to {1}".format(self.__name__,
           self.message_path))
 
+        # The job table may be accessed from several request handler threads
+        # at the same time, hence all access has to hold self.jobs_lock.
         self.jobs = {}
+        self.jobs_lock = RLock()
+
+        # Request handler threads of threaded servers must not fork job
+        # processes, they only queue jobs and wake up the serving loop which
+        # starts them, see start_worker().
+        self.threaded_server = isinstance(self.server, ThreadingMixIn)
+        self.wakeup = Event()
+
+        # Translation requests waiting for a free job slot.
+        self.pending = JobScheduler(self.MAX_WAIT)
+        self.MAX_JOBS = cpu_count()
+
+        # Largest resident size observed for any job, used to estimate the
+        # memory needed by jobs which have not yet loaded their models.
+        self.job_memory = 0
+        self.deferred = 0
+        self.deferrals = 0
+
+        # Statistics of the periodic clean up, see clean_up().
+        self.cleaned = time()
+        self.cleanup_stats = {'evicted': 0, 'files': 0, 'reclaimed': 0.0}
 
         # Register worker interface functions.
         self.server.register_function(self.stop_worker, "stop_worker")
@@ -80,19 +586,70 @@ class AbstractWorkerServer(object):
         self.server.register_function(self.delete_translation,
           "delete_translation")
         self.server.register_function(self.language_pairs, "language_pairs")
+        self.server.register_function(self.job_status, "job_status")
+        self.server.register_function(self.queue_status, "queue_status")
+        self.server.register_function(self.queue_depths, "queue_depths")
+        self.server.register_function(self.memory_status, "memory_status")
+        self.server.register_function(self.cleanup_status, "cleanup_status")
+        self.server.register_function(self.job_statuses, "job_statuses")
+        self.server.register_function(self.fetch_translations,
+          "fetch_translations")
+        self.server.register_function(self.delete_translations,
+          "delete_translations")
+        self.server.register_function(self.job_progress, "job_progress")
+        self.server.register_function(self.fetch_partial_translation,
+          "fetch_partial_translation")
+
+        # Clients may also batch several calls into one system.multicall.
+        self.server.register_multicall_functions()
 
     @staticmethod
     def usage():
         """
         Returns usage information, e.g. for additional parameters, etc.
         """
-        return ()
+        return ('MAX_JOBS=max_number_of_parallel_jobs',
+          'MAX_WAIT=seconds_before_queued_jobs_are_started_first',
+          'MIN_MEMORY=megabytes_to_keep_available (optional)',
+          'JOB_DEADLINE=max_seconds_per_job (optional)',
+          'JOB_TTL=seconds_before_unfetched_results_are_removed')
 
     def parse_args(self, args):
         """
         Parses the given args list and sets worker specific paramters.
+
+        Sub-classes should call this implementation to support the common
+        parameters shared by all worker servers.
         """
-        return True
+        for arg in args:
+            try:
+                key, value = arg.split('=')
+
+            except ValueError:
+                continue
+
+            if key == 'MAX_JOBS':
+                print "Setting MAX_JOBS={0}".format(value)
+                self.MAX_JOBS = int(value)
+
+            elif key == 'MAX_WAIT':
+                print "Setting MAX_WAIT={0}".format(value)
+                self.MAX_WAIT = int(value)
+                self.pending.max_wait = self.MAX_WAIT
+
+            elif key == 'MIN_MEMORY':
+                print "Setting MIN_MEMORY={0}".format(value)
+                self.MIN_MEMORY = int(value)
+
+            elif key == 'JOB_DEADLINE':
+                print "Setting JOB_DEADLINE={0}".format(value)
+                self.JOB_DEADLINE = int(value)
+
+            elif key == 'JOB_TTL':
+                print "Setting JOB_TTL={0}".format(value)
+                self.JOB_TTL = int(value)
+
+        return self.MAX_JOBS > 0
 
     def start_worker(self):
         """
@@ -101,8 +658,234 @@ class AbstractWorkerServer(object):
         self.LOGGER.info("Started {0} instance, serving via XML-RPC.".format(
           self.__name__))
 
+        # Threaded servers handle requests in the background, so that this
+        # loop is the only thread forking job processes.
+        serving = None
+        if self.threaded_server:
+            serving = Thread(target=self.server.serve_forever,
+              args=(self.poll_interval,))
+            serving.daemon = True
+            serving.start()
+
         while not self.finished:
-            self.server.handle_request()
+            if serving:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+            else:
+                self.server.handle_request()
+
+            self.check_jobs()
+            self.schedule_jobs()
+            self.maintain()
+
+            if time() - self.cleaned > self.CLEANUP_INTERVAL:
+                self.clean_up()
+
+        if serving:
+            self.server.shutdown()
+
+    def maintain(self):
+        """
+        Performs periodic maintenance tasks, called from the serving loop.
+        """
+        pass
+
+    def check_jobs(self):
+        """
+        Terminates jobs running past their deadline, kills what is left of
+        terminated jobs after KILL_GRACE seconds and records why they have
+        been killed.
+        """
+        now = time()
+        with self.jobs_lock:
+            jobs = self.jobs.values()
+
+        for job in jobs:
+            if job.is_overdue(now):
+                self.LOGGER.warning('Job "{0}" exceeded its deadline of ' \
+                  '{1} seconds.'.format(job.request_id, job.deadline))
+                job.terminate('deadline of {0} seconds exceeded'.format(
+                  job.deadline))
+
+            if job.killed and not job.reaped:
+                # Threads cannot be killed, we wait until they have stopped.
+                if job.is_running() and (not isinstance(job.process,
+                  Process) or now - job.killed < self.KILL_GRACE):
+                    continue
+
+                self.reap(job)
+
+    def reap(self, job):
+        """
+        Kills what is left of the given terminated job and records why it
+        has been killed.
+        """
+        job.kill()
+        if job.kill_reason:
+            self.record_kill(job)
+        job.reaped = True
+
+    def clean_up(self):
+        """
+        Evicts finished jobs whose results have not been fetched within
+        JOB_TTL seconds and deleted jobs, reaps finished child processes and
+        removes scratch files no longer needed.
+
+        Scratch files of requests unknown to this worker server are only
+        removed once they are older than JOB_TTL, as the message path may be
+        shared with other worker servers.
+        """
+        now = time()
+        self.cleaned = now
+
+        # Joins finished job processes, so that no zombies are left behind.
+        active_children()
+
+        evicted = []
+        with self.jobs_lock:
+            for request_id, job in self.jobs.items():
+                if job.is_alive():
+                    continue
+
+                if job.finished is None:
+                    job.finished = now
+
+                if job.deleted or now - job.finished > self.JOB_TTL:
+                    del self.jobs[request_id]
+                    evicted.append(request_id)
+
+            jobs = dict(self.jobs)
+
+        files, reclaimed = 0, 0
+        for filename in os.listdir(self.message_path):
+            match = SCRATCH_FILE.match(filename)
+            if not match:
+                continue
+
+            path = os.path.join(self.message_path, filename)
+            request_id = match.group('request_id')
+            job = jobs.get(request_id)
+            try:
+                if job is None:
+                    if request_id not in evicted and \
+                      now - os.path.getmtime(path) <= self.JOB_TTL:
+                        continue
+
+                # Source and target files of known jobs are only needed as
+                # long as the job is running.
+                elif match.group('kind') == 'message' or job.is_alive():
+                    continue
+
+                size = os.path.getsize(path)
+                remove(path)
+                files += 1
+                reclaimed += size
+
+            except OSError:
+                continue
+
+        self.cleanup_stats['evicted'] += len(evicted)
+        self.cleanup_stats['files'] += files
+        self.cleanup_stats['reclaimed'] += reclaimed
+        if evicted or files:
+            self.LOGGER.info('Evicted {0} job(s), removed {1} file(s) ' \
+              'reclaiming {2} bytes.'.format(len(evicted), files, reclaimed))
+
+    def cleanup_status(self):
+        """
+        Returns a dictionary with the number of evicted jobs and removed
+        scratch files and the number of reclaimed bytes since the worker
+        server has been started, as well as the current number of jobs.
+
+        Reclaimed bytes are given as a float, as XML-RPC integers are limited
+        to 32 bits.
+        """
+        with self.jobs_lock:
+            stats = dict(self.cleanup_stats)
+            stats['jobs'] = len(self.jobs)
+
+        return stats
+
+    def record_kill(self, job):
+        """
+        Adds the reason why the given job has been killed to the packet data
+        of its message, using the "KILLED" key.
+        """
+        filename = '{0}/{1}.message'.format(self.message_path,
+          job.request_id)
+        try:
+            handle = open(filename, 'rb')
+            message = TranslationRequestMessage()
+            message.ParseFromString(handle.read())
+            handle.close()
+
+            keyvalue = message.packet_data.add()
+            keyvalue.key = 'KILLED'
+            keyvalue.value = job.kill_reason
+
+            handle = open('{0}.part'.format(filename), 'wb')
+            handle.write(message.SerializeToString())
+            handle.close()
+            os.rename('{0}.part'.format(filename), filename)
+
+        except (IOError, OSError, DecodeError):
+            self.LOGGER.error('Could not record kill reason for request ' \
+              '"{0}".'.format(job.request_id))
+
+    def schedule_jobs(self):
+        """
+        Starts queued translation jobs as long as there are free job slots
+        and, if MIN_MEMORY is set, enough available memory.
+        """
+        with self.jobs_lock:
+            running = [j for j in self.jobs.values() if j.is_running()]
+
+            self.deferred = 0
+            while len(self.pending) and len(running) < self.MAX_JOBS:
+                if not self.has_memory(running):
+                    self.deferred = len(self.pending)
+                    self.deferrals += 1
+                    self.LOGGER.info('Deferring {0} job(s), not enough ' \
+                      'memory available.'.format(self.deferred))
+                    break
+
+                job = self.pending.pop()
+                job.start(self.handle_translation, self.threaded_jobs)
+                running.append(job)
+                self.LOGGER.info('Started translation job "{0}"'.format(
+                  job.process))
+
+    def memory_headroom(self, running):
+        """
+        Returns the number of bytes which may still be used before available
+        memory drops below MIN_MEMORY, or None if this is not limited.
+
+        Running jobs which have not yet reached the largest job size seen so
+        far are expected to grow to it, so their difference is reserved.
+        """
+        available = available_memory()
+        if not self.MIN_MEMORY or available is None:
+            return None
+
+        for job in running:
+            self.job_memory = max(self.job_memory, job.memory(),
+              job.peak_memory)
+
+        reserved = sum([max(0, self.job_memory - job.peak_memory)
+          for job in running if isinstance(job.process, Process)])
+        return available - reserved - self.MIN_MEMORY * MEGABYTE
+
+    def has_memory(self, running):
+        """
+        Checks if another job can be started without available memory
+        dropping below MIN_MEMORY.  A single job is always allowed to run.
+        """
+        if not running:
+            return True
+
+        headroom = self.memory_headroom(running)
+        return headroom is None or headroom >= self.job_memory
 
     def stop_worker(self):
         """
@@ -111,14 +894,58 @@ class AbstractWorkerServer(object):
         self.LOGGER.info('Stopped {0} instance.'.format(self.__name__))
         if not self.finished:
             self.finished = True
+            self.wakeup.set()
+
+            with self.jobs_lock:
+                self.pending.clear()
+                running = [j for j in self.jobs.values() if j.is_running()]
+
+            for job in running:
+                job.terminate('worker server stopped')
+
+            # Processes ignoring SIGTERM are killed after KILL_GRACE seconds.
+            stopped = time()
+            for job in running:
+                if isinstance(job.process, Process):
+                    job.process.join(max(0, stopped + self.KILL_GRACE -
+                      time()))
+                self.reap(job)
+
+    def is_cancelled(self, request_id):
+        """
+        Checks if the given translation request has been terminated.
+
+        Threaded jobs use this to stop processing deleted requests.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        return job is None or job.is_cancelled()
+
+    @contextmanager
+    def on_cancel(self, request_id, callback):
+        """
+        Context manager calling callback() if the given translation request
+        is terminated while the block runs, see TranslationJob.on_cancel().
+
+        Threaded jobs use this to release what they are blocked on when
+        their request is deleted or exceeds its deadline.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        if job is None:
+            callback()
+            yield
+            return
 
-            for proc in self.jobs.values():
-                if proc.is_alive():
-                    proc.terminate()
+        with job.on_cancel(callback):
+            yield
 
     def list_requests(self):
         """Returns a list of all registered translation requests."""
-        return self.jobs.keys()
+        with self.jobs_lock:
+            return self.jobs.keys()
 
     def is_alive(self):
         """
@@ -128,12 +955,13 @@ class AbstractWorkerServer(object):
 
     def is_busy(self):
         """
-        Checks if the worker server is currently busy.
+        Checks if the worker server is currently busy, i.e. if all job slots
+        are in use.  New requests are still accepted and queued.
         """
-        if any([p.is_alive() for p in self.jobs.values()]):
-            return True
+        with self.jobs_lock:
+            running = len([j for j in self.jobs.values() if j.is_running()])
 
-        return False
+        return running >= self.MAX_JOBS
 
     def is_ready(self, request_id):
         """
@@ -141,13 +969,16 @@ class AbstractWorkerServer(object):
 
         Returns False if request_id is invalid.
         """
-        if not request_id in self.jobs.keys():
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        if job is None:
             self.LOGGER.info('Unknown request id "{0}" queried.'.format(
               request_id))
 
             return False
 
-        return not self.jobs[request_id].is_alive()
+        return not job.is_alive()
 
     def is_valid(self, request_id):
         """
@@ -155,7 +986,158 @@ class AbstractWorkerServer(object):
 
         Returns False if request_id is invalid.
         """
-        return request_id in self.jobs.keys()
+        with self.jobs_lock:
+            return request_id in self.jobs
+
+    def job_status(self, request_id):
+        """
+        Returns the status of a translation request, i.e. one of "queued",
+        "running" or "finished".
+
+        Returns "unknown" if request_id is invalid.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        if job is None:
+            return 'unknown'
+
+        return job.status()
+
+    def job_statuses(self, request_ids):
+        """
+        Returns a dictionary mapping each of the given request ids to its
+        status, see job_status().
+        """
+        return dict([(request_id, self.job_status(request_id))
+          for request_id in request_ids])
+
+    def job_progress(self, request_id):
+        """
+        Returns a dictionary describing the progress of a translation
+        request, see TranslationJob.progress().
+
+        Returns {'status': 'unknown'} if request_id is invalid.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        if job is None:
+            return {'status': 'unknown'}
+
+        return job.progress(time())
+
+    def report_progress(self, request_id, lines, completed=None):
+        """
+        Records that the given target lines have been appended to the
+        translated prefix of a translation request; completed is the number
+        of newly translated segments, by default the number of lines.
+
+        Called by handle_translation() implementations from the job process
+        or thread, see ProgressCollector for jobs translated in parts.
+        """
+        # Job processes are forked while holding jobs_lock, so their copy of
+        # the lock may never be released; a single lookup is atomic anyway.
+        job = self.jobs.get(request_id)
+
+        if job is None:
+            return
+
+        if lines:
+            handle = open('{0}/{1}.prefix'.format(self.message_path,
+              request_id), 'a')
+            handle.write(u''.join([u'{0}\n'.format(line)
+              for line in lines]).encode('utf-8'))
+            handle.close()
+
+        with job.completed.get_lock():
+            job.completed.value += len(lines) if completed is None \
+              else completed
+
+    def fetch_partial_translation(self, request_id):
+        """
+        Retrieves the target text translated so far for the given request id,
+        i.e. the complete target text once the request is finished.
+
+        Returns the UTF-8 encoded target text in base64 encoding, like
+        fetch_translation(), or False if request_id is invalid or the text is
+        not available.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        if job is None:
+            self.LOGGER.info('Unknown request id "{0}" queried.'.format(
+              request_id))
+
+            return False
+
+        try:
+            if job.is_alive():
+                filename = '{0}/{1}.prefix'.format(self.message_path,
+                  request_id)
+                if not os.path.exists(filename):
+                    return b64encode('')
+
+                handle = open(filename, 'rb')
+                prefix = handle.read()
+                handle.close()
+
+                # The last line may still be being written.
+                return b64encode(prefix[:prefix.rfind('\n') + 1])
+
+            handle = open('{0}/{1}.message'.format(self.message_path,
+              request_id), 'rb')
+            message = TranslationRequestMessage()
+            message.ParseFromString(handle.read())
+            handle.close()
+
+            return b64encode(message.target_text.encode('utf-8'))
+
+        except (IOError, DecodeError):
+            return False
+
+        return "ERROR"
+
+    def queue_status(self):
+        """
+        Returns a dictionary describing job slot usage of the worker server.
+        """
+        with self.jobs_lock:
+            running = len([j for j in self.jobs.values() if j.is_running()])
+            return {'slots': self.MAX_JOBS, 'running': running,
+              'queued': len(self.pending)}
+
+    def queue_depths(self):
+        """
+        Returns a dictionary mapping priority classes to the number of jobs
+        queued in the respective class.
+        """
+        with self.jobs_lock:
+            return self.pending.depths()
+
+    def memory_status(self):
+        """
+        Returns a dictionary describing memory usage of the worker server,
+        sizes are given in megabytes.
+
+        Headroom is the memory left before MIN_MEMORY is reached, None if
+        no MIN_MEMORY is set; deferred is the number of queued jobs held back
+        for lack of memory and deferrals counts how often this happened.
+        """
+        with self.jobs_lock:
+            running = [j for j in self.jobs.values() if j.is_running()]
+            headroom = self.memory_headroom(running)
+            jobs = dict([(j.request_id, j.memory() / MEGABYTE)
+              for j in running])
+            deferred, deferrals = self.deferred, self.deferrals
+
+        available = available_memory()
+        return {'available': None if available is None else
+          available / MEGABYTE, 'min_memory': self.MIN_MEMORY,
+          'headroom': None if headroom is None else headroom / MEGABYTE,
+          'job_memory': self.job_memory / MEGABYTE, 'jobs': jobs,
+          'deferred': deferred, 'deferrals': deferrals}
 
     def start_translation(self, serialized):
         """
@@ -163,13 +1145,39 @@ class AbstractWorkerServer(object):
 
         Writes out a serialized version of the TranslationRequestMessage to
         the worker server's output folder.  Returns True if successful, False
-        when an error occurs.
+        when an error occurs or a request with the same id already exists.
         """
         try:
             # Create new TranslationRequestMessage object and load serialized.
             message = TranslationRequestMessage()
             message.ParseFromString(b64decode(serialized))
 
+            priority = DEFAULT_PRIORITY
+            deadline = self.JOB_DEADLINE
+            for keyvalue in message.packet_data:
+                if keyvalue.key == 'PRIORITY' and \
+                  keyvalue.value in PRIORITY_CLASSES:
+                    priority = str(keyvalue.value)
+
+                # Requests may ask for a shorter deadline than JOB_DEADLINE.
+                elif keyvalue.key == 'DEADLINE' and \
+                  keyvalue.value.isdigit() and int(keyvalue.value) > 0:
+                    deadline = min(int(keyvalue.value),
+                      deadline or int(keyvalue.value))
+
+            # The job is registered before its message file is written, so
+            # that a second request with the same id cannot overwrite it.
+            job = TranslationJob(message.request_id, priority,
+              len(split_lines(message.source_text)))
+            job.deadline = deadline
+            with self.jobs_lock:
+                if message.request_id in self.jobs:
+                    self.LOGGER.error('Translation request "{0}" already ' \
+                      'exists!'.format(message.request_id))
+                    return False
+
+                self.jobs[message.request_id] = job
+
             # Write serialized translation request message to file.
             handle = open('{0}/{1}.message'.format(self.message_path,
               message.request_id), 'w')
@@ -179,21 +1187,30 @@ class AbstractWorkerServer(object):
             self.LOGGER.info('Created new translation request "{0}".'.format(
               message.request_id))
 
-            # Start up translation process for the new request object.
-            proc = Process(target=self.handle_translation,
-              args=(message.request_id,))
-            proc.start()
-            self.jobs[message.request_id] = proc
-            self.LOGGER.info('Started translation job "{0}"'.format(proc))
+            # Queue the new request, it is started once a job slot is free.
+            with self.jobs_lock:
+                self.pending.append(job)
 
-        except (IOError, DecodeError):
+            self.LOGGER.info('Queued translation job "{0}".'.format(
+              message.request_id))
+            if self.threaded_server:
+                self.wakeup.set()
+
+            else:
+                self.schedule_jobs()
+
+        except IOError:
             self.LOGGER.error('Could not start translation job!')
 
-            if message.request_id in self.jobs.keys():
-                self.jobs.pop(message.request_id)
+            with self.jobs_lock:
+                self.jobs.pop(message.request_id, None)
 
             return False
 
+        except DecodeError:
+            self.LOGGER.error('Could not start translation job!')
+            return False
+
         return True
 
     def fetch_translation(self, request_id):
@@ -203,14 +1220,17 @@ class AbstractWorkerServer(object):
         Returns "ERROR" if request_id is invalid or "NOT_READY" if the
         translation request is not yet ready.
         """
-        if not request_id in self.jobs.keys():
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+        if job is None:
             self.LOGGER.info('Unknown request id "{0}" queried.'.format(
               request_id))
 
             return b64encode("ERROR")
 
-        # Check if the given request is still being processed.
-        if self.jobs[request_id].is_alive():
+        # Check if the given request is still queued or being processed.
+        if job.is_alive():
             return b64encode("NOT_READY")
 
         self.LOGGER.debug("Translation requests: {0}".format(
@@ -230,24 +1250,61 @@ class AbstractWorkerServer(object):
 
         return b64encode("ERROR")
 
+    def fetch_translations(self, request_ids, delete=False):
+        """
+        Returns a dictionary mapping each of the given request ids to its
+        translation result, encoded as by fetch_translation().
+
+        If delete is True, results are deleted from the worker server once
+        they have been fetched.
+        """
+        failed = (b64encode("ERROR"), b64encode("NOT_READY"))
+        results = {}
+        for request_id in request_ids:
+            results[request_id] = self.fetch_translation(request_id)
+            if delete and results[request_id] not in failed:
+                self.delete_translation(request_id)
+
+        return results
+
     def delete_translation(self, request_id):
         """
         Deletes a translation request from the worker server.
 
         Returns True if the translation request could be deleted successfully.
         """
-        if not request_id in self.jobs.keys():
+        with self.jobs_lock:
+            job = self.jobs.get(request_id)
+
+            # Queued jobs are simply dropped from the queue and job table.
+            if job is not None and request_id in self.pending:
+                self.pending.remove(request_id)
+                self.jobs.pop(request_id)
+
+        if job is None or job.deleted:
             self.LOGGER.info('Unknown request id "{0}" queried.'.format(
               request_id))
 
             return False
 
-        self.jobs[request_id].terminate()
+        # Deleted jobs are evicted from the job table by clean_up().
+        job.deleted = True
+        job.terminate()
         self.LOGGER.info('Terminated request "{0}".'.format(request_id))
 
         remove('{0}/{1}.message'.format(self.message_path, request_id))
         return True
 
+    def delete_translations(self, request_ids):
+        """
+        Deletes the given translation requests from the worker server.
+
+        Returns a dictionary mapping each request id to True if it could be
+        deleted successfully.
+        """
+        return dict([(request_id, self.delete_translation(request_id))
+          for request_id in request_ids])
+
     def handle_translation(self, request_id):
         """
         Raises NotImplemented exception, has to be implemented in sub-classes.
@@ -287,8 +1344,8 @@ class DummyWorker(AbstractWorkerServer):
         self.LOGGER.info("Sleeping for {0} seconds...".format(interval))
         sleep(interval)
 
-        # The dummy implementation takes the source text from /tmp/$id.source
-        # and writes an upper-cased version of that text to /tmp/$id.target.
+        # The dummy implementation takes the source text from the request's
+        # message file and writes an upper-cased version of that text back.
 
         self.LOGGER.debug("Finalizing result for request {0}".format(
           request_id))
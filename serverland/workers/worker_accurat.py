@@ -1,47 +1,60 @@
 """
 Implementation of a worker server that connects ACCURAT Moses instances.
 """
-from subprocess import Popen, PIPE
-from time import sleep
-
 from workers.worker import AbstractWorkerServer
-from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
+from workers.worker_moses import MosesWorker
 
 
-class AccuratWorker(AbstractWorkerServer):
+class AccuratWorker(MosesWorker):
     """
     Implementation of a worker server that connects ACCURAT Moses instances.
+
+    This is a special instance of the Moses worker, with pre-defined
+    knowledge about the ACCURAT Moses configurations.  To avoid memory
+    issues, the number of Moses processes running at the same time is
+    limited: jobs starting their own Moses processes, up to SHARDS each, run
+    at most N_BEST of them in total; persistent decoders are limited by
+    MOSES_DECODERS per language pair and by MODEL_MEMORY.  MIN_MEMORY may be
+    set in both cases.
     """
     __name__ = 'AccuratWorker'
     # pylint: disable-msg=C0103
-    N_BEST = None
+    MOSES_CMD = '/share/accurat/run/wmt10/bin/moses-irstlm/mosesdecoder' \
+      '/mosesdecoder/moses-cmd/src/moses'
+    MOSES_CONFIG = '/share/accurat/mtserver/accurat/{0}-{1}/moses.ini.bin'
 
     @staticmethod
     def usage():
         """
         Returns usage information, e.g. for additional parameters, etc.
         """
-        return ('N_BEST=max_number_of_parallel_jobs',)
+        return AbstractWorkerServer.usage() + (
+          'N_BEST=max_number_of_moses_processes (default: MAX_JOBS)',
+          'MOSES_DECODERS=persistent_decoders_per_pair (0 = start per job)',
+          'MODEL_MEMORY=megabytes_for_persistent_decoders (optional)',
+          'SHARDS=max_number_of_parallel_decoders_per_job (optional)',
+          'SHARD_LINES=min_number_of_lines_per_shard (optional)')
     
     def parse_args(self, args):
         """
         Parses the given args list and sets worker specific paramters.
         """
-        for arg in args:
-            try:
-                key, value = arg.split('=')
-            
-            except ValueError:
-                continue
-            
-            if key == 'N_BEST':
-                print "Setting N_BEST={0}".format(value)
-                self.N_BEST = int(value)
+        # N_BEST limits the number of Moses processes, see MAX_DECODERS.
+        args = ['MAX_DECODERS={0}'.format(arg.split('=', 1)[1])
+          if arg.startswith('N_BEST=') else arg for arg in args]
         
-        if not self.N_BEST:
-            return False
-        
-        return True
+        return super(AccuratWorker, self).parse_args(args)
+
+    def moses_configs(self):
+        """
+        Returns a dictionary mapping language pairs to Moses config files.
+        """
+        configs = {}
+        for source, target in self.language_pairs():
+            configs[(source, target)] = self.MOSES_CONFIG.format(
+              self.language_code(source), self.language_code(target))
+
+        return configs
     
     def language_pairs(self):
         """
@@ -64,81 +77,3 @@ class AccuratWorker(AbstractWorkerServer):
           'lav': 'lv', 'lit': 'lt', 'hrv': 'hr', 'est': 'et'
         }
         return mapping.get(iso639_3_code)
-
-    def is_busy(self):
-        """
-        Checks if the worker server is currently busy.
-        """
-        # pylint: disable-msg=E1101
-        if sum([p.is_alive() for p in self.jobs.values()]) >= self.N_BEST:
-            return True
-
-        return False
-
-    # pylint: disable-msg=E1002
-    def start_translation(self, serialized):
-        if self.is_busy():
-            return False
-        
-        super(AccuratWorker, self).start_translation(serialized)
-    
-    def handle_translation(self, request_id):
-        """
-        Translates text using the Accurat Moses SMT system.
-        """
-        handle = open('/tmp/{0}.message'.format(request_id), 'r+b')
-        message = TranslationRequestMessage()
-        message.ParseFromString(handle.read())
-        
-        # First, we write out the source text to file.
-        source = open('/tmp/{0}.source'.format(request_id), 'w')
-        source.write(message.source_text.encode('utf-8'))
-        
-        # Check if the last line ends with a line break, otherwise Moses
-        # I/O implementation does not accept the input!
-        if not message.source_text.endswith('\n'):
-            source.write('\n')
-        source.close()
-        
-        source_language = self.language_code(message.source_language)
-        target_language = self.language_code(message.target_language)
-        
-        # This is a special instance of the Moses worker, with pre-defined
-        # knowledge about the ACCURAT Moses configurations.  We use this
-        # approach to ensure that only one Moses process at a time can be
-        # started; by doing so, we can avoid memory issues.
-        MOSES_CMD = '/share/accurat/run/wmt10/bin/moses-irstlm/mosesdecoder' \
-          '/mosesdecoder/moses-cmd/src/moses'
-        
-        MOSES_CONFIG = '/share/accurat/mtserver/accurat/{0}-{1}/' \
-          'moses.ini.bin'.format(source_language, target_language)
-        
-        # Then, we invoke the Moses command reading from the source file
-        # and writing to a target file, also inside /tmp.  This blocks until
-        # the Moses process finishes.
-        shell_cmd = "{0} -f {1} < /tmp/{2}.source > /tmp/{3}.target".format(
-          MOSES_CMD, MOSES_CONFIG, request_id, request_id)
-        
-        proc_stdout, proc_stderr = Popen(shell_cmd, shell=True, stdout=PIPE,
-          stderr=PIPE).communicate()
-        
-        # Wait for some time to ensure file I/O is completed.
-        sleep(2)
-        
-        # We can now load the translation from the target file.
-        target = open('/tmp/{0}.target'.format(request_id), 'r')
-        target_text = target.read()
-        message.target_text = unicode(target_text, 'utf-8')
-        target.close()
-        
-        keyvalue = message.packet_data.add()
-        keyvalue.key = 'STDOUT'
-        keyvalue.value = proc_stdout
-        
-        keyvalue = message.packet_data.add()
-        keyvalue.key = 'STDERR'
-        keyvalue.value = proc_stderr
-        
-        handle.seek(0)
-        handle.write(message.SerializeToString())
-        handle.close()
@@ -2,13 +2,12 @@
 Implementation of a worker server that connects to Microsoft Translator.
 """
 import re
-import urllib2
 
-from workers.worker import AbstractWorkerServer
+from workers.service import ServiceWorker
 from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
 
 
-class BingWorker(AbstractWorkerServer):
+class BingWorker(ServiceWorker):
     """
     Implementation of a worker server that connects to Microsoft Translator.
     
@@ -20,7 +19,15 @@ class BingWorker(AbstractWorkerServer):
     
     """
     __name__ = 'BingWorker'
-    __batch__ = 100
+    # pylint: disable-msg=C0103
+    SERVICE_URL = 'http://api.microsofttranslator.com/v2/Http.svc/' \
+      'TranslateArray'
+    BATCH_BYTES = 10000
+    BATCH_LINES = 100
+    CHARS_PER_MONTH = 2000000
+
+    # Every line is wrapped into a <string xmlns="..."></string> element.
+    line_overhead = 90
 
     # TODO: update language pairs to all 39 base languages.
     def language_pairs(self):
@@ -52,12 +59,20 @@ class BingWorker(AbstractWorkerServer):
         }
         return mapping.get(iso639_3_code)
 
-    def _batch_translate(self, source, target, text):
-        """Translates a text using Microsoft Translator."""
+    def line_size(self, line):
+        """
+        Returns the number of bytes the given line adds to the XML request,
+        taking escaped ampersands into account.
+        """
+        return len(line.strip().replace(u'&', u'&amp;').encode('utf-8')) + \
+          self.line_overhead
+
+    def _batch_translate(self, source, target, lines):
+        """Translates a list of lines using Microsoft Translator."""
         app_id = '9259D297CB9F67680C259FD62734B07C0D528312'
 
         _texts = []
-        for source_line in text.split('\n'):
+        for source_line in lines:
             source_line = source_line.strip()
 
             _texts.append(u'<string xmlns="http://schemas.microsoft.com/' \
@@ -75,15 +90,10 @@ class BingWorker(AbstractWorkerServer):
 <To>{3}</To>
 </TranslateArrayRequest>""".format(app_id, source, _texts, target)
 
-        the_url = 'http://api.microsofttranslator.com/v2/Http.svc/' \
-          'TranslateArray'
+        the_url = self.SERVICE_URL
         the_header = {'User-agent': 'Mozilla/5.0', 'Content-Type': 'text/xml'}
 
-        opener = urllib2.build_opener(urllib2.HTTPHandler)
-        http_request = urllib2.Request(the_url, the_xml, the_header)
-        http_handle = opener.open(http_request)
-        content = http_handle.read()
-        http_handle.close()
+        content = self.http_post(the_url, the_xml, the_header)
 
         result_exp = re.compile('<TranslatedText>(.*?)</TranslatedText>',
           re.I|re.U|re.S)
@@ -106,31 +116,20 @@ class BingWorker(AbstractWorkerServer):
         Requires a Bing AppID as documented at MSDN:
         - http://msdn.microsoft.com/en-us/library/ff512421.aspx
         """
-        handle = open('/tmp/{0}.message'.format(request_id), 'r+b')
+        handle = open('{0}/{1}.message'.format(self.message_path,
+          request_id), 'r+b')
         message = TranslationRequestMessage()
         message.ParseFromString(handle.read())
 
         source = self.language_code(message.source_language)
         target = self.language_code(message.target_language)
 
-        _source_text = message.source_text.split('\n')
-
-        result = u''
-        batches = len(_source_text) / self.__batch__
-        for batch in range(batches):
-            _start = batch * self.__batch__
-            _end = _start + self.__batch__
-            text = u'\n'.join(_source_text[_start:_end])
-            result += self._batch_translate(source, target, text)
-            result += '\n'
-        
-        last_batch = len(_source_text) % self.__batch__
-        if last_batch:
-            text = u'\n'.join(_source_text[-last_batch:])
-            result += self._batch_translate(source, target, text)
-            result += '\n'
-
-        message.target_text = result
+        self.translate_message(message, source, target, request_id)
+
+        if self.is_cancelled(request_id):
+            handle.close()
+            return
+
         handle.seek(0)
         handle.write(message.SerializeToString())
         handle.close()
@@ -3,19 +3,25 @@ Implementation of a worker server that connects to Google Translate.
 """
 import re
 import urllib
-import urllib2
 
-from workers.worker import AbstractWorkerServer
+from workers.service import ServiceWorker
 from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
 
 
-class GoogleWorker(AbstractWorkerServer):
+class GoogleWorker(ServiceWorker):
     """
     Implementation of a worker server that connects to Google Translate.
     """
     __name__ = 'GoogleWorker'
     __splitter__ = '[[GOOGLE_SPLITTER]]'
-    __batch__ = 200
+    # pylint: disable-msg=C0103
+    SERVICE_URL = 'http://translate.google.com/translate_t'
+    BATCH_BYTES = 5000
+    BATCH_LINES = 100
+
+    # Every line is followed by a line break and a splitter token, which are
+    # URL-encoded together with the line, see line_size().
+    line_overhead = len(urllib.quote_plus('\n{0}\n'.format(__splitter__)))
 
     # TODO: update language pairs to all 66 base languages.
     def language_pairs(self):
@@ -53,18 +59,30 @@ class GoogleWorker(AbstractWorkerServer):
         }
         return mapping.get(iso639_3_code)
 
-    def _batch_translate(self, source, target, text):
-        """Translates a text using Google Translate."""
-        the_url = 'http://translate.google.com/translate_t'
+    def line_size(self, line):
+        """
+        Returns the number of bytes the given line adds to the URL-encoded
+        request; non-ASCII characters take up to three times as many bytes
+        as in UTF-8.
+        """
+        return len(urllib.quote_plus(line.strip().encode('utf-8'))) + \
+          self.line_overhead
+
+    def _batch_translate(self, source, target, lines):
+        """Translates a list of lines using Google Translate."""
+        # Insert splitter tokens to allow re-construction of original lines.
+        _source_text = []
+        for source_line in lines:
+            _source_text.append(source_line.strip())
+            _source_text.append(unicode(self.__splitter__))
+        text = u'\n'.join(_source_text)
+
+        the_url = self.SERVICE_URL
         the_data = urllib.urlencode({'js': 'n', 'sl': source, 'tl': target,
           'text': text.encode('utf-8')})
         the_header = {'User-agent': 'Mozilla/5.0'}
 
-        opener = urllib2.build_opener(urllib2.HTTPHandler)
-        http_request = urllib2.Request(the_url, the_data, the_header)
-        http_handle = opener.open(http_request)
-        content = http_handle.read()
-        http_handle.close()
+        content = self.http_post(the_url, the_data, the_header)
 
         result_exp = re.compile('<span id=result_box.*?>(.*)</span></div>',
           re.I|re.U|re.S)
@@ -106,35 +124,20 @@ class GoogleWorker(AbstractWorkerServer):
         """
         Handler connecting to the Google Translate service.
         """
-        handle = open('/tmp/{0}.message'.format(request_id), 'r+b')
+        handle = open('{0}/{1}.message'.format(self.message_path,
+          request_id), 'r+b')
         message = TranslationRequestMessage()
         message.ParseFromString(handle.read())
 
         source = self.language_code(message.source_language)
         target = self.language_code(message.target_language)
 
-        # Insert splitter tokens to allow re-construction of original lines.
-        _source_text = []
-        for source_line in message.source_text.split('\n'):
-            _source_text.append(source_line.strip())
-            _source_text.append(unicode(self.__splitter__))
+        self.translate_message(message, source, target, request_id)
+
+        if self.is_cancelled(request_id):
+            handle.close()
+            return
 
-        result = u''
-        batches = len(_source_text) / self.__batch__
-        for batch in range(batches):
-            _start = batch * self.__batch__
-            _end = _start + self.__batch__
-            text = u'\n'.join(_source_text[_start:_end])
-            result += self._batch_translate(source, target, text)
-            result += '\n'
-        
-        last_batch = len(_source_text) % self.__batch__
-        if last_batch:
-            text = u'\n'.join(_source_text[-last_batch:])
-            result += self._batch_translate(source, target, text)
-            result += '\n'
-
-        message.target_text = result
         handle.seek(0)
         handle.write(message.SerializeToString())
         handle.close()
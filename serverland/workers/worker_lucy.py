@@ -49,7 +49,8 @@ class LucyWorker(AbstractWorkerServer):
 
         Uses the XML-RPC server wrapper running at msv-3207.sb.dfki.de.
         """
-        handle = open('/tmp/{0}.message'.format(request_id), 'r+b')
+        handle = open('{0}/{1}.message'.format(self.message_path,
+          request_id), 'r+b')
         message = TranslationRequestMessage()
         message.ParseFromString(handle.read())
 
@@ -1,10 +1,12 @@
 """
 Implementation of a worker server that starts a Moses SMT system.
 """
-from subprocess import Popen, PIPE
-from time import sleep
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
-from workers.worker import AbstractWorkerServer
+from workers.decoder import ModelRegistry, MosesDecoder, split_lines, \
+  split_shards
+from workers.worker import AbstractWorkerServer, ProgressCollector
 from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
 
 
@@ -18,21 +20,38 @@ class MosesWorker(AbstractWorkerServer):
     MOSES_CONFIG = None
     MOSES_SOURCE = None
     MOSES_TARGET = None
+    MOSES_MODELS = ()
+    MOSES_DECODERS = 0
+    MODEL_MEMORY = None
+    SHARDS = 1
+    SHARD_LINES = 500
+    MAX_DECODERS = None
+    registry = None
     
     @staticmethod
     def usage():
         """
         Returns usage information, e.g. for additional parameters, etc.
         """
-        return ('MOSES_CMD=/path/to/moses/binary',
+        return AbstractWorkerServer.usage() + (
+          'MOSES_CMD=/path/to/moses/binary',
           'MOSES_CONFIG=/path/to/moses/config',
           'MOSES_SOURCE=source_language_iso639_3_code',
-          'MOSES_TARGET=target_language_iso639_3_code')
+          'MOSES_TARGET=target_language_iso639_3_code',
+          'MOSES_MODELS=src-tgt:/path/to/moses/config,... (optional)',
+          'MOSES_DECODERS=number_of_persistent_decoders (0 = start per job)',
+          'MODEL_MEMORY=megabytes_for_persistent_decoders (optional)',
+          'SHARDS=max_number_of_parallel_decoders_per_job (optional)',
+          'SHARD_LINES=min_number_of_lines_per_shard (optional)',
+          'MAX_DECODERS=max_number_of_moses_processes (default: MAX_JOBS)')
     
     def parse_args(self, args):
         """
         Parses the given args list and sets worker specific paramters.
         """
+        if not super(MosesWorker, self).parse_args(args):
+            return False
+
         for arg in args:
             try:
                 key, value = arg.split('=')
@@ -55,20 +74,122 @@ class MosesWorker(AbstractWorkerServer):
             elif key == 'MOSES_TARGET':
                 print "Setting MOSES_TARGET={0}".format(value)
                 self.MOSES_TARGET = value
+
+            elif key == 'MOSES_MODELS':
+                print "Setting MOSES_MODELS={0}".format(value)
+                models = []
+                for model in value.split(','):
+                    pair, config = model.split(':', 1)
+                    models.append((tuple(pair.split('-')), config))
+                self.MOSES_MODELS = tuple(models)
+
+            elif key == 'MOSES_DECODERS':
+                print "Setting MOSES_DECODERS={0}".format(value)
+                self.MOSES_DECODERS = int(value)
         
-        if not self.MOSES_CMD or not self.MOSES_CONFIG or \
-          not self.MOSES_SOURCE or not self.MOSES_TARGET:
+            elif key == 'MODEL_MEMORY':
+                print "Setting MODEL_MEMORY={0}".format(value)
+                self.MODEL_MEMORY = int(value)
+
+            elif key == 'SHARDS':
+                print "Setting SHARDS={0}".format(value)
+                self.SHARDS = int(value)
+
+            elif key == 'SHARD_LINES':
+                print "Setting SHARD_LINES={0}".format(value)
+                self.SHARD_LINES = int(value)
+
+            elif key == 'MAX_DECODERS':
+                print "Setting MAX_DECODERS={0}".format(value)
+                self.MAX_DECODERS = int(value)
+
+        if not self.MOSES_CMD or not self.moses_configs():
             return False
         
+        # Persistent decoders are shared between jobs which therefore have
+        # to run as threads inside the worker server process.
+        if self.MOSES_DECODERS > 0:
+            budget = None
+            if self.MODEL_MEMORY:
+                budget = self.MODEL_MEMORY * 1024 * 1024
+
+            self.registry = ModelRegistry(self.MOSES_CMD,
+              self.moses_configs(), budget, self.MOSES_DECODERS)
+            self.threaded_jobs = True
+
+        # Otherwise, each job starts up to SHARDS Moses processes of its own,
+        # so fewer jobs may run at the same time to stay within MAX_DECODERS.
+        else:
+            self.limit_decoders()
+        
         return True
 
+    def limit_decoders(self):
+        """
+        Limits SHARDS and MAX_JOBS so that jobs starting their own Moses
+        processes never run more than MAX_DECODERS of them at the same time.
+        """
+        decoders = self.MAX_DECODERS or self.MAX_JOBS
+        self.SHARDS = max(1, min(self.SHARDS, decoders))
+        self.MAX_JOBS = max(1, min(self.MAX_JOBS, decoders / self.SHARDS))
+        print "Running up to {0} job(s) with up to {1} Moses process(es) " \
+          "each".format(self.MAX_JOBS, self.SHARDS)
+
+    def moses_configs(self):
+        """
+        Returns a dictionary mapping language pairs to Moses config files.
+        """
+        configs = dict(self.MOSES_MODELS)
+        if self.MOSES_CONFIG and self.MOSES_SOURCE and self.MOSES_TARGET:
+            configs[(self.MOSES_SOURCE, self.MOSES_TARGET)] = \
+              self.MOSES_CONFIG
+
+        return configs
+
+    def shard_count(self, lines):
+        """
+        Returns the number of shards a document with the given number of
+        lines is split into; each shard has at least SHARD_LINES lines.
+        """
+        count = (lines + self.SHARD_LINES - 1) / self.SHARD_LINES
+        return max(1, min(self.SHARDS, count))
+
+    @staticmethod
+    def map_shards(function, shards):
+        """
+        Applies function to all shards in parallel, returns the results in
+        the original shard order.
+        """
+        if len(shards) == 1:
+            return [function(shards[0])]
+
+        pool = ThreadPool(len(shards))
+        try:
+            return pool.map(function, shards)
+
+        finally:
+            pool.close()
+
+    def maintain(self):
+        """
+        Restarts crashed persistent decoders, if any.
+        """
+        if self.registry:
+            self.registry.check()
+
+    def stop_worker(self):
+        """
+        Stops the event handler and terminates all persistent decoders.
+        """
+        super(MosesWorker, self).stop_worker()
+        if self.registry:
+            self.registry.stop()
+
     def language_pairs(self):
         """
         Returns a tuple of all supported language pairs for this worker.
         """
-        return (
-          (self.MOSES_SOURCE, self.MOSES_TARGET),
-        )
+        return tuple(self.moses_configs().keys())
 
     def language_code(self, iso639_3_code):
         """
@@ -82,41 +203,91 @@ class MosesWorker(AbstractWorkerServer):
         """
         Translates text using the Moses SMT system.
         """
-        handle = open('/tmp/{0}.message'.format(request_id), 'r+b')
+        handle = open('{0}/{1}.message'.format(self.message_path,
+          request_id), 'r+b')
         message = TranslationRequestMessage()
         message.ParseFromString(handle.read())
         
-        # First, we write out the source text to file.
-        source = open('/tmp/{0}.source'.format(request_id), 'w')
-        source.write(message.source_text.encode('utf-8'))
-        source.close()
-        
-        # Then, we invoke the Moses command reading from the source file
-        # and writing to a target file, also inside /tmp.  This blocks until
-        # the Moses process finishes.
-        shell_cmd = "{0} -f {1} < /tmp/{2}.source > /tmp/{3}.target".format(
-          self.MOSES_CMD, self.MOSES_CONFIG, request_id, request_id)
-        
-        proc_stdout, proc_stderr = Popen(shell_cmd, shell=True, stdout=PIPE,
-          stderr=PIPE).communicate()
-        
-        # Wait for some time to ensure file I/O is completed.
-        sleep(2)
+        pair = (message.source_language, message.target_language)
+
+        # Large documents are split into shards of consecutive lines which
+        # are decoded in parallel and re-assembled in their original order.
+        source_lines = split_lines(message.source_text)
+        shards = split_shards(source_lines,
+          self.shard_count(len(source_lines)))
+
+        # Translated lines are reported as they are read from the decoders,
+        # so that clients can follow progress and fetch the target prefix.
+        progress = ProgressCollector(partial(self.report_progress,
+          request_id), shards)
+
+        # If persistent decoders are available, we stream the source lines
+        # through them instead of loading the models again.
+        if self.registry:
+            # Translations of deleted or overdue requests are abandoned, so
+            # that this thread does not wait for their decoders.
+            on_cancel = partial(self.on_cancel, request_id)
+            try:
+                with self.registry.pool(pair) as pool:
+                    results = self.map_shards(lambda (index, lines):
+                      pool.decode(lines, partial(progress.add, index),
+                      on_cancel), list(enumerate(shards)))
+            
+            except IOError:
+                if not self.is_cancelled(request_id):
+                    raise
+            
+            if self.is_cancelled(request_id):
+                handle.close()
+                return
         
-        # We can now load the translation from the target file.
-        target = open('/tmp/{0}.target'.format(request_id), 'r')
-        target_text = target.read()
-        message.target_text = unicode(target_text, 'utf-8')
-        target.close()
+        else:
+            config = self.moses_configs()[pair]
+            results = self.map_shards(lambda (index, lines):
+              self.decode_shard(request_id, index, config, lines,
+              partial(progress.add, index)), list(enumerate(shards)))
         
-        keyvalue = message.packet_data.add()
-        keyvalue.key = 'STDOUT'
-        keyvalue.value = proc_stdout
+        # If any decoder terminated prematurely, no target text is set and
+        # the request fails; the decoders' error output is kept in any case.
+        if all([target is not None for target, _ in results]):
+            message.target_text = u''.join([u'{0}\n'.format(line)
+              for target, _ in results for line in target])
         
-        keyvalue = message.packet_data.add()
-        keyvalue.key = 'STDERR'
-        keyvalue.value = proc_stderr
+        for index, (_, proc_stderr) in enumerate(results):
+            suffix = '.{0}'.format(index) if len(results) > 1 else ''
+            
+            keyvalue = message.packet_data.add()
+            keyvalue.key = 'STDERR{0}'.format(suffix)
+            keyvalue.value = proc_stderr
         
         handle.seek(0)
         handle.write(message.SerializeToString())
         handle.close()
+
+    def decode_shard(self, request_id, index, config, lines, callback=None):
+        """
+        Translates the given shard of source lines using a new Moses process;
+        callback is passed on to MosesDecoder.translate().
+
+        Source lines are streamed to the decoder's stdin and translations are
+        read back line by line from its stdout, so neither scratch files nor
+        waiting for file I/O are needed.  Returns a (target_lines, stderr)
+        tuple; target_lines is None if the decoder terminated prematurely,
+        stderr holds the last lines of the decoder's error output.
+        """
+        if not lines:
+            return ([], '')
+
+        decoder = MosesDecoder(self.MOSES_CMD, config)
+        try:
+            target_lines = decoder.translate(lines, callback)
+
+        except IOError, msg:
+            self.LOGGER.error('Shard {0} of request {1}: {2}'.format(index,
+              request_id, msg))
+            target_lines = None
+
+        finally:
+            decoder.stop()
+
+        return (target_lines, decoder.error_log())
@@ -1,37 +1,106 @@
 """
 Implementation of a worker server that connects to a Moses SMT server system.
 """
+import httplib
+import socket
 import xmlrpclib
 
-from workers.worker import AbstractWorkerServer
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+from workers.decoder import not_cancellable, split_lines
+from workers.worker import AbstractWorkerServer, ProgressCollector
 from protobuf.TranslationRequestMessage_pb2 import TranslationRequestMessage
 
 
+# An old-style class, like xmlrpclib.Transport, so that its methods come first
+# in the method resolution order of the transports below.
+class AbortableMixin:
+    """
+    Makes an XML-RPC transport abortable from another thread, so that a
+    request waiting for a hanging Moses server fails at once.
+    """
+    aborted = False
+
+    def abort(self):
+        """Shuts down the connection and fails all further requests."""
+        self.aborted = True
+
+        # pylint: disable-msg=E1101,W0212
+        connection = self._connection[1]
+        if connection and connection.sock:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+
+            except socket.error:
+                pass
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        """
+        Sends a single request unless the transport has been aborted.
+
+        Transport.request() retries requests once if the connection has
+        been closed, so this is also checked before the retry.
+        """
+        if self.aborted:
+            raise socket.error('Request to {0} aborted.'.format(host))
+
+        return xmlrpclib.Transport.single_request(self, host, handler,
+          request_body, verbose)
+
+
+class AbortableTransport(AbortableMixin, xmlrpclib.Transport):
+    """Abortable XML-RPC transport for http:// backends."""
+
+
+class AbortableSafeTransport(AbortableMixin, xmlrpclib.SafeTransport):
+    """Abortable XML-RPC transport for https:// backends."""
+
+
 class MosesServerWorker(AbstractWorkerServer):
     """
     Implementation of a worker server connecting to a Moses SMT server system.
+
+    Segments are sent to one or several Moses server backends using a fixed
+    number of persistent connections per backend, so that several segment
+    requests are in flight at the same time.
     """
     __name__ = 'MosesServerWorker'
     # pylint: disable-msg=C0103
     MOSES_HOST = None
     MOSES_PORT = None
+    MOSES_BACKENDS = ()
     MOSES_SOURCE = None
     MOSES_TARGET = None
+    MOSES_INFLIGHT = 4
+    MOSES_MULTICALL = 1
+    proxies = None
+
+    # Connections are shared between jobs, hence jobs have to run as threads.
+    threaded_jobs = True
     
     @staticmethod
     def usage():
         """
         Returns usage information, e.g. for additional parameters, etc.
         """
-        return ('MOSES_HOST=http://example.org',
+        return AbstractWorkerServer.usage() + (
+          'MOSES_HOST=http://example.org',
           'MOSES_PORT=port_number',
+          'MOSES_BACKENDS=http://example.org:port,... (optional)',
           'MOSES_SOURCE=source_language_iso639_3_code',
-          'MOSES_TARGET=target_language_iso639_3_code')
+          'MOSES_TARGET=target_language_iso639_3_code',
+          'MOSES_INFLIGHT=parallel_requests_per_backend (optional)',
+          'MOSES_MULTICALL=segments_per_multicall_batch (optional)')
     
     def parse_args(self, args):
         """
         Parses the given args list and sets worker specific paramters.
         """
+        if not super(MosesServerWorker, self).parse_args(args):
+            return False
+
         for arg in args:
             try:
                 key, value = arg.split('=')
@@ -47,6 +116,10 @@ class MosesServerWorker(AbstractWorkerServer):
                 print "Setting MOSES_PORT={0}".format(value)
                 self.MOSES_PORT = value
 
+            elif key == 'MOSES_BACKENDS':
+                print "Setting MOSES_BACKENDS={0}".format(value)
+                self.MOSES_BACKENDS = tuple(value.split(','))
+
             elif key == 'MOSES_SOURCE':
                 print "Setting MOSES_SOURCE={0}".format(value)
                 self.MOSES_SOURCE = value
@@ -55,12 +128,48 @@ class MosesServerWorker(AbstractWorkerServer):
                 print "Setting MOSES_TARGET={0}".format(value)
                 self.MOSES_TARGET = value
         
-        if not self.MOSES_HOST or not self.MOSES_PORT or \
-          not self.MOSES_SOURCE or not self.MOSES_TARGET:
+            elif key == 'MOSES_INFLIGHT':
+                print "Setting MOSES_INFLIGHT={0}".format(value)
+                self.MOSES_INFLIGHT = int(value)
+
+            elif key == 'MOSES_MULTICALL':
+                print "Setting MOSES_MULTICALL={0}".format(value)
+                self.MOSES_MULTICALL = int(value)
+
+        if not self.backends() or not self.MOSES_SOURCE or \
+          not self.MOSES_TARGET or self.MOSES_INFLIGHT < 1:
             return False
         
+        # Each backend gets MOSES_INFLIGHT proxies, interleaved so that
+        # segment requests are spread evenly across all backends.
+        self.proxies = Queue()
+        for _ in range(self.MOSES_INFLIGHT):
+            for backend in self.backends():
+                self.proxies.put((backend, self.transport(backend)))
+
         return True
 
+    @staticmethod
+    def transport(backend):
+        """
+        Returns a new, abortable XML-RPC transport for the given backend.
+        """
+        if backend.startswith('https:'):
+            return AbortableSafeTransport()
+
+        return AbortableTransport()
+
+    def backends(self):
+        """
+        Returns a tuple of all configured Moses server URLs.
+        """
+        backends = list(self.MOSES_BACKENDS)
+        if self.MOSES_HOST and self.MOSES_PORT:
+            backends.append('{0}:{1}'.format(self.MOSES_HOST,
+              self.MOSES_PORT))
+
+        return tuple(backends)
+
     def language_pairs(self):
         """
         Returns a tuple of all supported language pairs for this worker.
@@ -79,36 +188,118 @@ class MosesServerWorker(AbstractWorkerServer):
 
     def is_alive(self):
         """
-        Checks if the Lucy RBMT XML-RPC interface is running.
+        Checks if at least one Moses server XML-RPC interface is running.
         """
-        proxy = xmlrpclib.ServerProxy('{0}:{1}'.format(self.MOSES_HOST,
-          self.MOSES_PORT))
+        for backend in self.backends():
+            proxy = xmlrpclib.ServerProxy(backend)
+            try:
+                _ = proxy.system.listMethods()
+                return True
+
+            except:
+                continue
+
+        return False
+
+    def _translate_batch(self, texts, callback=None, on_cancel=None):
+        """
+        Translates a batch of segments using one of the pooled connections.
+
+        If MOSES_MULTICALL is larger than 1, the whole batch is sent as a
+        single system.multicall request.  If callback is given, it is called
+        as callback(number, text) for each translated segment as soon as it
+        has been received.  If on_cancel is given, the connection is shut
+        down when the request is cancelled, see on_cancel() of the worker.
+        """
+        backend, transport = self.proxies.get()
+        proxy = xmlrpclib.ServerProxy(backend, transport=transport)
         try:
-            _ = proxy.system.listMethods()
-        
-        except:
-            return False
+            with (on_cancel or not_cancellable)(transport.abort):
+                if self.MOSES_MULTICALL > 1:
+                    multicall = xmlrpclib.MultiCall(proxy)
+                    for text in texts:
+                        multicall.translate({'text': text})
+                    contents = list(multicall())
+            
+                else:
+                    contents = []
+                    for text in texts:
+                        contents.append(proxy.translate({'text': text}))
+                        if callback:
+                            callback(len(contents) - 1,
+                              contents[-1].get('text', '\n'))
         
-        return True
+        except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+            # The connection may be broken, so we replace it by a new one.
+            transport = self.transport(backend)
+            raise
+
+        finally:
+            if transport.aborted:
+                transport = self.transport(backend)
+            self.proxies.put((backend, transport))
+
+        results = [content.get('text', '\n') for content in contents]
+
+        # Segments of a multicall batch are all received at once.
+        if callback and self.MOSES_MULTICALL > 1:
+            for number, text in enumerate(results):
+                callback(number, text)
+
+        return results
 
     def handle_translation(self, request_id):
         """
         Translates text using the connected Moses SMT server system.
         """
-        handle = open('/tmp/{0}.message'.format(request_id), 'r+b')
+        handle = open('{0}/{1}.message'.format(self.message_path,
+          request_id), 'r+b')
         message = TranslationRequestMessage()
         message.ParseFromString(handle.read())
 
-        proxy = xmlrpclib.ServerProxy('{0}:{1}'.format(self.MOSES_HOST,
-          self.MOSES_PORT))
+        lines = split_lines(message.source_text)
+        size = max(1, self.MOSES_MULTICALL)
+        batches = [lines[i:i + size] for i in range(0, len(lines), size)]
+
+        # Translated segments are reported as they arrive, so that clients
+        # can follow progress and fetch the target prefix.
+        progress = ProgressCollector(partial(self.report_progress,
+          request_id), batches)
+
+        def translate((index, batch)):
+            """Translates the given batch and reports its segments."""
+            if self.is_cancelled(request_id):
+                return []
+
+            return self._translate_batch(batch, partial(progress.add, index),
+              partial(self.on_cancel, request_id))
+
+        # Batches are sent concurrently, at most one per pooled connection;
+        # ThreadPool.map() returns the results in the original order.
+        # Connections of deleted or overdue requests are shut down, so that
+        # this thread does not wait for a hanging Moses server.
+        results = []
+        if batches:
+            pool = ThreadPool(min(len(batches),
+              self.MOSES_INFLIGHT * len(self.backends())))
+            try:
+                results = pool.map(translate, list(enumerate(batches)))
+
+            except (xmlrpclib.Error, socket.error, httplib.HTTPException):
+                if not self.is_cancelled(request_id):
+                    raise
+
+            finally:
+                pool.close()
 
-        result = []
-        for text in message.source_text.split(u'\n'):
-            content = proxy.translate({'text': text})
-            result.append(content.get('text', '\n'))
+        if self.is_cancelled(request_id):
+            handle.close()
+            return
 
+        result = [text for batch in results for text in batch]
         if result:
-            message.target_text = u'\n'.join(result)
+            message.target_text = u''.join([u'{0}\n'.format(text)
+              for text in result])
 
         handle.seek(0)
         handle.write(message.SerializeToString())